@@ -4,12 +4,19 @@ monkey.patch_all()
 
 from threading import Thread
 import time
-from datetime import datetime
 import logging
-from flask import Flask, send_from_directory
+from flask import (Flask, send_from_directory, jsonify, redirect, url_for,
+                   abort, request, Response, json)
 from flask.ext.socketio import SocketIO, emit
 import os
 import fermenter
+import dashboard
+import queries
+import export
+import supervisor
+import rendering
+import broadcast
+from instrumentation import metrics
 
 logging.basicConfig()
 
@@ -25,6 +32,10 @@ PLOTS_INTERVAL = 10 # (sec): time to wait between updating plots
 app = Flask(__name__)
 socketio = SocketIO(app)
 threads = {}
+vessels = {} # the supervised vessels, keyed by id
+packed_plots = False # whether plot updates are sent as packed arrays
+hub = broadcast.BroadcastHub(json.dumps) # fans updates out to dashboards
+exporter = export.Exporter()
 
 ###############################################################################
 # EVENTS
@@ -32,111 +43,158 @@ threads = {}
 @socketio.on("socket event", namespace="/socket")
 def handle_socket_event(message):
     print(message["data"])
+@socketio.on("dashboard subscribe", namespace="/socket")
+def handle_subscribe(message):
+    """Subscribes the client to the stats and plot updates of a vessel.
+    Clients showing plots as images, as given by a "plots" of "svg", are only
+    notified of which plots changed instead of being sent their samples.
+    """
+    vessel_id = message.get("vessel")
+    if vessel_id not in vessels:
+        return
+    namespace = request.namespace
+    def send(event, frame, acknowledge):
+        namespace.emit(event, frame, callback=acknowledge)
+    plots = "plot images" if message.get("plots") == "svg" else "plots"
+    hub.subscribe(namespace, send, (vessel_id, (vessel_id, plots)))
+@socketio.on("disconnect", namespace="/socket")
+def handle_disconnect():
+    hub.unsubscribe(request.namespace)
 @socketio.on("fermenter stop", namespace="/socket")
 def handle_stop(message):
-    if not events["fermenter idle"].is_set():
-        events["fermenter idle"].set()
-        fermenter.stop_fermenter(a, records, locks, events["fermenter idle"])
+    vessel = vessels.get(message.get("vessel"))
+    if vessel and not vessel.events["fermenter idle"].is_set():
+        vessel.send("stop")
 @socketio.on("fermenter start", namespace="/socket")
 def handle_start(message):
-    if events["fermenter idle"].is_set():
-        events["fermenter idle"].clear()
-        fermenter.start_fermenter(a, records, locks, events["fermenter idle"])
+    vessel = vessels.get(message.get("vessel"))
+    if vessel and vessel.events["fermenter idle"].is_set():
+        vessel.send("start")
 @socketio.on("impeller set", namespace="/socket")
 def handle_impeller(message):
-    with locks["records"]:
-        if message["data"]:
-            start = records["start"]
-            if records["impeller"][-1] is None:
-                records["impeller"].pop()
-            records["impeller"].append((fermenter.hours_offset(start,
-                                                               datetime.now()),
-                                        records["impeller"][-1][1]))
-            fermenter.set_impeller(a, locks["arduino"], float(message["data"]))
-            records["impeller"].append((fermenter.hours_offset(start,
-                                                               datetime.now()),
-                                        float(message["data"])))
+    vessel = vessels.get(message.get("vessel"))
+    if vessel and message["data"]:
+        vessel.send("impeller", float(message["data"]))
 @socketio.on("recalibrate optics", namespace="/socket")
 def handle_recalibrate(message):
-    if not events["calibrate"].is_set():
-        events["calibrate"].set()
+    vessel = vessels.get(message.get("vessel"))
+    if vessel and not vessel.events["calibrate"].is_set():
+        vessel.send("recalibrate")
+@socketio.on("plots resync", namespace="/socket")
+def handle_plots_resync(message):
+    """Sends the requesting client the samples it is missing."""
+    vessel = vessels.get(message.get("vessel"))
+    if not vessel:
+        return
+    for (event, update) in dashboard.resync_updates(
+            vessel.records, vessel.locks, message, packed_plots):
+        update["vessel"] = vessel.id
+        emit(event, update)
+@socketio.on("plot window request", namespace="/socket")
+def handle_plot_window(message):
+    """Sends the requesting client a decimated time window of a plot."""
+    vessel = vessels.get(message.get("vessel"))
+    if not vessel:
+        return
+    window = dashboard.plot_window(vessel.records, vessel.locks, message)
+    if window is not None:
+        window["vessel"] = vessel.id
+        emit("plot window", window)
+@socketio.on("series query", namespace="/socket")
+def handle_series_query(message):
+    """Sends the requesting client a page of samples of a channel of a vessel.
+    The message holds the vessel, channel and query parameters, and an
+    optional id which is echoed in the reply.
+    """
+    vessel = vessels.get(message.get("vessel"))
+    if not vessel:
+        return
+    reply = {"vessel": vessel.id, "id": message.get("id")}
+    try:
+        reply.update(queries.query_series(
+            vessel.records, **queries.parse_query(message.get("channel"),
+                                                  message)))
+    except ValueError as error:
+        reply["error"] = str(error)
+    emit("series query result", reply)
+@socketio.on("metrics request", namespace="/socket")
+def handle_metrics_request(message):
+    """Sends the requesting client summaries of the hot path metrics of a
+    vessel, or of the dashboard if no vessel is given.
+    """
+    emit("metrics update", metrics_summaries_of(message.get("vessel")))
+@socketio.on("metrics enable", namespace="/socket")
+def handle_metrics_enable(message):
+    """Switches metrics recording on or off, as given by the message data."""
+    metrics.enable(message["data"])
+    for vessel in vessels.values():
+        vessel.send("metrics enable", bool(message["data"]))
+    emit("metrics update", metrics_summaries_of(message.get("vessel")))
+@socketio.on("metrics reset", namespace="/socket")
+def handle_metrics_reset(message):
+    metrics.reset()
+    for vessel in vessels.values():
+        vessel.send("metrics reset")
+    emit("metrics update", metrics_summaries_of(message.get("vessel")))
+
+###############################################################################
+# STATELESS FUNCTIONS
+###############################################################################
+def metrics_summaries_of(vessel_id=None):
+    """Returns the metrics summaries of a vessel, or of the dashboard."""
+    if vessel_id is None:
+        return metrics.summaries()
+    vessel = vessels.get(vessel_id)
+    return {
+        "vessel": vessel_id,
+        "metrics": vessel.metrics if vessel else None,
+    }
 
 ###############################################################################
 # THREADS
 ###############################################################################
-def update_stats(records, locks):
+def start_threads(vessels):
+    """Starts the threads which broadcast updates of vessels, once for all
+    clients, whether or not any dashboard is open.
+    """
+    for (name, target) in (("stats", update_stats), ("plots", update_plots)):
+        if name not in threads or not threads[name].is_alive():
+            threads[name] = Thread(target=target, name=name, args=(vessels,))
+            threads[name].daemon = True
+            threads[name].start()
+def update_stats(vessels):
     while True:
-        with locks["records"]:
-            stats = {
-                "start": records["start"],
-                "stop": records["stop"],
-                "now": datetime.now(),
-                "since": fermenter.hours_offset(records["start"],
-                                                datetime.now()),
-                "temp": records["temp"][-1],
-                "heater": records["heater"][-1],
-                "impeller": records["impeller"][-1],
-                "optics": {
-                    "calibration": {
-                        "red": records["optics"]["calibration"]["red"],
-                        "green": records["optics"]["calibration"]["green"],
-                    },
-                    "ambient": records["optics"]["ambient"][-1],
-                    "red": records["optics"]["red"][-1],
-                    "green": records["optics"]["green"][-1],
-                },
-            }
-        socketio.emit("stats update", stats, namespace="/socket")
+        started = time.time()
+        for vessel in vessels.values():
+            stats = dashboard.construct_stats(vessel.records, vessel.locks)
+            stats["vessel"] = vessel.id
+            hub.publish("stats update", stats, vessel.id)
+        metrics.record("emit stats", time.time() - started)
         time.sleep(STATS_INTERVAL)
-def update_plots(records, locks):
-    temp_last_update = None
-    optics_last_update = None
-    duty_cycles_last_update = None
+def update_plots(vessels):
+    """Broadcasts the samples appended to each plot since the last broadcast.
+    Clients request full snapshots through "plots resync" when they connect or
+    when they detect a gap in the updates they received. Clients showing plots
+    as images are instead sent the ETag of each changed plot, with which they
+    fetch its SVG.
+    """
+    # Workers extend their impeller series themselves
+    broadcasters = {vessel_id: dashboard.PlotBroadcaster(False, packed_plots)
+                    for vessel_id in vessels.keys()}
     while True:
-        rerender_optics = False
-        rerender_temp = False
-        rerender_duty_cycles = False
-        with locks["records"]:
-            start = records["start"]
-            if records["optics"]["red"][-1]:
-                if (not optics_last_update or
-                        optics_last_update < records["optics"]["red"][-1][0]):
-                    optics_last_update = records["optics"]["red"][-1][0]
-                    rerender_optics = True
-            if records["temp"][-1] and records["heater"][-1]:
-                if (not temp_last_update or
-                        temp_last_update < records["temp"][-1][0]):
-                    temp_last_update = records["temp"][-1][0]
-                    rerender_temp = True
-            if records["impeller"][-1]:
-                if (not duty_cycles_last_update or
-                        duty_cycles_last_update < records["impeller"][-1][0]):
-                    duty_cycles_last_update = records["impeller"][-1][0]
-                    rerender_duty_cycles = True
-                    if records["impeller"][-1] is None:
-                        records["impeller"].pop()
-                    records["impeller"].append((fermenter.hours_offset(start,
-                                                                       datetime.now()),
-                                                records["impeller"][-1][1]))
-            if rerender_optics:
-                socketio.emit("optics plot update", {
-                    "calibration": records["optics"]["calibration"],
-                    "redgreen": [x + (z,) for x, (y, z) in
-                                 zip(records["optics"]["red"],
-                                     records["optics"]["green"])],
-                }, namespace="/socket")
-                socketio.emit("environ plot update", {
-                    "ambient": records["optics"]["ambient"]
-                }, namespace="/socket")
-            if rerender_temp:
-                socketio.emit("temp plot update", {
-                    "tempheater": [x + (z,) for x, (y, z) in
-                                   zip(records["temp"], records["heater"])],
-                }, namespace="/socket")
-            if rerender_duty_cycles:
-                socketio.emit("impeller plot update", {
-                    "impeller": records["impeller"],
-                }, namespace="/socket")
+        started = time.time()
+        for vessel in vessels.values():
+            for (event, update) in broadcasters[vessel.id].updates(
+                    vessel.records, vessel.locks):
+                update["vessel"] = vessel.id
+                hub.publish(event, update, (vessel.id, "plots"))
+                plot = event.split(" ")[0]
+                hub.publish(plot + " plot image update", {
+                    "vessel": vessel.id,
+                    "plot": plot,
+                    "etag": rendering.plot_etag(vessel.records, plot),
+                }, (vessel.id, "plot images"))
+        metrics.record("emit plots", time.time() - started)
         time.sleep(PLOTS_INTERVAL)
 
 ###############################################################################
@@ -144,18 +202,120 @@ def update_plots(records, locks):
 ###############################################################################
 @app.route("/")
 def index():
-    """Deliver the dashboard"""
-    global threads
-    if "stats" not in threads.keys() or not threads["stats"].is_alive():
-        threads["stats"] = Thread(target=update_stats, name="stats",
-                                  args=(records, locks))
-        threads["stats"].start()
-    if "plot" not in threads.keys() or not threads["plot"].is_alive():
-        threads["plots"] = Thread(target=update_plots, name="plots",
-                                  args=(records, locks))
-        threads["plots"].start()
+    """Deliver the dashboard of the first vessel"""
+    return redirect(url_for("vessel_dashboard",
+                            vessel_id=next(iter(vessels.keys()))))
+
+@app.route("/vessels")
+def vessel_ids():
+    """Deliver the ids of all vessels as JSON"""
+    return jsonify(vessels=list(vessels.keys()))
+
+@app.route("/vessels/<vessel_id>")
+def vessel_dashboard(vessel_id):
+    """Deliver the dashboard of the specified vessel"""
+    if vessel_id not in vessels:
+        abort(404)
     return send_from_directory("static", "dashboard.html")
 
+@app.route("/vessels/<vessel_id>/series/<channel>")
+def vessel_series(vessel_id, channel):
+    """Deliver a page of samples of a channel of a vessel as JSON.
+    Query parameters are t0, t1, cursor, generation, offset, limit, bucket
+    and aggregate; see queries.query_series.
+    """
+    if vessel_id not in vessels:
+        abort(404)
+    try:
+        result = queries.query_series(vessels[vessel_id].records,
+                                      **queries.parse_query(channel,
+                                                            request.args))
+    except ValueError as error:
+        response = jsonify(error=str(error))
+        response.status_code = 400
+        return response
+    result["vessel"] = vessel_id
+    return jsonify(result)
+
+@app.route("/vessels/<vessel_id>/exports", methods=["POST"])
+def vessel_export(vessel_id):
+    """Start exporting the run of a vessel to a file in the requested format"""
+    if vessel_id not in vessels:
+        abort(404)
+    try:
+        job = exporter.export(vessels[vessel_id].records, vessel_id,
+                              request.args.get("format", "npz"),
+                              vessels[vessel_id].log_path)
+    except ValueError as error:
+        response = jsonify(error=str(error))
+        response.status_code = 400
+        return response
+    job["url"] = url_for("vessel_export_job", vessel_id=vessel_id,
+                         job_id=job["id"])
+    response = jsonify(job)
+    response.status_code = 202
+    return response
+
+@app.route("/vessels/<vessel_id>/exports/<int:job_id>")
+def vessel_export_job(vessel_id, job_id):
+    """Deliver the state of an export as JSON"""
+    job = exporter.job(job_id)
+    if job is None or job["name"] != vessel_id:
+        abort(404)
+    if job["state"] == "done":
+        job["file"] = url_for("vessel_export_file", vessel_id=vessel_id,
+                              job_id=job_id)
+    return jsonify(job)
+
+@app.route("/vessels/<vessel_id>/exports/<int:job_id>/file")
+def vessel_export_file(vessel_id, job_id):
+    """Deliver the file written by a finished export"""
+    job = exporter.job(job_id)
+    if job is None or job["name"] != vessel_id or job["state"] != "done":
+        abort(404)
+    return send_from_directory(os.path.abspath(exporter.directory),
+                               os.path.basename(job["path"]),
+                               as_attachment=True)
+
+@app.route("/vessels/<vessel_id>/export.csv")
+def vessel_export_csv(vessel_id):
+    """Stream the run of a vessel as a CSV download"""
+    if vessel_id not in vessels:
+        abort(404)
+    snapshot = fermenter.records_snapshot(vessels[vessel_id].records)
+    filename = export.export_filename(vessel_id, snapshot, "csv")
+    snapshot = export.full_resolution_snapshot(snapshot,
+                                               vessels[vessel_id].log_path)
+    return Response(export.csv_chunks(snapshot), mimetype="text/csv",
+                    headers={"Content-Disposition":
+                             "attachment; filename=" + filename})
+
+@app.route("/vessels/<vessel_id>/metrics")
+def vessel_metrics_summaries(vessel_id):
+    """Deliver summaries of the hot path metrics of a vessel as JSON"""
+    if vessel_id not in vessels:
+        abort(404)
+    return jsonify(metrics_summaries_of(vessel_id))
+
+@app.route("/vessels/<vessel_id>/plots/<plot>")
+def vessel_plot(vessel_id, plot):
+    """Deliver the specified plot of a vessel as SVG.
+    Plots are only rendered again when their samples change, and clients
+    revalidating a cached plot by its ETag get an empty response until then.
+    """
+    if vessel_id not in vessels or plot not in rendering.PLOTS:
+        abort(404)
+    records = vessels[vessel_id].records
+    etag = rendering.plot_etag(records, plot)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        (etag, svg) = rendering.cached_plot(records, plot)
+        response = Response(svg, mimetype="image/svg+xml")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
 @app.route("/client.js")
 def client():
     """Deliver the client-side scripting"""
@@ -168,12 +328,21 @@ def style():
 
 @app.route("/plots/<plot>")
 def plots(plot):
-    """Deliver the specified plot"""
-    return send_from_directory("static/plots/", plot + ".svg")
+    """Deliver the specified plot of the first vessel"""
+    return redirect(url_for("vessel_plot",
+                            vessel_id=next(iter(vessels.keys())), plot=plot))
+
+@app.route("/metrics")
+def metrics_summaries():
+    """Deliver summaries of the hot path metrics as JSON"""
+    return jsonify(metrics.summaries())
 
 ###############################################################################
 # MAIN
 ###############################################################################
 if __name__ == "__main__":
-    (a, records, locks, events, threads) = fermenter.run_fermenter()
-    socketio.run(app, host='0.0.0.0', port=80)
+    args = supervisor.parse_args("Serves a web dashboard for fermenters.")
+    packed_plots = args.packed_plots
+    vessels = supervisor.run_vessels_from_args(args)
+    start_threads(vessels)
+    socketio.run(app, host='0.0.0.0', port=args.http_port)
@@ -0,0 +1,285 @@
+#!/usr/bin/env python2
+"""
+Benchmarks the acquisition, filtering and dashboard paths of the fermenter.
+Runs offline against a simulated Arduino and prints results as JSON, so that
+results can be compared across commits.
+"""
+
+import sys
+import json
+import time
+import argparse
+import threading
+import subprocess
+from collections import OrderedDict
+import numpy as np
+import fermenter
+import dashboard
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+HISTORIES = OrderedDict([ # (hours): lengths of synthetic run histories
+    ("1 hour", 1),
+    ("1 day", 24),
+    ("2 weeks", 336),
+])
+TEMP_RECORD_INTERVAL = 20 # (sec): time between synthetic temp records
+LIGHT_RECORD_INTERVAL = 20 # (sec): time between synthetic optics records
+PERCENTILES = (50, 90, 99)
+
+# Repetitions
+ACQUISITION_REPEATS = 20
+FILTER_REPEATS = 1000
+MEASUREMENT_REPEATS = 2
+EMIT_REPEATS = 20
+DELTA_SAMPLES = 1 # samples appended to each series between plot emits
+
+# Full measurements are dominated by host overheads once they are scaled up,
+# so they run at this time scale whatever the time scale of the others
+MEASUREMENT_TIME_SCALE = 1
+
+###############################################################################
+# INSTRUMENTS
+###############################################################################
+class TimedLock(object):
+    """A lock which records how long it is waited for and held."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.waits = []
+        self.holds = []
+        self._acquired = None
+    def __enter__(self):
+        requested = time.time()
+        self._lock.acquire()
+        self._acquired = time.time()
+        self.waits.append(self._acquired - requested)
+        return self
+    def __exit__(self, *_):
+        self.holds.append(time.time() - self._acquired)
+        self._lock.release()
+def summarize(durations):
+    """Returns the count, mean, max and percentiles of durations (in sec)."""
+    durations = np.asarray(durations, dtype=np.float64)
+    if not durations.size:
+        return {"count": 0}
+    summary = OrderedDict([
+        ("count", int(durations.size)),
+        ("mean", float(durations.mean())),
+        ("max", float(durations.max())),
+    ])
+    for percentile in PERCENTILES:
+        summary["p%d" % percentile] = float(np.percentile(durations,
+                                                          percentile))
+    return summary
+def timed(function, repeats, clock=time):
+    """Returns the durations of repeated calls of a function."""
+    durations = []
+    for _ in range(repeats):
+        started = clock.time()
+        function()
+        durations.append(clock.time() - started)
+    return durations
+def payload_bytes(message):
+    """Returns the length of a message when serialized as JSON."""
+    return len(json.dumps(message, default=str))
+
+###############################################################################
+# SYNTHETIC DATA
+###############################################################################
+def synthetic_records(hours, seed=0):
+    """Returns records filled with a plausible run of the specified length."""
+    rng = np.random.RandomState(seed)
+    records = fermenter.construct_records()
+    series = records["series"]
+    temp_times = np.arange(0, hours * 3600, TEMP_RECORD_INTERVAL) / 3600.0
+    temps = fermenter.SETPOINT + rng.normal(0, 0.2, temp_times.size)
+    series["temp"].extend(temp_times, temps)
+    series["heater"].extend(temp_times, np.vectorize(
+        fermenter.temp_to_heating_control_effort)(temps))
+    series["impeller"].extend(temp_times[:1], [fermenter.IMPELLER_DEFAULT_DUTY])
+    light_times = np.arange(0, hours * 3600, LIGHT_RECORD_INTERVAL) / 3600.0
+    od = 1.5 / (1 + 29 * np.exp(-0.7 * light_times))
+    ambient = 900 + rng.normal(0, 2, light_times.size)
+    series["ambient"].extend(light_times, ambient)
+    series["red"].extend(light_times, 600 * 10 ** -od)
+    series["green"].extend(light_times, 500 * 10 ** (-0.6 * od))
+    records["optics"]["calibration"]["red"] = 600 * 10 ** -od[0]
+    records["optics"]["calibration"]["green"] = 500 * 10 ** (-0.6 * od[0])
+    fermenter.publish_records(records)
+    return records
+def append_synthetic_samples(records, nsamples):
+    """Appends samples just after the end of each series of records."""
+    series = records["series"]
+    for channel in series.channels():
+        last = series.last(channel) or (0, 0)
+        for i in range(nsamples):
+            series.append(channel, last[0] + (i + 1) / 3600.0, last[1])
+    fermenter.publish_records(records)
+
+###############################################################################
+# BENCHMARKS
+###############################################################################
+def bench_acquisition(a):
+    """Benchmarks batched pin acquisition against the simulated Arduino."""
+    pin = fermenter.SENSOR_PINS["phototransistor"]
+    nsamples = fermenter.LIGHT_SAMPLES_PER_ACQUISITION
+    durations = timed(lambda: fermenter.acquire_pin(
+        a, pin, nsamples, fermenter.LIGHT_SAMPLE_INTERVAL),
+        ACQUISITION_REPEATS, fermenter.clock)
+    return OrderedDict([
+        ("latency", summarize(durations)),
+        ("samples_per_sec", nsamples * len(durations) / sum(durations)),
+    ])
+def bench_filters():
+    """Benchmarks outlier removal and estimation on acquisition-sized
+    batches.
+    """
+    rng = np.random.RandomState(0)
+    light = rng.normal(600, 3, fermenter.LIGHT_SAMPLES_PER_ACQUISITION)
+    temp = rng.normal(215, 1, fermenter.TEMP_SAMPLES_PER_ACQUISITION)
+    # Estimators of their own leave those of any running fermenter alone
+    estimators = fermenter.construct_estimators()
+    results = OrderedDict()
+    for (name, function, samples) in (
+            ("discard_light_outliers", fermenter.discard_light_outliers,
+             light),
+            ("discard_temp_outliers", fermenter.discard_temp_outliers, temp),
+            ("estimate_acquisition light",
+             lambda samples: fermenter.estimate_acquisition(
+                 "red", samples, estimators["red"]),
+             light),
+            ("estimate_acquisition temp",
+             lambda samples: fermenter.estimate_acquisition(
+                 "temp", samples, estimators["temp"]),
+             temp)):
+        durations = timed(lambda: function(samples), FILTER_REPEATS)
+        results[name] = OrderedDict([
+            ("latency", summarize(durations)),
+            ("samples_per_sec", samples.size * len(durations) /
+             sum(durations)),
+        ])
+    return results
+def bench_measurements(a):
+    """Benchmarks full temperature and transmittance measurements."""
+    results = OrderedDict()
+    estimator = fermenter.construct_estimators()["temp"]
+    results["measure_temp"] = summarize(timed(
+        lambda: fermenter.measure_temp(a, estimator), MEASUREMENT_REPEATS,
+        fermenter.clock))
+    for mode in ("multiplexed", "early-stopping"):
+        results["measure_transmittances " + mode] = summarize(timed(
+            lambda: fermenter.measure_transmittances(a, mode),
+            MEASUREMENT_REPEATS, fermenter.clock))
+    return results
+def bench_dashboard(hours):
+    """Benchmarks the stats and plot emit paths over a synthetic history."""
+    records = synthetic_records(hours)
+    locks = fermenter.construct_locks()
+    locks["records"] = TimedLock()
+    results = OrderedDict()
+    results["samples"] = sum(len(records["series"][channel])
+                             for channel in records["series"])
+    stats = []
+    durations = []
+    for _ in range(EMIT_REPEATS):
+        started = time.time()
+        stats.append(dashboard.construct_stats(records, locks))
+        durations.append(time.time() - started)
+    results["stats"] = OrderedDict([
+        ("latency", summarize(durations)),
+        ("bytes_per_emit", payload_bytes(stats[-1])),
+    ])
+    for packed in (False, True):
+        suffix = " packed" if packed else ""
+        broadcaster = dashboard.PlotBroadcaster(packed=packed)
+        broadcaster.updates(records, locks)
+        for (name, prepare, make) in (
+                ("plot snapshot", lambda: None,
+                 lambda: dashboard.resync_updates(records, locks, {}, packed)),
+                ("plot delta",
+                 lambda: append_synthetic_samples(records, DELTA_SAMPLES),
+                 lambda: broadcaster.updates(records, locks))):
+            durations = []
+            encodings = []
+            sizes = []
+            for _ in range(EMIT_REPEATS):
+                prepare()
+                started = time.time()
+                updates = make()
+                durations.append(time.time() - started)
+                started = time.time()
+                sizes.append(sum(payload_bytes(update)
+                                 for (_, update) in updates))
+                encodings.append(time.time() - started)
+            results[name + suffix] = OrderedDict([
+                ("latency", summarize(durations)),
+                ("encode_latency", summarize(encodings)),
+                ("bytes_per_emit", float(np.mean(sizes))),
+            ])
+    results["records lock"] = OrderedDict([
+        ("wait", summarize(locks["records"].waits)),
+        ("hold", summarize(locks["records"].holds)),
+    ])
+    return results
+def git_commit():
+    """Returns the current git commit, or None outside of a repository."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"]).decode(
+            "ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+def connect_simulated(latency, time_scale, seed):
+    """Returns a simulated Arduino on a fermenter clock of a time scale."""
+    fermenter.set_clock(time_scale)
+    a = fermenter.connect("simulated", latency=latency, seed=seed)
+    fermenter.set_pin_modes(a)
+    return a
+def run_benchmarks(latency=None, time_scale=1, seed=0):
+    """Runs all benchmarks and returns their results.
+    Acquisition and measurement durations are in simulated seconds;
+    measurements are simulated at MEASUREMENT_TIME_SCALE.
+    """
+    measurements = bench_measurements(connect_simulated(
+        latency, MEASUREMENT_TIME_SCALE, seed))
+    a = connect_simulated(latency, time_scale, seed)
+    results = OrderedDict([
+        ("commit", git_commit()),
+        ("latency", a.latency),
+        ("time_scale", time_scale),
+        ("measurement_time_scale", MEASUREMENT_TIME_SCALE),
+        ("acquire_pin", bench_acquisition(a)),
+        ("filters", bench_filters()),
+        ("measurements", measurements),
+        ("dashboard", OrderedDict()),
+    ])
+    for (name, hours) in HISTORIES.items():
+        results["dashboard"][name] = bench_dashboard(hours)
+    return results
+
+###############################################################################
+# MAIN
+###############################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--latency", type=float, default=None,
+                        help="serial round-trip time (sec) of the simulation")
+    parser.add_argument("--time-scale", type=float, default=10,
+                        help="factor by which the simulation is sped up; "
+                             "host overheads are scaled up by the same "
+                             "factor, so full measurements run in real time")
+    parser.add_argument("--output", default=None,
+                        help="path of a file to write results to")
+    args = parser.parse_args()
+    # Only the results are printed to stdout, so that they can be redirected
+    stdout = sys.stdout
+    sys.stdout = sys.stderr
+    try:
+        results = run_benchmarks(args.latency, args.time_scale)
+    finally:
+        sys.stdout = stdout
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    print(output)
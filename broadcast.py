@@ -0,0 +1,149 @@
+#!/usr/bin/env python2
+"""
+Broadcasts dashboard updates to many clients at once.
+Each update is encoded once per tick, and the same encoded frame is fanned out
+to every client subscribed to its topic. Each subscriber sends one frame at a
+time and waits for the client to acknowledge it before sending the next;
+frames published meanwhile wait in a mailbox which keeps only the latest frame
+of each event, so a slow client skips to the latest update instead of falling
+ever further behind, and never holds up the others.
+"""
+
+import json
+import time
+import threading
+from threading import Thread
+from collections import OrderedDict
+from instrumentation import metrics
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+ACK_TIMEOUT = 30 # (sec): time to wait for a client to acknowledge a frame
+
+###############################################################################
+# STATELESS FUNCTIONS
+###############################################################################
+def encode_json(message):
+    """Returns the compact JSON text of a message."""
+    return json.dumps(message, separators=(",", ":"), default=str)
+
+###############################################################################
+# SUBSCRIBERS
+###############################################################################
+class Subscriber(object):
+    """A client of a broadcast hub, with a sender thread which sends it one
+    frame at a time. A frame replaces any frame of the same event still
+    waiting to be sent, and counts as dropped.
+
+    Arguments:
+        send: a function of an event, an encoded frame and an acknowledge
+            function, which sends the frame to the client and arranges for
+            acknowledge to be called once the client has handled it
+        topics: the topics of the frames sent to the client
+    """
+    def __init__(self, send, topics):
+        self.topics = frozenset(topics)
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        self._send = send
+        self._mailbox = OrderedDict()
+        self._lock = threading.Lock()
+        self._pending = threading.Event()
+        self._acknowledged = threading.Event()
+        self._thread = Thread(target=self._run, name="subscriber")
+        self._thread.daemon = True
+        self._thread.start()
+    def offer(self, event, frame):
+        """Queues a frame to be sent, replacing an unsent frame of the event.
+        Returns whether an unsent frame was dropped.
+        """
+        with self._lock:
+            dropped = self._mailbox.pop(event, None) is not None
+            self._mailbox[event] = frame
+            if dropped:
+                self.dropped += 1
+        self._pending.set()
+        return dropped
+    def close(self):
+        """Stops sending frames to the client."""
+        self.closed = True
+        self._pending.set()
+        self._acknowledged.set()
+    def _acknowledge(self, *args):
+        self._acknowledged.set()
+    def _run(self):
+        while not self.closed:
+            self._pending.wait()
+            with self._lock:
+                if not self._mailbox:
+                    self._pending.clear()
+                    continue
+                (event, frame) = self._mailbox.popitem(last=False)
+            if self.closed:
+                break
+            self._acknowledged.clear()
+            try:
+                self._send(event, frame, self._acknowledge)
+            except Exception:
+                # The client is gone; it is unsubscribed on disconnection
+                self.closed = True
+                break
+            self.sent += 1
+            self._acknowledged.wait(ACK_TIMEOUT)
+
+###############################################################################
+# HUB
+###############################################################################
+class BroadcastHub(object):
+    """Fans encoded frames out to subscribed clients.
+
+    Arguments:
+        encode: a function which returns the encoded frame of a message
+    """
+    def __init__(self, encode=encode_json):
+        self.encode = encode
+        self._subscribers = {}
+        self._lock = threading.Lock()
+    def subscribe(self, key, send, topics):
+        """Subscribes a client to the frames of some topics, replacing any
+        earlier subscription of the client.
+
+        Arguments:
+            key: a hashable identifying the client, such as its connection
+            send: the send function of the subscriber, as for Subscriber
+            topics: the hashable topics of the frames to send, such as a
+                vessel id
+        """
+        subscriber = Subscriber(send, topics)
+        with self._lock:
+            previous = self._subscribers.get(key)
+            self._subscribers[key] = subscriber
+        if previous is not None:
+            previous.close()
+    def unsubscribe(self, key):
+        """Unsubscribes a client, if it is subscribed."""
+        with self._lock:
+            subscriber = self._subscribers.pop(key, None)
+        if subscriber is not None:
+            subscriber.close()
+    def subscriber_count(self):
+        """Returns the number of subscribed clients."""
+        with self._lock:
+            return len(self._subscribers)
+    def publish(self, event, message, topic):
+        """Encodes a message once and offers the frame to every subscriber of
+        its topic. Returns the number of subscribers it was offered to.
+        """
+        started = time.time()
+        frame = self.encode(message)
+        metrics.record("broadcast encode", time.time() - started)
+        with self._lock:
+            subscribers = [subscriber for subscriber
+                           in self._subscribers.values()
+                           if topic in subscriber.topics]
+        for subscriber in subscribers:
+            if not subscriber.closed:
+                subscriber.offer(event, frame)
+        return len(subscribers)
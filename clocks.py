@@ -0,0 +1,69 @@
+#!/usr/bin/env python2
+"""
+Clocks through which the fermenter reads time and waits.
+"""
+
+import time
+from datetime import datetime, timedelta
+
+###############################################################################
+# CLOCKS
+###############################################################################
+class Clock(object):
+    """The real wall clock."""
+    def now(self):
+        """Returns the current datetime."""
+        return datetime.now()
+    def time(self):
+        """Returns the current time, in seconds since the epoch."""
+        return time.time()
+    def sleep(self, seconds):
+        """Waits for the specified duration."""
+        time.sleep(seconds)
+    def wait(self, event, timeout=None):
+        """Waits for an event to be set or for the timeout to elapse.
+        Returns whether the event was set.
+        """
+        return event.wait(timeout)
+class ScaledClock(Clock):
+    """A clock which runs faster than real time by a constant factor.
+    Durations passed to the clock are divided by the scale before waiting on
+    the real clock, and elapsed real time is multiplied by the scale.
+    """
+    def __init__(self, scale):
+        self.scale = float(scale)
+        self._real_origin = time.time()
+        self._origin = datetime.now()
+    def _elapsed(self):
+        return (time.time() - self._real_origin) * self.scale
+    def now(self):
+        return self._origin + timedelta(seconds=self._elapsed())
+    def time(self):
+        return self._real_origin + self._elapsed()
+    def sleep(self, seconds):
+        time.sleep(seconds / self.scale)
+    def wait(self, event, timeout=None):
+        if timeout is None:
+            return event.wait()
+        return event.wait(timeout / self.scale)
+class VirtualClock(Clock):
+    """A clock whose time only advances when it is slept or waited on.
+    Replays run the scheduler in a single thread against this clock, so
+    waiting for an event which is not set just advances time by the timeout,
+    and a week of simulated time passes as fast as the steps can run.
+
+    Arguments:
+        origin: the initial time, in seconds since the epoch
+    """
+    def __init__(self, origin):
+        self._time = float(origin)
+    def now(self):
+        return datetime.fromtimestamp(self._time)
+    def time(self):
+        return self._time
+    def sleep(self, seconds):
+        self._time += max(0, seconds)
+    def wait(self, event, timeout=None):
+        if not event.is_set() and timeout is not None:
+            self.sleep(timeout)
+        return event.is_set()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python2
+"""
+Feedback controllers of fermenter actuators.
+"""
+
+###############################################################################
+# CONTROLLERS
+###############################################################################
+class PIDController(object):
+    """A PID controller with feed-forward and integrator anti-windup.
+    The output is the feed-forward plus proportional, integral and derivative
+    terms of the error from the setpoint, limited to the output range. The
+    derivative acts on the low-pass filtered measurement rather than on the
+    error, so that setpoint changes do not kick the output. The integral stops
+    growing while the output is saturated in the direction of the error, and
+    its contribution is limited to the output range, so it does not wind up
+    while the actuator is pinned at a limit.
+
+    Arguments:
+        setpoint: the target value of the measurement
+        kp: the proportional gain, in output units per measurement unit
+        ki: the integral gain, in output units per measurement unit-second
+        kd: the derivative gain, in output unit-seconds per measurement unit
+        feed_forward: the output expected to hold the measurement at setpoint
+        limits: the lowest and highest outputs
+        derivative_filter_time: the time constant (in sec) of the low-pass
+            filter on the derivative of the measurement
+    """
+    def __init__(self, setpoint, kp, ki=0, kd=0, feed_forward=0,
+                 limits=(0, 1), derivative_filter_time=0):
+        self.setpoint = setpoint
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self.feed_forward = feed_forward
+        self.limits = limits
+        self.derivative_filter_time = derivative_filter_time
+        self.reset()
+    def reset(self):
+        """Forgets the integral and the previous measurement."""
+        self.integral = 0
+        self.derivative = 0
+        self.output = None
+        self._last_measurement = None
+    def update(self, measurement, dt):
+        """Returns the output for a new measurement.
+
+        Arguments:
+            dt: the time (in sec) since the previous measurement
+        """
+        (low, high) = self.limits
+        error = self.setpoint - measurement
+        if self._last_measurement is not None and dt > 0:
+            rate = (measurement - self._last_measurement) / dt
+            smoothing = dt / (self.derivative_filter_time + dt)
+            self.derivative += smoothing * (rate - self.derivative)
+        self._last_measurement = measurement
+        output = (self.feed_forward + self.kp * error + self.integral -
+                  self.kd * self.derivative)
+        saturated = ((output >= high and error > 0) or
+                     (output <= low and error < 0))
+        if not saturated:
+            self.integral = max(low - self.feed_forward,
+                                min(high - self.feed_forward,
+                                    self.integral + self.ki * error * dt))
+        self.output = max(low, min(high, output))
+        return self.output
@@ -0,0 +1,261 @@
+#!/usr/bin/env python2
+"""
+Builds the stats and plot messages sent to dashboard clients.
+"""
+
+import base64
+import weakref
+import numpy as np
+import fermenter
+import decimation
+import queries
+from estimators import doubling_time
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+PLOT_POINTS = 1000 # maximum number of points per series in snapshots
+PACKED_TYPE = "<f4" # array type of packed sample times and values
+PLOT_CHANNELS = { # the recorded channels shown in each plot
+    "temp": ("temp", "heater"),
+    "optics": ("red", "green"),
+    "environ": ("ambient",),
+    "impeller": ("impeller",),
+}
+
+###############################################################################
+# GLOBALS
+###############################################################################
+pyramids = weakref.WeakKeyDictionary() # decimation pyramids by series store
+
+###############################################################################
+# STATS
+###############################################################################
+def construct_stats(records, locks):
+    """Returns a stats message with the latest samples of all series.
+    Reads the latest snapshot of records, so never waits for the records lock.
+    """
+    snapshot = fermenter.records_snapshot(records)
+    last = snapshot.last
+    stats = {
+        "start": snapshot.start,
+        "stop": snapshot.stop,
+        "now": fermenter.clock.now(),
+        "since": fermenter.hours_offset(snapshot.start, fermenter.clock.now()),
+        "temp": last["temp"],
+        "heater": last["heater"],
+        "impeller": last["impeller"],
+        "optics": {
+            "calibration": {
+                "red": snapshot.calibration["red"],
+                "green": snapshot.calibration["green"],
+            },
+            "ambient": last["ambient"],
+            "red": last["red"],
+            "green": last["green"],
+            "od": last["od"],
+        },
+        "growth": {
+            "rate": last["growth"],
+            "doubling_time": doubling_time(last["growth"] and
+                                           last["growth"][1]),
+            "phase": snapshot.phase,
+        },
+    }
+    return stats
+
+###############################################################################
+# PLOTS
+###############################################################################
+def series_pyramids(series):
+    """Returns the decimation pyramids of each channel of a series store."""
+    store_pyramids = pyramids.get(series)
+    if store_pyramids is None:
+        store_pyramids = {channel: decimation.MinMaxPyramid()
+                          for channel in series.channels()}
+        pyramids[series] = store_pyramids
+    return store_pyramids
+def take_plot_views(records, locks, extend_impeller=False):
+    """Returns the generation, calibration and views of all recorded series,
+    and the offset and number of rolled-up samples of each series.
+    Views come from the latest snapshot of records, so the records lock is
+    only taken to extend the impeller series.
+
+    Arguments:
+        extend_impeller: whether to extend the impeller series to the current
+            time with its latest duty cycle
+    """
+    if extend_impeller:
+        with locks["records"]:
+            series = records["series"]
+            impeller_last = series.last("impeller")
+            if impeller_last:
+                series.append("impeller",
+                              fermenter.hours_offset(records["start"],
+                                                     fermenter.clock.now()),
+                              impeller_last[1])
+                fermenter.publish_records(records)
+    snapshot = fermenter.records_snapshot(records)
+    offsets = {channel: (offset, len(snapshot.history[channel][2]))
+               for (channel, offset) in snapshot.offsets.items()}
+    return (snapshot.generation, snapshot.calibration, snapshot.series,
+            offsets)
+def decimated_points(pyramid, generation, times, values, t0=None, t1=None,
+                     npoints=PLOT_POINTS, method="minmax", offset=0):
+    """Returns at most about npoints samples of a series window as rows."""
+    (times, values) = decimation.decimate(pyramid, times, values, t0, t1,
+                                          npoints, method, generation, offset)
+    return np.column_stack((times, values)).tolist()
+def pack_array(array):
+    """Returns an array packed as base64 text of its PACKED_TYPE buffer."""
+    packed = np.ascontiguousarray(array, dtype=PACKED_TYPE)
+    return base64.b64encode(packed.tobytes()).decode("ascii")
+def pack_points(times, values):
+    """Returns samples packed as the time of the first sample (origin) and
+    packed arrays of sample times relative to the origin and sample values.
+    Relative times keep their precision when packed as float32.
+    """
+    origin = float(times[0]) if len(times) else 0.0
+    return {
+        "origin": origin,
+        "times": pack_array(np.asarray(times) - origin),
+        "values": pack_array(values),
+    }
+def plot_update(plot, generation, calibration, views, offsets, cursors,
+                store_pyramids, packed=False):
+    """Returns a plot update message with the samples after the cursors.
+    Samples are indexed by their index plus the offset of their series, so
+    cursors stay valid across compactions. Each series in the message covers
+    the samples from the index given by its cursor to the end of the series.
+    A series starting at zero is a snapshot, which is decimated to at most
+    about PLOT_POINTS points; other series are sent at full resolution. A
+    cursor into samples which were rolled up since gets a snapshot.
+
+    Arguments:
+        offsets: the offset and number of rolled-up samples of each series,
+            as from take_plot_views
+        cursors: a dict of the index after the last sample the recipient
+            already has, keyed by channel name
+        store_pyramids: the decimation pyramids of the series, from
+            series_pyramids
+        packed: whether to send the samples of each series packed, as from
+            pack_points, instead of as a list of points
+    """
+    message = {"generation": generation, "series": {}}
+    for channel in PLOT_CHANNELS[plot]:
+        (times, values) = views[channel]
+        (offset, rolled) = offsets[channel]
+        end = offset + len(times)
+        begin = cursors.get(channel, 0)
+        if not offset + rolled <= begin <= end:
+            begin = 0
+        update = {"from": begin, "to": end}
+        if begin:
+            (times, values) = (times[begin - offset:], values[begin - offset:])
+        else:
+            (times, values) = decimation.decimate(
+                store_pyramids[channel], times, values, None, None,
+                PLOT_POINTS, "minmax", generation, offset)
+        if packed:
+            update["packed"] = pack_points(times, values)
+        else:
+            update["points"] = np.column_stack((times, values)).tolist()
+        message["series"][channel] = update
+    if plot == "optics":
+        message["calibration"] = calibration
+    return message
+def resync_updates(records, locks, message, packed=False):
+    """Returns the plot update messages answering a client's resync request.
+    The client reports the generation and lengths of its local series; if the
+    generation is stale, the client receives full snapshots instead.
+    """
+    (generation, calibration, views, offsets) = take_plot_views(records,
+                                                                locks)
+    cursors = {}
+    if message.get("generation") == generation:
+        cursors = message.get("cursors") or {}
+    store_pyramids = series_pyramids(records["series"])
+    return [(plot + " plot update",
+             plot_update(plot, generation, calibration, views, offsets,
+                         cursors, store_pyramids, packed))
+            for plot in PLOT_CHANNELS.keys()]
+def plot_window(records, locks, message):
+    """Returns a decimated time window of a plot, or None for unknown plots
+    and malformed requests.
+    The message specifies the plot and optionally the window bounds t0 and t1
+    (in hours after start), the maximum number of points per series, and the
+    decimation method ("minmax" or "lttb").
+    """
+    plot = message.get("plot")
+    if plot not in PLOT_CHANNELS:
+        return None
+    try:
+        t0 = queries.optional_float(message.get("t0"), "t0")
+        t1 = queries.optional_float(message.get("t1"), "t1")
+        npoints = queries.optional_int(message.get("points"), "points",
+                                       PLOT_POINTS)
+    except ValueError:
+        return None
+    if npoints <= 0:
+        return None
+    npoints = min(npoints, PLOT_POINTS)
+    (generation, calibration, views, offsets) = take_plot_views(records,
+                                                                locks)
+    window = {
+        "plot": plot,
+        "generation": generation,
+        "t0": t0,
+        "t1": t1,
+        "series": {},
+    }
+    store_pyramids = series_pyramids(records["series"])
+    for channel in PLOT_CHANNELS[plot]:
+        (times, values) = views[channel]
+        window["series"][channel] = decimated_points(
+            store_pyramids[channel], generation, times, values, window["t0"],
+            window["t1"], npoints, message.get("method", "minmax"),
+            offsets[channel][0])
+    if plot == "optics":
+        window["calibration"] = calibration
+    return window
+class PlotBroadcaster(object):
+    """Tracks the samples already broadcast to all clients for each plot.
+
+    Arguments:
+        extend_impeller: whether to extend the impeller series to the current
+            time before each broadcast, which only the process running the
+            fermenter should do
+        packed: whether to send samples packed, as from pack_points
+    """
+    def __init__(self, extend_impeller=True, packed=False):
+        self.extend_impeller = extend_impeller
+        self.packed = packed
+        self.generation = None
+        self.calibration = None
+        self.cursors = {}
+    def updates(self, records, locks):
+        """Returns the plot update messages for samples appended since the
+        previous call, as a list of (event, message) pairs.
+        """
+        (generation, calibration, views, offsets) = take_plot_views(
+            records, locks, self.extend_impeller)
+        if generation != self.generation:
+            self.generation = generation
+            self.cursors = {}
+        store_pyramids = series_pyramids(records["series"])
+        updates = []
+        for (plot, channels) in PLOT_CHANNELS.items():
+            ends = {channel: offsets[channel][0] + len(views[channel][0])
+                    for channel in channels}
+            appended = any(ends[channel] > self.cursors.get(channel, 0)
+                           for channel in channels)
+            recalibrated = (plot == "optics" and
+                            calibration != self.calibration)
+            if appended or recalibrated:
+                updates.append((plot + " plot update",
+                                plot_update(plot, generation, calibration,
+                                            views, offsets, self.cursors,
+                                            store_pyramids, self.packed)))
+                self.cursors.update(ends)
+        self.calibration = calibration
+        return updates
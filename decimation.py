@@ -0,0 +1,241 @@
+#!/usr/bin/env python2
+"""
+Reduces time series to a bounded number of points for plotting.
+"""
+
+import threading
+import numpy as np
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+BASE_BUCKET_SIZE = 4 # number of samples summarized by each finest bucket
+LEVEL_GROWTH = 2 # number of buckets merged into each coarser bucket
+INITIAL_BUCKETS = 256 # number of buckets preallocated for each level
+LTTB_CANDIDATES_PER_POINT = 4 # bucket extrema considered per LTTB output point
+
+###############################################################################
+# STATELESS FUNCTIONS
+###############################################################################
+def window_indices(times, t0, t1):
+    """Returns the index range of the samples within a closed time window.
+    Times must be monotonically increasing; a bound of None is unbounded.
+    """
+    begin = 0 if t0 is None else int(np.searchsorted(times, t0, "left"))
+    end = len(times) if t1 is None else int(np.searchsorted(times, t1, "right"))
+    return (begin, max(begin, end))
+def lttb(times, values, npoints):
+    """Returns the indices of the points selected by the largest triangle three
+    buckets algorithm. The first and last points are always selected.
+
+    Arguments:
+        npoints: the number of points to select
+    """
+    length = len(times)
+    if npoints >= length or npoints < 3:
+        return np.arange(length)
+    selected = np.empty(npoints, dtype=np.int64)
+    selected[0] = 0
+    selected[-1] = length - 1
+    edges = np.linspace(1, length - 1, npoints - 1).astype(np.int64)
+    previous = 0
+    for i in range(npoints - 2):
+        (begin, end) = (edges[i], edges[i + 1])
+        if i + 2 < npoints - 1:
+            (next_begin, next_end) = (edges[i + 1], edges[i + 2])
+        else:
+            (next_begin, next_end) = (length - 1, length)
+        next_time = times[next_begin:next_end].mean()
+        next_value = values[next_begin:next_end].mean()
+        areas = np.abs((times[previous] - next_time) *
+                       (values[begin:end] - values[previous]) -
+                       (times[previous] - times[begin:end]) *
+                       (next_value - values[previous]))
+        previous = begin + int(areas.argmax())
+        selected[i + 1] = previous
+    return selected
+def bucket_extrema(values, begin, end, width):
+    """Returns the indices of the minimum and maximum of each bucket of samples.
+    Buckets are consecutive runs of width samples starting at begin; the last
+    bucket may be partial.
+    """
+    nfull = (end - begin) // width
+    full = values[begin:begin + nfull * width].reshape(nfull, width)
+    offsets = begin + np.arange(nfull, dtype=np.int64) * width
+    mins = full.argmin(axis=1) + offsets
+    maxs = full.argmax(axis=1) + offsets
+    tail = begin + nfull * width
+    if tail < end:
+        mins = np.append(mins, tail + values[tail:end].argmin())
+        maxs = np.append(maxs, tail + values[tail:end].argmax())
+    return (mins, maxs)
+def part_extrema(values, parts, indices=()):
+    """Returns the sorted indices of the bounds of an index range, of the
+    minimum and maximum of each part of the range, and of other indices.
+
+    Arguments:
+        parts: consecutive (begin, end) index ranges covering the range
+    """
+    indices = list(indices)
+    for (part_begin, part_end) in parts:
+        if part_begin < part_end:
+            part = values[part_begin:part_end]
+            indices.append(part_begin + np.array([part.argmin(),
+                                                  part.argmax()]))
+    (begin, end) = (parts[0][0], parts[-1][1])
+    return np.unique(np.concatenate([[begin, end - 1]] + indices))
+def merge_extrema(values, mins, maxs):
+    """Returns the extrema indices of buckets which merge pairs of buckets.
+    A trailing unpaired bucket is merged with itself.
+    """
+    if len(mins) % 2:
+        mins = np.append(mins, mins[-1])
+        maxs = np.append(maxs, maxs[-1])
+    mins = mins.reshape(-1, 2)
+    maxs = maxs.reshape(-1, 2)
+    first_min = values[mins[:, 0]] <= values[mins[:, 1]]
+    first_max = values[maxs[:, 0]] >= values[maxs[:, 1]]
+    return (np.where(first_min, mins[:, 0], mins[:, 1]),
+            np.where(first_max, maxs[:, 0], maxs[:, 1]))
+
+###############################################################################
+# CACHES
+###############################################################################
+class ExtremaLevel(object):
+    """A growable array of the min and max sample indices of each bucket."""
+    def __init__(self, width):
+        self.width = width
+        self.mins = np.empty(INITIAL_BUCKETS, dtype=np.int64)
+        self.maxs = np.empty(INITIAL_BUCKETS, dtype=np.int64)
+        self.size = 0
+    def assign(self, begin, mins, maxs):
+        """Overwrites the buckets starting at the begin index."""
+        end = begin + len(mins)
+        if end > self.mins.size:
+            capacity = max(end, self.mins.size * 2)
+            for name in ("mins", "maxs"):
+                column = np.empty(capacity, dtype=np.int64)
+                column[:self.size] = getattr(self, name)[:self.size]
+                setattr(self, name, column)
+        self.mins[begin:end] = mins
+        self.maxs[begin:end] = maxs
+        self.size = max(self.size, end)
+class MinMaxPyramid(object):
+    """Incrementally maintained min-max summaries of a series at many resolutions.
+    Level k summarizes buckets of BASE_BUCKET_SIZE * LEVEL_GROWTH ** k samples
+    by the indices of their extreme samples. Updating the pyramid after appends
+    only recomputes the last few buckets of each level.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+    def reset(self):
+        """Discards all summaries."""
+        self.generation = None
+        self.offset = 0
+        self.length = 0
+        self.levels = []
+    def update(self, times, values, generation=None, offset=0):
+        """Summarizes samples appended to the series since the last update.
+
+        Arguments:
+            times, values: views of all samples of the series
+            generation: the generation of the series; summaries of a different
+                generation are discarded
+            offset: the offset of the series, which changes when it is
+                compacted; summaries of a different offset are discarded
+        """
+        with self._lock:
+            if (generation != self.generation or offset != self.offset or
+                    len(values) < self.length):
+                self.reset()
+                self.generation = generation
+                self.offset = offset
+            self._update(values)
+    def _update(self, values):
+        """Recomputes the buckets covering samples after the summarized ones."""
+        length = len(values)
+        if length == self.length:
+            return
+        width = BASE_BUCKET_SIZE
+        level_index = 0
+        first = self.length // width
+        (mins, maxs) = bucket_extrema(values, first * width, length, width)
+        while True:
+            if level_index == len(self.levels):
+                self.levels.append(ExtremaLevel(width))
+            level = self.levels[level_index]
+            level.assign(first, mins, maxs)
+            if level.size <= 1:
+                break
+            # Recompute the coarser buckets containing the changed buckets
+            first = first // LEVEL_GROWTH
+            (mins, maxs) = merge_extrema(
+                values, level.mins[first * LEVEL_GROWTH:level.size],
+                level.maxs[first * LEVEL_GROWTH:level.size])
+            width *= LEVEL_GROWTH
+            level_index += 1
+        del self.levels[level_index + 1:]
+        self.length = length
+    def extrema(self, values, begin, end, nbuckets):
+        """Returns the sorted indices of bucket extrema within an index range.
+        Uses the finest level with at most nbuckets buckets over the range.
+        Buckets only partly within the range are summarized from their samples
+        within it instead.
+
+        Arguments:
+            values: a view of all values of the series, as last updated
+        """
+        with self._lock:
+            if not self.levels:
+                return part_extrema(values, [(begin, end)])
+            for level in self.levels:
+                first = begin // level.width
+                last = (end - 1) // level.width
+                if last - first + 1 <= nbuckets:
+                    break
+            # Buckets wholly within the range and the summarized samples, as
+            # the pyramid may have been reset to a shorter series meanwhile
+            summarized = min(end, self.length)
+            head_end = min(end, -(-begin // level.width) * level.width)
+            tail_begin = max(head_end,
+                             summarized // level.width * level.width)
+            first = head_end // level.width
+            last = min(tail_begin // level.width, level.size)
+            mins = level.mins[first:last]
+            maxs = level.maxs[first:last]
+            indices = [np.column_stack((np.minimum(mins, maxs),
+                                        np.maximum(mins, maxs))).ravel()]
+        return part_extrema(values, [(begin, head_end), (tail_begin, end)],
+                            indices)
+
+###############################################################################
+# DECIMATION
+###############################################################################
+def decimate(pyramid, times, values, t0=None, t1=None, npoints=1000,
+             method="minmax", generation=None, offset=0):
+    """Returns at most about npoints (time, value) samples of a series window.
+    Windows with few enough samples are returned at full resolution.
+
+    Arguments:
+        pyramid: the MinMaxPyramid caching summaries of the series
+        times, values: views of all samples of the series
+        t0, t1: the bounds of the time window, or None for unbounded
+        method: "minmax" to keep the extrema of each bucket, or "lttb" to
+            select among bucket extrema by largest triangle three buckets
+        generation, offset: the generation and offset of the series, as for
+            MinMaxPyramid.update
+    """
+    (begin, end) = window_indices(times, t0, t1)
+    if end - begin <= npoints:
+        return (times[begin:end], values[begin:end])
+    pyramid.update(times, values, generation, offset)
+    if method == "lttb":
+        candidates = pyramid.extrema(values, begin, end,
+                                     npoints * LTTB_CANDIDATES_PER_POINT // 2)
+        indices = candidates[lttb(times[candidates], values[candidates],
+                                  npoints)]
+    else:
+        indices = pyramid.extrema(values, begin, end,
+                                  max(1, npoints // 2 - 1))
+    return (times[indices], values[indices])
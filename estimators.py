@@ -0,0 +1,189 @@
+#!/usr/bin/env python2
+"""
+Streaming robust estimators of noisy sensor channels.
+"""
+
+import math
+from bisect import bisect_left, bisect_right, insort
+from collections import deque
+
+###############################################################################
+# ESTIMATORS
+###############################################################################
+class HampelFilter(object):
+    """A windowed median filter which estimates the mean of a channel.
+    Samples are pushed one at a time into a window of the most recent samples.
+    Samples further than the threshold from the median of the window are
+    outliers; the estimate is the mean of the remaining samples. The window is
+    kept both in arrival order and in sorted order, in buffers allocated once,
+    so the median is read in constant time and the mean of inliers is read
+    from a running sum, less the outliers in the tails of the sorted window.
+
+    Arguments:
+        window: the number of most recent samples to estimate from
+        threshold: the maximum difference from the median of an inlier
+    """
+    def __init__(self, window, threshold):
+        self.window = window
+        self.threshold = threshold
+        self._ring = [0] * window # samples in arrival order
+        self._sorted = [] # samples in sorted order
+        self._next = 0 # index in the ring of the next sample
+        self._total = 0
+    def __len__(self):
+        return len(self._sorted)
+    def clear(self):
+        """Discards all samples in the window."""
+        del self._sorted[:]
+        self._next = 0
+        self._total = 0
+    def push(self, value):
+        """Adds a sample, evicting the oldest sample if the window is full."""
+        if len(self._sorted) == self.window:
+            evicted = self._ring[self._next]
+            del self._sorted[bisect_left(self._sorted, evicted)]
+            self._total -= evicted
+        self._ring[self._next] = value
+        self._next = (self._next + 1) % self.window
+        insort(self._sorted, value)
+        self._total += value
+    def extend(self, values):
+        """Adds samples in order, such as those of a batch acquisition."""
+        if hasattr(values, "tolist"):
+            values = values.tolist()
+        for value in values:
+            self.push(value)
+    def values(self):
+        """Returns the samples in the window, from oldest to newest."""
+        count = len(self._sorted)
+        begin = (self._next - count) % self.window
+        return [self._ring[(begin + i) % self.window] for i in range(count)]
+    def median(self):
+        """Returns the median of the window, or None if it is empty."""
+        count = len(self._sorted)
+        if not count:
+            return None
+        middle = count // 2
+        if count % 2:
+            return self._sorted[middle]
+        return (self._sorted[middle - 1] + self._sorted[middle]) / 2.0
+    def is_outlier(self, value):
+        """Returns whether a value is an outlier of the current window."""
+        median = self.median()
+        return median is None or abs(value - median) > self.threshold
+    def _inlier_bounds(self):
+        median = self.median()
+        return (bisect_left(self._sorted, median - self.threshold),
+                bisect_right(self._sorted, median + self.threshold))
+    def inliers(self):
+        """Returns the number of samples in the window which are inliers."""
+        if not self._sorted:
+            return 0
+        (low, high) = self._inlier_bounds()
+        return high - low
+    def mean(self):
+        """Returns the mean of the inliers of the window, or None if none."""
+        if not self._sorted:
+            return None
+        (low, high) = self._inlier_bounds()
+        if high <= low:
+            return None
+        total = self._total
+        for i in range(low):
+            total -= self._sorted[i]
+        for i in range(high, len(self._sorted)):
+            total -= self._sorted[i]
+        return float(total) / (high - low)
+class GrowthEstimator(object):
+    """A sliding-window estimator of the specific growth rate of a culture.
+    The rate is the slope of the least-squares line through the natural log
+    of the optical density (OD) of the samples within a time window. Samples
+    enter and leave the window one at a time, and the fit is kept as running
+    sums, so each sample costs constant time. Growth is in its exponential
+    phase while the rate is above both a minimum rate and a fraction of the
+    peak rate so far; it is in its lag phase before that, and stationary
+    after it.
+
+    Arguments:
+        window: the duration (in hours) of the window
+        min_samples: the number of samples needed to estimate the rate
+        min_od: the lowest OD used, below which its log is mostly noise
+        min_rate: the lowest rate (in 1/hour) of exponential growth
+        stationary_fraction: the fraction of the peak rate below which
+            exponential growth has stopped
+    """
+    PHASES = ("lag", "exponential", "stationary")
+    def __init__(self, window, min_samples, min_od, min_rate,
+                 stationary_fraction):
+        self.window = window
+        self.min_samples = min_samples
+        self.min_od = min_od
+        self.min_rate = min_rate
+        self.stationary_fraction = stationary_fraction
+        self.clear()
+    def __len__(self):
+        return len(self._samples)
+    def clear(self):
+        """Discards all samples, the peak rate and the phase."""
+        self._samples = deque()
+        self._origin = None # time from which sample times are offset
+        self._sums = [0.0] * 4 # of times, logs, squared times, time-logs
+        self.rate = None
+        self.peak_rate = None
+        self.phase = None
+    def _add(self, time, log, sign):
+        sums = self._sums
+        sums[0] += sign * time
+        sums[1] += sign * log
+        sums[2] += sign * time * time
+        sums[3] += sign * time * log
+    def push(self, time, od):
+        """Adds a sample of the OD at a time (in hours), evicting samples which
+        fall out of the window, and updates the rate and the phase. Samples
+        below the lowest OD are ignored.
+        """
+        if od < self.min_od:
+            return
+        if self._origin is None:
+            self._origin = time
+        time -= self._origin
+        log = math.log(od)
+        self._samples.append((time, log))
+        self._add(time, log, 1)
+        while self._samples[0][0] < time - self.window:
+            (evicted_time, evicted_log) = self._samples.popleft()
+            self._add(evicted_time, evicted_log, -1)
+        self._update(time - self._samples[0][0])
+    def _update(self, span):
+        count = len(self._samples)
+        (times, logs, squares, products) = self._sums
+        denominator = count * squares - times * times
+        # A fit over a fraction of the window is too noisy to trust, and the
+        # last rate is stale once its samples leave the window
+        if (count < self.min_samples or span < self.window / 2.0 or
+                denominator <= 0):
+            self.rate = None
+            return
+        self.rate = (count * products - times * logs) / denominator
+        if self.peak_rate is None or self.rate > self.peak_rate:
+            self.peak_rate = self.rate
+        if self.rate >= max(self.min_rate,
+                            self.stationary_fraction * self.peak_rate):
+            self.phase = "exponential"
+        elif self.phase in (None, "lag"):
+            self.phase = "lag"
+        else:
+            self.phase = "stationary"
+    @property
+    def doubling_time(self):
+        """The doubling time (in hours) at the current rate, or None unless
+        the culture is growing.
+        """
+        return doubling_time(self.rate)
+def doubling_time(rate):
+    """Returns the doubling time (in hours) at a specific growth rate (in
+    1/hour), or None unless the rate is positive.
+    """
+    if rate is None or rate <= 0:
+        return None
+    return math.log(2) / rate
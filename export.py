@@ -0,0 +1,270 @@
+#!/usr/bin/env python2
+"""
+Exports the recorded history of a fermenter run to columnar files.
+Exports read a snapshot of records, so they never hold the records lock while
+writing, and run in background threads. Samples rolled up by compaction are
+read back at full resolution from the run log when there is one; otherwise
+they are exported with their minimums, maximums and counts.
+"""
+
+import os
+import io
+import itertools
+import threading
+from threading import Thread
+import numpy as np
+import fermenter
+import runlog
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+EXPORT_DIRECTORY = "exports" # directory to which export files are written
+CSV_CHUNK_SIZE = 10000 # number of samples formatted per streamed CSV chunk
+CSV_FORMAT = "%.9g" # format of times and values in CSV files
+START_TOLERANCE = 1e-3 # (sec): error in start times of a run read from a log
+HISTORY_COLUMNS = ("min", "max", "count", "tier") # of rolled-up exports
+FORMATS = { # file extension of each export format
+    "npz": ".npz",
+    "parquet": ".parquet",
+    "csv": ".csv",
+}
+
+###############################################################################
+# STATELESS FUNCTIONS
+###############################################################################
+def optional_timestamp(moment):
+    """Returns the POSIX timestamp of a datetime, or NaN for None."""
+    if moment is None:
+        return float("nan")
+    return runlog.datetime_to_timestamp(moment)
+def optional_value(value):
+    """Returns a float value, or NaN for None."""
+    return float("nan") if value is None else float(value)
+def snapshot_metadata(snapshot):
+    """Returns the start and stop times and calibration of a snapshot.
+    Times are POSIX timestamps, and absent values are NaN.
+    """
+    return [
+        ("start", optional_timestamp(snapshot.start)),
+        ("stop", optional_timestamp(snapshot.stop)),
+        ("calibration red", optional_value(snapshot.calibration["red"])),
+        ("calibration green", optional_value(snapshot.calibration["green"])),
+    ]
+def rolled_up(snapshot):
+    """Returns whether any series of a snapshot holds rolled-up samples."""
+    return any(len(counts) for (_, _, counts) in snapshot.history.values())
+def history_columns(snapshot, channel):
+    """Returns the minimums, maximums, counts and tiers of all samples of a
+    channel of a snapshot, in the order of HISTORY_COLUMNS. Samples at full
+    resolution are their own minimum and maximum, with a count of 1 and a
+    tier of 0; rolled-up samples have a tier of 1.
+    """
+    values = snapshot.series[channel][1]
+    (mins, maxs, counts) = snapshot.history[channel]
+    raw = values[len(counts):]
+    return (np.concatenate((mins, raw)), np.concatenate((maxs, raw)),
+            np.concatenate((counts, np.ones(len(raw)))),
+            np.concatenate((np.ones(len(counts)), np.zeros(len(raw)))))
+def full_resolution_snapshot(snapshot, log_path):
+    """Returns a snapshot in which rolled-up samples are replaced by the
+    samples they were rolled up from, as read from a run log. Returns the
+    snapshot itself if it holds no rolled-up samples, or if the log does not
+    hold its run.
+
+    Arguments:
+        log_path: the path of the run log of the snapshot's records, or None
+    """
+    if not rolled_up(snapshot) or not log_path or not os.path.exists(log_path):
+        return snapshot
+    run = runlog.last_run(runlog.read_records(log_path))
+    if not run.size or abs(run["value"][0] - runlog.datetime_to_timestamp(
+            snapshot.start)) > START_TOLERANCE:
+        return snapshot
+    codes = run["code"]
+    series = dict(snapshot.series)
+    history = dict(snapshot.history)
+    for (channel, (times, values)) in snapshot.series.items():
+        rolled = len(snapshot.history[channel][2])
+        if not rolled:
+            continue
+        # Samples still at full resolution may not have been logged yet
+        samples = run[codes == runlog.CHANNEL_CODES[channel]]
+        if rolled < len(times):
+            samples = samples[samples["time"] < times[rolled]]
+        series[channel] = (np.concatenate((samples["time"], times[rolled:])),
+                           np.concatenate((samples["value"],
+                                           values[rolled:])))
+        history[channel] = tuple(column[:0] for column in history[channel])
+    return snapshot._replace(series=series, history=history)
+def export_filename(name, snapshot, export_format):
+    """Returns the name of the export file of a run."""
+    return "%s-%s%s" % (name, snapshot.start.strftime("%Y%m%d-%H%M%S"),
+                        FORMATS[export_format])
+
+###############################################################################
+# WRITERS
+###############################################################################
+def write_npz(snapshot, path):
+    """Writes the series and metadata of a snapshot to a compressed NPZ file.
+    Each channel is stored as <channel>_times and <channel>_values arrays,
+    followed by <channel>_min, <channel>_max, <channel>_count and
+    <channel>_tier arrays if it holds rolled-up samples (see
+    history_columns); metadata are stored as scalar arrays named as in
+    snapshot_metadata, with spaces replaced by underscores.
+    """
+    arrays = {}
+    for (channel, (times, values)) in snapshot.series.items():
+        arrays[channel + "_times"] = times
+        arrays[channel + "_values"] = values
+        if len(snapshot.history[channel][2]):
+            for (name, column) in zip(HISTORY_COLUMNS,
+                                      history_columns(snapshot, channel)):
+                arrays[channel + "_" + name] = column
+    for (name, value) in snapshot_metadata(snapshot):
+        arrays[name.replace(" ", "_")] = np.float64(value)
+    with open(path, "wb") as export_file:
+        np.savez_compressed(export_file, **arrays)
+def write_parquet(snapshot, path):
+    """Writes the series of a snapshot to a Parquet file as a long table.
+    The table has channel, time and value columns, followed by the columns
+    of HISTORY_COLUMNS if any series holds rolled-up samples (see
+    history_columns); metadata are stored as key-value metadata of the
+    schema. Requires pyarrow.
+    """
+    import pyarrow
+    import pyarrow.parquet
+    names = ["time", "value"]
+    if rolled_up(snapshot):
+        names += HISTORY_COLUMNS
+    channels = []
+    columns = {name: [] for name in names}
+    for (channel, (times, values)) in snapshot.series.items():
+        channels.append(pyarrow.DictionaryArray.from_arrays(
+            np.zeros(len(times), dtype=np.int32), [channel]))
+        chunks = (times, values)
+        if len(names) > 2:
+            chunks += history_columns(snapshot, channel)
+        for (name, chunk) in zip(names, chunks):
+            columns[name].append(chunk)
+    table = pyarrow.Table.from_arrays(
+        [pyarrow.chunked_array(channels, pyarrow.dictionary(
+            pyarrow.int32(), pyarrow.string()))] +
+        [pyarrow.chunked_array(columns[name], pyarrow.float64())
+         for name in names],
+        names=["channel"] + names)
+    metadata = {name: repr(value)
+                for (name, value) in snapshot_metadata(snapshot)}
+    table = table.replace_schema_metadata(metadata)
+    pyarrow.parquet.write_table(table, path, compression="zstd")
+def csv_chunks(snapshot):
+    """Yields the series of a snapshot as chunks of CSV text.
+    Metadata are written first as comment lines starting with "#", followed
+    by a header and a channel, time, value row for each sample, which also
+    holds the columns of HISTORY_COLUMNS if any series holds rolled-up
+    samples (see history_columns).
+    """
+    lines = ["# %s: %s" % (name, repr(value))
+             for (name, value) in snapshot_metadata(snapshot)]
+    header = ["channel", "time", "value"]
+    history = rolled_up(snapshot)
+    if history:
+        header += HISTORY_COLUMNS
+    yield "\n".join(lines + [",".join(header)]) + "\n"
+    for (channel, (times, values)) in snapshot.series.items():
+        columns = (times, values)
+        if history:
+            columns += history_columns(snapshot, channel)
+        for begin in range(0, len(times), CSV_CHUNK_SIZE):
+            end = begin + CSV_CHUNK_SIZE
+            chunk = io.BytesIO()
+            np.savetxt(chunk, np.column_stack([column[begin:end]
+                                               for column in columns]),
+                       fmt=CSV_FORMAT, delimiter=",",
+                       header="", comments="")
+            text = chunk.getvalue().decode("ascii")
+            yield "".join(channel + "," + line + "\n"
+                          for line in text.splitlines())
+def write_csv(snapshot, path):
+    """Writes the series and metadata of a snapshot to a CSV file."""
+    with open(path, "w") as export_file:
+        for chunk in csv_chunks(snapshot):
+            export_file.write(chunk)
+WRITERS = {
+    "npz": write_npz,
+    "parquet": write_parquet,
+    "csv": write_csv,
+}
+
+###############################################################################
+# EXPORTS
+###############################################################################
+class Exporter(object):
+    """Runs exports in background threads and tracks their progress.
+    Each export is a job, which is a dict of its id, name, format, path and
+    state: "running", "done" or "failed", with an error message on failure.
+
+    Arguments:
+        directory: the directory to which export files are written
+    """
+    def __init__(self, directory=EXPORT_DIRECTORY):
+        self.directory = directory
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+    def export(self, records, name, export_format, log_path=None):
+        """Starts exporting the current snapshot of records.
+        Returns a copy of the job of the export.
+
+        Arguments:
+            name: the name of the run, such as the vessel id
+            export_format: the name of an export format in FORMATS
+            log_path: the path of the run log of the records, from which
+                rolled-up samples are exported at full resolution; that of the
+                run log attached to records by default
+        """
+        if export_format not in WRITERS:
+            raise ValueError("Unknown export format %s; choose from %s" %
+                             (export_format, ", ".join(sorted(WRITERS))))
+        snapshot = fermenter.records_snapshot(records)
+        if log_path is None and records["log"]:
+            log_path = records["log"].path
+        path = os.path.join(self.directory,
+                            export_filename(name, snapshot, export_format))
+        with self._lock:
+            job = {
+                "id": next(self._ids),
+                "name": name,
+                "format": export_format,
+                "path": path,
+                "state": "running",
+                "error": None,
+            }
+            self._jobs[job["id"]] = job
+        thread = Thread(target=self._run, name="export %d" % job["id"],
+                        args=(job, snapshot, log_path))
+        thread.daemon = True
+        thread.start()
+        return dict(job)
+    def _run(self, job, snapshot, log_path):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            partial = job["path"] + ".partial"
+            WRITERS[job["format"]](full_resolution_snapshot(snapshot,
+                                                            log_path),
+                                   partial)
+            os.rename(partial, job["path"])
+            state = "done"
+            error = None
+        except Exception as exception:
+            state = "failed"
+            error = "%s: %s" % (type(exception).__name__, exception)
+        with self._lock:
+            job["state"] = state
+            job["error"] = error
+    def job(self, job_id):
+        """Returns a copy of the job of an export, or None if unknown."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
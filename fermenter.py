@@ -3,15 +3,23 @@
 Drives an Arduino to control a fermenter.
 """
 
-import time
-from datetime import datetime
-from array import array
 import numpy as np
-from Arduino import Arduino
+import math
+import time
 import threading
-from threading import Thread
 import signal
 import sys
+import atexit
+import argparse
+from collections import namedtuple, OrderedDict
+from timeseries import TimeSeriesStore
+import runlog
+import clocks
+from scheduler import (Scheduler, AdaptiveInterval, PARK, PRIORITY_CONTROL,
+                       PRIORITY_OPTICS)
+from instrumentation import metrics, InstrumentedLock, InstrumentedDevice
+from estimators import HampelFilter, GrowthEstimator
+from control import PIDController
 
 ###############################################################################
 # PARAMETERS
@@ -33,7 +41,9 @@ ACTUATOR_PINS = {
 LOW_PASS_FILTER_TAU = 0.016 # (s): the RC constant of the low pass filter
 STEADY_STATE_TAUS = 30 # number of taus to wait to reach steady state
 FILTER_STEADY_STATE_TIME = LOW_PASS_FILTER_TAU * STEADY_STATE_TAUS
-LIGHT_MEASUREMENT_INTERVAL = 10 # (sec): time to wait between measurements
+LIGHT_MEASUREMENT_INTERVAL = 10 # (sec): shortest time between measurements
+LIGHT_MAX_MEASUREMENT_INTERVAL = 300 # (sec): longest time between measurements
+LIGHT_STABLE_TOLERANCE = 3 # (pin value): largest stable transmittance change
 
 # Light noise filtering
 LIGHT_SAMPLES_PER_ACQUISITION = 10
@@ -41,6 +51,18 @@ LIGHT_SAMPLE_INTERVAL = 0.1 # (sec): time to wait between each sampling
 LIGHT_OUTLIER_THRESHOLD = 50 # maximum allowed deviation from median
 LIGHT_ACQUISITIONS_PER_MEASUREMENT = 5 # robustness to ambient light variation
 
+# Early-stopping light measurement
+OPTICS_MODE = "early-stopping" # either "early-stopping" or "multiplexed"
+LIGHT_COLORS = ("ambient", "red", "green") # order of acquisitions in a round
+LIGHT_SAMPLE_SCHEDULES = { # (samples per acquisition, sample interval in sec)
+    "ambient": (LIGHT_SAMPLES_PER_ACQUISITION, LIGHT_SAMPLE_INTERVAL),
+    "red": (LIGHT_SAMPLES_PER_ACQUISITION, LIGHT_SAMPLE_INTERVAL),
+    "green": (LIGHT_SAMPLES_PER_ACQUISITION, LIGHT_SAMPLE_INTERVAL),
+}
+LIGHT_MIN_ACQUISITIONS = 2 # rounds of acquisitions before stopping early
+LIGHT_CONFIDENCE_Z = 1.96 # z-score of the confidence interval for stopping
+LIGHT_CONFIDENCE_HALF_WIDTH = 2 # (pin value): interval at which to stop early
+
 # Temperature noise filtering
 TEMP_SAMPLES_PER_ACQUISITION = 10
 TEMP_SAMPLE_INTERVAL = 0.5 # (sec): time to wait between each sampling
@@ -51,20 +73,65 @@ HEAT_LOSS = 9.3 # (Watts): rate of heat loss at 37 deg C
 MAX_HEATING = 14.9 # (Watts): rate at which TEC supply heat
 SETPOINT = 37.5 # (deg C): target temperature to maintain
 HEATER_SETPOINT_DUTY = HEAT_LOSS / MAX_HEATING # stable duty cycle at setpoint
-GAIN = HEATER_SETPOINT_DUTY - 1 # proportional gain
-TEMP_MEASUREMENT_INTERVAL = 10 # (sec): time to wait between measurements
+GAIN = HEATER_SETPOINT_DUTY - 1 # proportional gain of the simple control law
+TEMP_CONTROL_INTERVAL = 1 # (sec): time between heater control updates
+TEMP_PROPORTIONAL_GAIN = 1 # (1/deg C): duty cycle per deg C below setpoint
+TEMP_INTEGRAL_TIME = 1200 # (sec): time for the integral to match the P term
+# The thermal response is first-order, so derivative action only adds noise
+TEMP_DERIVATIVE_TIME = 0 # (sec): time by which the D term anticipates error
+TEMP_DERIVATIVE_FILTER_TIME = 10 # (sec): time constant of the D term filter
+TEMP_MEASUREMENT_INTERVAL = 10 # (sec): shortest time between recordings
+TEMP_MAX_MEASUREMENT_INTERVAL = 120 # (sec): longest time between recordings
+TEMP_STABLE_TOLERANCE = 0.2 # (deg C): largest stable temperature change
+
+# Growth analytics
+GROWTH_WINDOW = 2 # (hours): duration of the window of the growth rate fit
+GROWTH_MIN_SAMPLES = 10 # number of OD samples needed to fit the growth rate
+GROWTH_MIN_OD = 0.01 # lowest OD fitted, below which its log is mostly noise
+GROWTH_MIN_RATE = 0.05 # (1/hour): lowest growth rate of exponential growth
+GROWTH_STATIONARY_FRACTION = 0.2 # fraction of the peak rate ending growth
 
 # Impeller
 IMPELLER_DEFAULT_DUTY = 0.2 # default duty cycle of the impeller
 
-# Idling
-IDLE_CHECK_INTERVAL = 5 # (sec): time to wait between wakeup checks
-
 # Constants
 SERIAL_RATE = "9600" # (baud) rate of USB communication
 PWM_MAX = 255
 ARDUINO_PORT = "/dev/ttyACM0"
 ANALOG_PIN_OFFSET = 15 # the formal pin number corresponding to pin A0
+DEFAULT_BACKEND = "arduino" # the device backend used by default
+
+# Batched acquisition
+BATCH_COMMAND = "arb" # firmware command to read a pin many times, see firmware/
+BATCH_SAMPLE_DTYPE = np.dtype("<u2") # format of each sample in a batch reply
+BATCH_TIMEOUT_MARGIN = 2 # (sec): extra time to wait for a batch reply
+
+# Records
+RECORD_CHANNELS = ("temp", "heater", "impeller", "ambient", "red", "green",
+                   "od", "growth")
+RUN_LOG_PATH = "fermenter.runlog" # binary log of all runs, for crash recovery
+RAW_RETENTION = 6 # (hours): samples kept at full resolution; see retention
+
+###############################################################################
+# GLOBALS
+###############################################################################
+clock = clocks.Clock() # replaced by a faster clock for simulated runs
+# Streaming estimators of the latest acquisition of each channel, filled by
+# construct_estimators once it is defined
+estimators = {}
+# Streaming estimator of the growth of the culture, from the OD
+growth = GrowthEstimator(GROWTH_WINDOW, GROWTH_MIN_SAMPLES, GROWTH_MIN_OD,
+                         GROWTH_MIN_RATE, GROWTH_STATIONARY_FRACTION)
+# Intervals between recorded measurements, adapted to how fast they change
+intervals = {
+    "temp": AdaptiveInterval("temp", TEMP_MEASUREMENT_INTERVAL,
+                             TEMP_MAX_MEASUREMENT_INTERVAL,
+                             (TEMP_STABLE_TOLERANCE,)),
+    "optics": AdaptiveInterval("optics", LIGHT_MEASUREMENT_INTERVAL,
+                               LIGHT_MAX_MEASUREMENT_INTERVAL,
+                               (LIGHT_STABLE_TOLERANCE,
+                                LIGHT_STABLE_TOLERANCE)),
+}
 
 ###############################################################################
 # STATELESS FUNCTIONS
@@ -76,7 +143,10 @@ def pin_val_to_temp(pin_value):
     """Return the deg C temperature represented by the input pin value."""
     return 0.174 * pin_value + 0.764
 def temp_to_heating_control_effort(temp):
-    """Return the duty cycle needed to reach the setpoint temperature."""
+    """Return the duty cycle needed to reach the setpoint temperature.
+    This is the simple proportional law; the heater is driven by the PID
+    controller from construct_temp_controller.
+    """
     raw_duty = HEATER_SETPOINT_DUTY + GAIN * (temp - SETPOINT)
     return max(0, min(1, raw_duty))
 def discard_temp_outliers(samples):
@@ -108,6 +178,13 @@ def discard_light_outliers(samples):
 def get_abs(transmittance, full_transmittance):
     """Normalizes a transmittance against a calibration value."""
     return float(full_transmittance - transmittance) / full_transmittance
+def optical_density(full_transmittance, transmittance):
+    """Returns the optical density of a transmittance against a calibration
+    value, or None if either is not positive.
+    """
+    if not full_transmittance or full_transmittance <= 0 or transmittance <= 0:
+        return None
+    return math.log10(float(full_transmittance) / transmittance)
 def hours_offset(start, end):
     """Returns the difference (in hours) between the two datetimes."""
     return (end - start).total_seconds() / 3600
@@ -115,203 +192,531 @@ def hours_offset(start, end):
 ###############################################################################
 # ARDUINO SUBROUTINES
 ###############################################################################
-def connect():
-    """Initializes a connection to the Arduino"""
-    a = Arduino(SERIAL_RATE, port=ARDUINO_PORT)
+def connect_arduino(port=ARDUINO_PORT):
+    """Returns a connection to a physical Arduino"""
+    from Arduino import Arduino
+    return Arduino(SERIAL_RATE, port=port)
+def connect_simulated(port=None, latency=None, seed=None):
+    """Returns a simulated Arduino driven by the fermenter clock"""
+    import simulator
+    return simulator.SimulatedArduino(clock, latency=latency, seed=seed)
+BACKENDS = {
+    "arduino": connect_arduino,
+    "simulated": connect_simulated,
+}
+def connect(backend=DEFAULT_BACKEND, **options):
+    """Initializes a connection to the Arduino through the specified backend.
+    The connection records the round-trip time of each call in the metrics.
+
+    Arguments:
+        backend: the name of a backend in BACKENDS
+        options: keyword arguments passed to the backend
+    """
+    a = BACKENDS[backend](**options)
     print("Connected.")
-    return a
+    return InstrumentedDevice(a)
+def set_clock(time_scale):
+    """Runs the fermenter clock faster than real time by the given factor."""
+    global clock
+    if time_scale == 1:
+        clock = clocks.Clock()
+    else:
+        clock = clocks.ScaledClock(time_scale)
 def set_pin_modes(a):
     """Initializes pin modes for all pins"""
     for pin in SENSOR_PINS.values():
         a.pinMode(pin + ANALOG_PIN_OFFSET, "INPUT")
     for pin in ACTUATOR_PINS.values():
         a.pinMode(pin, "OUTPUT")
-def turn_off_actuators(a, arduino_lock):
+def turn_off_actuators(a):
     """Turns off all actuators"""
-    with arduino_lock:
-        for pin in ACTUATOR_PINS.values():
-            a.digitalWrite(pin, "LOW")
-def turn_off_leds(a, arduino_lock):
+    for pin in ACTUATOR_PINS.values():
+        a.digitalWrite(pin, "LOW")
+def turn_off_leds(a):
     """Turns off all LEDs"""
-    with arduino_lock:
-        a.digitalWrite(ACTUATOR_PINS["red led"], "LOW")
-        a.digitalWrite(ACTUATOR_PINS["green led"], "LOW")
-def initialize_default_actuators(a, arduino_lock):
+    a.digitalWrite(ACTUATOR_PINS["red led"], "LOW")
+    a.digitalWrite(ACTUATOR_PINS["green led"], "LOW")
+def initialize_default_actuators(a):
     """Turns on open-loop actuators to default states"""
-    with arduino_lock:
-        a.digitalWrite(ACTUATOR_PINS["heater fan"], "HIGH")
-        a.analogWrite(ACTUATOR_PINS["impeller motor"],
-                duty_cycle_to_pin_val(IMPELLER_DEFAULT_DUTY))
-def set_impeller(a, arduino_lock, duty):
+    a.digitalWrite(ACTUATOR_PINS["heater fan"], "HIGH")
+    a.analogWrite(ACTUATOR_PINS["impeller motor"],
+            duty_cycle_to_pin_val(IMPELLER_DEFAULT_DUTY))
+def set_impeller(a, duty):
     """Sets the impeller motor duty cycle"""
-    with arduino_lock:
-        a.analogWrite(ACTUATOR_PINS["impeller motor"],
-                      duty_cycle_to_pin_val(duty))
+    a.analogWrite(ACTUATOR_PINS["impeller motor"],
+                  duty_cycle_to_pin_val(duty))
+def switch_leds(a, color, leds):
+    """Turns on only the LED of the specified color, or none for "ambient".
+    Skips writes to LEDs already known to be in the desired state. Returns
+    whether any LED was written.
+
+    Arguments:
+        leds: a dict of the known states of LED pins, which is updated
+    """
+    switched = False
+    for led_color in ("red", "green"):
+        pin = ACTUATOR_PINS[led_color + " led"]
+        state = "HIGH" if led_color == color else "LOW"
+        if leds.get(pin) != state:
+            a.digitalWrite(pin, state)
+            leds[pin] = state
+            switched = True
+    return switched
+def set_heater(a, duty):
+    """Sets the heater duty cycle"""
+    a.analogWrite(ACTUATOR_PINS["heater"], duty_cycle_to_pin_val(duty))
+
+def serial_analog_read_batch(a, pin, nsamples, sample_interval):
+    """Reads a pin many times on an Arduino running the batch firmware command.
+    Returns the raw reply, which holds each sample as a little-endian uint16.
+    """
+    command = "@%s%%%d%%%d%%%d$!" % (BATCH_COMMAND, pin, nsamples,
+                                     int(round(sample_interval * 1000)))
+    nbytes = nsamples * BATCH_SAMPLE_DTYPE.itemsize
+    timeout = a.sr.timeout
+    a.sr.timeout = nsamples * sample_interval + BATCH_TIMEOUT_MARGIN
+    started = time.time()
+    try:
+        a.sr.write(command.encode("ascii"))
+        a.sr.flush()
+        reply = a.sr.read(nbytes)
+    finally:
+        a.sr.timeout = timeout
+    metrics.record("arduino " + BATCH_COMMAND, time.time() - started)
+    if len(reply) != nbytes:
+        raise IOError("Batch read of pin %d returned %d of %d bytes" %
+                      (pin, len(reply), nbytes))
+    return reply
+def analog_read_batch(a, pin, nsamples, sample_interval):
+    """Reads a pin many times in a single command and reply.
+    Backends may implement analogReadBatch natively; otherwise the command is
+    sent over the serial port of the Arduino.
+    """
+    if hasattr(a, "analogReadBatch"):
+        return a.analogReadBatch(pin, nsamples, sample_interval)
+    return serial_analog_read_batch(a, pin, nsamples, sample_interval)
+def pin_write_command(pin, method, value):
+    """Returns the serial command of a pin write, as the Arduino library
+    would send it for a call of method with pin and value.
+    """
+    if method == "digitalWrite":
+        return "@dw%%%d$!" % (-pin if value == "LOW" else pin)
+    return "@aw%%%d%%%d$!" % (pin, value)
+class CoalescingDevice(object):
+    """A proxy of an Arduino which coalesces pin writes.
+    Writes are held until flush_writes, which the scheduler calls after each
+    step, and any other use of the device sends held writes first, so reads
+    see every write before them. Only the last write held for each pin is
+    sent, and only if it differs from the state known to be on the pin. Held
+    writes are pipelined into a single serial write when the device has a
+    serial port, since pin writes have no reply. Must only be used from the
+    scheduler thread.
+    """
+    def __init__(self, device):
+        self.device = device
+        self._known = {} # the last write sent to each pin
+        self._held = OrderedDict() # the last write held for each pin
+    def __getattr__(self, name):
+        self.flush_writes()
+        return getattr(self.device, name)
+    def _write(self, pin, method, value):
+        self._held.pop(pin, None)
+        if self._known.get(pin) != (method, value):
+            self._held[pin] = (method, value)
+    def digitalWrite(self, pin, value):
+        self._write(pin, "digitalWrite", value)
+    def analogWrite(self, pin, value):
+        self._write(pin, "analogWrite", value)
+    def flush_writes(self):
+        """Sends all held writes."""
+        if not self._held:
+            return
+        (writes, self._held) = (self._held, OrderedDict())
+        for pin in writes:
+            self._known.pop(pin, None)
+        serial_port = getattr(self.device, "sr", None)
+        if serial_port is not None:
+            started = time.time()
+            serial_port.write("".join(
+                pin_write_command(pin, method, value)
+                for (pin, (method, value)) in writes.items()).encode("ascii"))
+            serial_port.flush()
+            metrics.record("arduino writes", time.time() - started)
+        else:
+            for (pin, (method, value)) in writes.items():
+                getattr(self.device, method)(pin, value)
+        self._known.update(writes)
 
 ###############################################################################
 # DATA ACQUISITION & PROCESSING
 ###############################################################################
-def acquire_pin(a, pin, nsamples, sample_interval, arduino_lock):
+# Routines named with _steps are generators of scheduler steps; see scheduler.
+def run_steps(steps):
+    """Runs a generator of steps in the calling thread, sleeping between steps.
+    The calling thread must have exclusive use of the Arduino.
+    """
+    for delay in steps:
+        if delay:
+            clock.sleep(delay)
+def acquire_pin(a, pin, nsamples, sample_interval):
     """Acquires a pin value as sampled over a time interval.
-    Returns as a Numpy array.
+    Samples are taken by the Arduino in a single batch and returned as a
+    read-only Numpy array of the raw reply.
 
     Arguments:
         pin: the pin from which to read
         nsamples: the number of samples to acquire
         sample_interval: the time to wait between samples
     """
-    samples = array('i')
-    for i in range(nsamples):
-        if i != 0:
-            time.sleep(sample_interval)
-        with arduino_lock:
-            samples.append(a.analogRead(pin))
-    return np.array(samples)
-def acquire_temp(a, arduino_lock):
+    reply = analog_read_batch(a, pin, nsamples, sample_interval)
+    return np.frombuffer(reply, dtype=BATCH_SAMPLE_DTYPE)
+def construct_estimators():
+    """Returns new streaming estimators of the acquisitions of each channel."""
+    channel_estimators = {
+        color: HampelFilter(max(LIGHT_SAMPLES_PER_ACQUISITION,
+                                LIGHT_SAMPLE_SCHEDULES[color][0]),
+                            LIGHT_OUTLIER_THRESHOLD)
+        for color in LIGHT_COLORS}
+    channel_estimators["temp"] = HampelFilter(TEMP_SAMPLES_PER_ACQUISITION,
+                                              TEMP_OUTLIER_THRESHOLD)
+    return channel_estimators
+estimators.update(construct_estimators())
+def estimate_acquisition(channel, samples, estimator=None):
+    """Replaces the samples in the estimator of a channel with an acquisition.
+    Returns the mean of the samples which are not outliers, or None if all
+    samples are outliers.
+
+    Arguments:
+        estimator: the estimator to use, if not the shared estimator of the
+            channel, such as to leave the state of a running fermenter alone
+    """
+    if estimator is None:
+        estimator = estimators[channel]
+    estimator.clear()
+    estimator.extend(samples)
+    return estimator.mean()
+def acquire_temp(a, estimator=None):
     """Returns the temperature as sampled over a short time interval.
     Discards outliers and returns the mean of the remaining samples.
     Temperature is returned as a pin value.
+
+    Arguments:
+        estimator: the estimator to use, as for estimate_acquisition
     """
     samples = acquire_pin(a, SENSOR_PINS["thermometer"],
-                          TEMP_SAMPLES_PER_ACQUISITION, TEMP_SAMPLE_INTERVAL,
-                          arduino_lock)
-    discarded = discard_temp_outliers(samples)
-    if discarded.size:
-        return np.mean(discarded)
-    else:
-        return None
-def acquire_light(a, color, arduino_lock):
-    """Returns the light intensity as sampled over a short time interval.
-    Light intensity is returned as an absolute pin value.
+                          TEMP_SAMPLES_PER_ACQUISITION, TEMP_SAMPLE_INTERVAL)
+    return estimate_acquisition("temp", samples, estimator)
+def acquire_light_steps(a, color, acquired):
+    """Acquires the light intensity as sampled over a short time interval.
+    Light intensity is appended to acquired as an absolute pin value.
     Turns off the green LED and turns on the LED and waits for filter response
-    before sampling.
-    Discards outliers and returns the mean of the remaining samples.
+    before sampling; other tasks may use the Arduino during the wait.
+    Discards outliers and appends the mean of the remaining samples, if any.
 
     Arguments:
         color: should be either "red", "green", or "ambient"
     """
-    turn_off_leds(a, arduino_lock)
-    with arduino_lock:
-        if color == "red":
-            a.digitalWrite(ACTUATOR_PINS["red led"], "HIGH")
-        elif color == "green":
-            a.digitalWrite(ACTUATOR_PINS["green led"], "HIGH")
-    time.sleep(FILTER_STEADY_STATE_TIME)
+    turn_off_leds(a)
+    if color == "red":
+        a.digitalWrite(ACTUATOR_PINS["red led"], "HIGH")
+    elif color == "green":
+        a.digitalWrite(ACTUATOR_PINS["green led"], "HIGH")
+    yield FILTER_STEADY_STATE_TIME
     samples = acquire_pin(a, SENSOR_PINS["phototransistor"],
-            LIGHT_SAMPLES_PER_ACQUISITION, LIGHT_SAMPLE_INTERVAL, arduino_lock)
-    turn_off_leds(a, arduino_lock)
-    discarded = discard_light_outliers(samples)
-    if discarded.size:
-        return np.mean(discarded)
+            LIGHT_SAMPLES_PER_ACQUISITION, LIGHT_SAMPLE_INTERVAL)
+    turn_off_leds(a)
+    mean = estimate_acquisition(color, samples)
+    if mean is not None:
+        acquired.append(mean)
+def sample_temp(a):
+    """Returns the latest filtered temperature estimate, in deg C.
+    Pushes one new sample into the streaming temperature estimator, whose
+    window holds the most recent samples. Returns None if all samples in the
+    window are outliers.
+    """
+    samples = acquire_pin(a, SENSOR_PINS["thermometer"], 1, 0)
+    estimator = estimators["temp"]
+    estimator.extend(samples)
+    estimate = estimator.mean()
+    if estimate is not None:
+        return pin_val_to_temp(estimate)
     else:
         return None
-def measure_temp(a, arduino_lock):
+def measure_temp(a, estimator=None):
     """Returns the temperature as measured over a short time.
     Temperature is returned in deg C.
+
+    Arguments:
+        estimator: the estimator to use, as for estimate_acquisition
     """
-    acquired = acquire_temp(a, arduino_lock)
-    if acquired:
-        return pin_val_to_temp(acquire_temp(a, arduino_lock))
+    acquired = acquire_temp(a, estimator)
+    if acquired is not None:
+        return pin_val_to_temp(acquired)
     else:
         return None
-def measure_transmittances(a, arduino_lock):
-    """Returns normalized light intensities as acquired over an extended time.
-    Light intensity is normalized to the ambient light.
-    Acquisition of different colors is time multiplexed.
-    Returns as a tuple of ambient light, red transmittance, and green
-    transmittance.
+def construct_acquisitions():
+    """Returns an empty dictionary of light acquisitions for each color.
+    Acquisitions of each color are pushed into an estimator of their mean.
     """
     acquisitions = {
-        "red": array('i'),
-        "ambient": array('i'),
-        "green": array('i'),
+        "red": HampelFilter(LIGHT_ACQUISITIONS_PER_MEASUREMENT,
+                            LIGHT_OUTLIER_THRESHOLD),
+        "ambient": HampelFilter(LIGHT_ACQUISITIONS_PER_MEASUREMENT,
+                                LIGHT_OUTLIER_THRESHOLD),
+        "green": HampelFilter(LIGHT_ACQUISITIONS_PER_MEASUREMENT,
+                              LIGHT_OUTLIER_THRESHOLD),
     }
+    return acquisitions
+def acquire_transmittances_steps(a, acquisitions):
+    """Acquires light intensities of all colors into acquisitions.
+    Acquisition of different colors is time multiplexed, and every acquisition
+    ends at a step boundary.
+    """
     for _ in range(LIGHT_ACQUISITIONS_PER_MEASUREMENT):
         for color in acquisitions.keys():
-            light = acquire_light(a, color, arduino_lock)
-            if not np.isnan(light):
-                acquisitions[color].append(int(light))
-    ambient_discarded = discard_light_outliers(np.array(acquisitions["ambient"]))
-    red_discarded = discard_light_outliers(np.array(acquisitions["red"]))
-    green_discarded = discard_light_outliers(np.array(acquisitions["green"]))
-    if ambient_discarded.size and red_discarded.size and green_discarded.size:
-        ambient = np.mean(ambient_discarded)
-        red = np.mean(red_discarded)
-        green = np.mean(green_discarded)
+            acquired = []
+            for delay in acquire_light_steps(a, color, acquired):
+                yield delay
+            if acquired:
+                acquisitions[color].push(int(acquired[0]))
+            yield 0
+def acquire_transmittances_early_stopping_steps(
+        a, acquisitions, schedules=None):
+    """Acquires light intensities of all colors into acquisitions, quickly.
+    Stops early once the transmittances are known precisely enough. Switches
+    the LEDs directly from one color to the next right after sampling, without
+    redundant writes, and yields to other tasks while the filter settles.
+    Rounds alternate the order of colors, so each round starts with the color
+    the previous one ended with, and the filter only settles after the LEDs
+    actually switch. Every acquisition ends at a step boundary.
+
+    Arguments:
+        schedules: a dict of the number of samples and the sample interval of
+            each acquisition of each color; LIGHT_SAMPLE_SCHEDULES by default
+    """
+    if schedules is None:
+        schedules = LIGHT_SAMPLE_SCHEDULES
+    leds = {}
+    rounds = [] # the acquisitions of each round, keyed by color
+    for acquisition in range(LIGHT_ACQUISITIONS_PER_MEASUREMENT):
+        colors = LIGHT_COLORS if acquisition % 2 == 0 else LIGHT_COLORS[::-1]
+        rounds.append({})
+        for color in colors:
+            if switch_leds(a, color, leds):
+                yield FILTER_STEADY_STATE_TIME
+            (nsamples, sample_interval) = schedules[color]
+            samples = acquire_pin(a, SENSOR_PINS["phototransistor"],
+                                  nsamples, sample_interval)
+            mean = estimate_acquisition(color, samples)
+            if mean is not None:
+                acquisitions[color].push(int(mean))
+                rounds[-1][color] = int(mean)
+            yield 0
+        if (acquisition + 1 >= LIGHT_MIN_ACQUISITIONS and
+                transmittances_converged(rounds)):
+            break
+    switch_leds(a, "ambient", leds)
+def transmittance_half_width(rounds, color):
+    """Returns the confidence interval half-width of a transmittance.
+    Uses the differences between the ambient and light acquisitions of each
+    round, so that ambient light drift common to both cancels out; rounds
+    missing either acquisition are skipped. Returns None if there are too few
+    rounds to estimate a standard error.
+
+    Arguments:
+        rounds: a list of the acquisitions of each round, keyed by color
+        color: the color of the transmittance
+    """
+    differences = np.array([acquired["ambient"] - acquired[color]
+                            for acquired in rounds
+                            if "ambient" in acquired and color in acquired],
+                           dtype=float)
+    if differences.size:
+        differences = discard_light_outliers(differences)
+    if differences.size < 2:
+        return None
+    return (LIGHT_CONFIDENCE_Z * np.std(differences, ddof=1) /
+            np.sqrt(differences.size))
+def transmittances_converged(rounds):
+    """Returns whether the red and green transmittances are precise enough,
+    given a list of the acquisitions of each round, keyed by color.
+    """
+    for color in ("red", "green"):
+        half_width = transmittance_half_width(rounds, color)
+        if half_width is None or half_width > LIGHT_CONFIDENCE_HALF_WIDTH:
+            return False
+    return True
+def transmittance_steps(a, acquisitions, mode=None):
+    """Returns steps which acquire transmittances in the given optics mode."""
+    if (mode or OPTICS_MODE) == "early-stopping":
+        return acquire_transmittances_early_stopping_steps(a, acquisitions)
+    return acquire_transmittances_steps(a, acquisitions)
+def combine_transmittances(acquisitions):
+    """Returns normalized light intensities from light acquisitions.
+    Light intensity is normalized to the ambient light.
+    Returns as a tuple of ambient light, red transmittance, and green
+    transmittance.
+    """
+    ambient = acquisitions["ambient"].mean()
+    red = acquisitions["red"].mean()
+    green = acquisitions["green"].mean()
+    if ambient is not None and red is not None and green is not None:
         return (ambient, ambient - red, ambient - green)
     else:
         return None
+def measure_transmittances(a, mode=None):
+    """Returns normalized light intensities as acquired over an extended time.
+    Light intensity is normalized to the ambient light.
+    Returns as a tuple of ambient light, red transmittance, and green
+    transmittance.
+
+    Arguments:
+        mode: the optics mode, if not OPTICS_MODE
+    """
+    acquisitions = construct_acquisitions()
+    run_steps(transmittance_steps(a, acquisitions, mode))
+    return combine_transmittances(acquisitions)
 
 ###############################################################################
 # DATA LOGGING
 ###############################################################################
-def record_heat_control(a, arduino_lock, start):
-    """Returns a heat control record.
-    Also adjusts the heating control effort and records that.
+def construct_temp_controller():
+    """Returns a PID controller of the heater duty cycle from temperature.
+    The stable duty cycle at the setpoint is fed forward.
     """
-    temp = measure_temp(a, arduino_lock)
-    if temp and np.isnan(temp):
-        return None
-    else:
-        heater_duty_cycle = temp_to_heating_control_effort(temp)
-        end_time = datetime.now()
-        return (hours_offset(start, end_time), temp, heater_duty_cycle)
-def record_transmittances(a, arduino_lock, start):
-    """Returns a transmittances record."""
-    transmittances = measure_transmittances(a, arduino_lock)
+    return PIDController(SETPOINT, TEMP_PROPORTIONAL_GAIN,
+                         TEMP_PROPORTIONAL_GAIN / TEMP_INTEGRAL_TIME,
+                         TEMP_PROPORTIONAL_GAIN * TEMP_DERIVATIVE_TIME,
+                         HEATER_SETPOINT_DUTY, (0, 1),
+                         TEMP_DERIVATIVE_FILTER_TIME)
+def transmittances_record(start, transmittances):
+    """Returns a transmittances record of measured transmittances."""
     if transmittances:
         (ambient, red, green) = transmittances
-        end_time = datetime.now()
+        end_time = clock.now()
     else:
         return None
     if np.isnan(ambient) or np.isnan(red) or np.isnan(green):
         return None
     else:
         return (hours_offset(start, end_time), ambient, red, green)
+class RecordsSnapshot(namedtuple("RecordsSnapshot", (
+        "version", "generation", "start", "stop", "calibration", "phase",
+        "series", "history", "offsets", "last"))):
+    """An immutable snapshot of records, which may be read without locking.
+    Series are read-only views of the columns of each channel, history holds
+    the minimums, maximums and counts of the rolled-up samples at the start of
+    each series, offsets hold the offset of each series (see TimeSeries), and
+    last holds the most recent sample of each channel. Phase
+    is the current phase of growth, or None if unknown. The version counts
+    publications.
+    """
+    __slots__ = ()
 def construct_records():
     """Returns an empty records dictionary."""
     records = {
-        "start": datetime.now(),
+        "start": clock.now(),
         "stop": None,
-        "temp": [None],
-        "heater": [None],
-        "impeller": [None],
+        "series": TimeSeriesStore(RECORD_CHANNELS),
+        "log": None,
         "optics": {
             "calibration": {
                 "red": None,
                 "green": None,
             },
-            "ambient": [None],
-            "red": [None],
-            "green": [None],
         },
+        "growth": {
+            "phase": None,
+        },
+        "snapshot": None,
     }
+    publish_records(records)
     return records
 def reinitialize_records(records):
     """Clears everything in records.
     Sets the start time of to be the current time.
     """
-    records["start"] = datetime.now()
+    records["start"] = clock.now()
     records["stop"] = None
-    records["temp"][:] = [None]
-    records["heater"][:] = [None]
-    records["impeller"][:] = [None]
+    records["series"].clear()
     records["optics"]["calibration"]["red"] = None
     records["optics"]["calibration"]["green"] = None
-    records["optics"]["ambient"][:] = [None]
-    records["optics"]["red"][:] = [None]
+    records["growth"]["phase"] = None
+def publish_records(records):
+    """Publishes a snapshot of records for readers which do not lock them.
+    Must be called with the records lock held after every change to records,
+    so that snapshots are published in order.
+    """
+    series = records["series"]
+    previous = records["snapshot"]
+    records["snapshot"] = RecordsSnapshot(
+        version=previous.version + 1 if previous else 0,
+        generation=series.generation,
+        start=records["start"],
+        stop=records["stop"],
+        calibration=dict(records["optics"]["calibration"]),
+        phase=records["growth"]["phase"],
+        series={channel: series[channel].view()
+                for channel in series.channels()},
+        history={channel: series[channel].history()
+                 for channel in series.channels()},
+        offsets={channel: series[channel].offset
+                 for channel in series.channels()},
+        last={channel: series.last(channel) for channel in series.channels()})
+def records_snapshot(records):
+    """Returns the latest snapshot of records. Does not lock the records."""
+    return records["snapshot"]
+def reset_growth(records):
+    """Restarts growth estimation from the OD recorded so far in records,
+    such as after recovering a run. Must be called with the records lock
+    held.
+    """
+    growth.clear()
+    (times, values) = records["series"]["od"].view()
+    for (time, od) in zip(times.tolist(), values.tolist()):
+        growth.push(time, od)
+    records["growth"]["phase"] = growth.phase
+def record_growth(records, time, red):
+    """Records the OD of a red transmittance and the growth rate estimated
+    from it. Must be called with the records lock held.
+    Only the red OD tracks the cell density: green light is absorbed by the
+    purple protein the strain produces, so its OD also rises with expression.
+    """
+    od = optical_density(records["optics"]["calibration"]["red"], red)
+    if od is None:
+        return
+    records["series"].append("od", time, od)
+    growth.push(time, od)
+    if growth.rate is not None:
+        records["series"].append("growth", time, growth.rate)
+    records["growth"]["phase"] = growth.phase
+def reset_intervals(reason):
+    """Shortens the intervals between measurements to their minimums."""
+    for interval in intervals.values():
+        interval.reset(reason)
+def log_event(records, event, value):
+    """Appends a run event to the run log of records, if there is one."""
+    if records["log"]:
+        records["log"].record_event(event, value)
+def attach_run_log(records, path):
+    """Recovers records from a run log and logs all new samples to it.
+    Returns whether an unfinished run was recovered, in which case it should be
+    resumed rather than restarted.
+    """
+    recovered = runlog.recover_records(path, records)
+    publish_records(records)
+    records["log"] = runlog.RunLog(path)
+    records["series"].add_listener(records["log"].record)
+    atexit.register(records["log"].close)
+    return recovered and records["stop"] is None
 
 ###############################################################################
-# THREADS
+# TASKS
 ###############################################################################
 def construct_locks():
     """Returns an initial locks dictionary."""
     locks = {
-        "arduino": threading.Lock(),
-        "records": threading.Lock(),
-        "impeller motor": threading.Lock(),
-        "heater": threading.Lock(),
-        "leds": threading.Lock(),
+        "records": InstrumentedLock("records"),
     }
     return locks
 def construct_events():
@@ -323,124 +728,279 @@ def construct_events():
     events["fermenter idle"].set()
     events["calibrate"].set()
     return events
-def start_fermenter(a, records, locks, idle_event):
-    """Starts fermenter operation."""
+def start_fermenter(scheduler, records, locks, idle_event, resume=False):
+    """Starts fermenter operation.
+    Must not be called from the scheduler thread.
+
+    Arguments:
+        resume: whether to continue the run in records instead of starting a
+            new run, such as after recovering from a crash
+    """
     print("Starting...")
-    idle_event.clear()
+    scheduler.call(initialize_default_actuators, (scheduler.device,)).result()
     with locks["records"]:
-        reinitialize_records(records)
-        with locks["impeller motor"]:
-            start = records["start"]
-            if records["impeller"][-1] is None:
-                records["impeller"].pop()
-            records["impeller"].append((hours_offset(start, datetime.now()),
-                                        IMPELLER_DEFAULT_DUTY))
-            initialize_default_actuators(a, locks["arduino"])
+        if not resume:
+            reinitialize_records(records)
+            log_event(records, "start", records["start"])
+        start = records["start"]
+        records["series"].append("impeller", hours_offset(start, clock.now()),
+                                 IMPELLER_DEFAULT_DUTY)
+        reset_growth(records)
+        publish_records(records)
+    reset_intervals("fermenter started")
+    idle_event.clear()
+    scheduler.wake()
     print("Started.")
-def stop_fermenter(a, records, locks, idle_event):
-    """Stops fermenter operation."""
+def stop_fermenter(scheduler, records, locks, idle_event):
+    """Stops fermenter operation.
+    Must not be called from the scheduler thread.
+    """
     print("Preparing to stop...")
     idle_event.set()
-    with locks["leds"]:
-        turn_off_leds(a, locks["arduino"])
+    scheduler.call(turn_off_actuators, (scheduler.device,)).result()
     with locks["records"]:
         start = records["start"]
-        records["impeller"].append((hours_offset(start, datetime.now()),
-                                    records["impeller"][-1][1]))
-        records["heater"].append((hours_offset(start, datetime.now()),
-                                  records["heater"][-1][1]))
-        with locks["impeller motor"] and locks["heater"]:
-            turn_off_actuators(a, locks["arduino"])
-            if records["impeller"][-1] is None:
-                records["impeller"].pop()
-            if records["heater"][-1] is None:
-                records["heater"].pop()
-            records["impeller"].append((hours_offset(start, datetime.now()),
-                                        0))
-            records["heater"].append((hours_offset(start, datetime.now()), 0))
-        records["stop"] = datetime.now()
+        series = records["series"]
+        for channel in ("impeller", "heater"):
+            last = series.last(channel)
+            if last:
+                series.append(channel, hours_offset(start, clock.now()),
+                              last[1])
+            series.append(channel, hours_offset(start, clock.now()), 0)
+        records["stop"] = clock.now()
+        log_event(records, "stop", records["stop"])
+        publish_records(records)
     print("Stopped.")
-def monitor_temp(a, records, locks, idle_event):
-    """Continuously monitor and record fluid temperature and heater state.
-    Also adjust heater based on temperature control information.
+def set_impeller_duty(scheduler, records, locks, duty):
+    """Sets and records the impeller motor duty cycle.
+    Must not be called from the scheduler thread.
+    """
+    scheduler.call(set_impeller, (scheduler.device, duty)).result()
+    with locks["records"]:
+        start = records["start"]
+        series = records["series"]
+        last = series.last("impeller")
+        if last:
+            series.append("impeller", hours_offset(start, clock.now()),
+                          last[1])
+        series.append("impeller", hours_offset(start, clock.now()), duty)
+        publish_records(records)
+    reset_intervals("impeller changed")
+def control_temp(a, records, locks, idle_event, interval=None):
+    """Continuously control the heater at a fixed rate, and record fluid
+    temperature and heater state.
+    Each control update pushes a temperature sample into the streaming
+    temperature estimator and sets the heater from the PID controller's
+    response to the latest estimate. Updates are due at fixed times, so a late
+    update does not delay later ones; their lateness is recorded as jitter.
+    Temperature and heater state are recorded at the adaptive interval of
+    intervals["temp"].
+    Returns a generator of steps for the scheduler; parks while idle.
+
+    Arguments:
+        interval: the time (in sec) between control updates;
+            TEMP_CONTROL_INTERVAL by default
     """
+    if interval is None:
+        interval = TEMP_CONTROL_INTERVAL
+    controller = construct_temp_controller()
+    due = None
     while True:
-        if not idle_event.is_set():
-            with locks["records"]:
-                start = records["start"]
-            record = record_heat_control(a, locks["arduino"], start)
-            if record:
-                with locks["arduino"] and locks["heater"]:
-                    a.analogWrite(ACTUATOR_PINS["heater"],
-                                  duty_cycle_to_pin_val(record[2]))
+        if idle_event.is_set():
+            due = None
+            yield PARK
+            continue
+        now = clock.time()
+        if due is None:
+            estimators["temp"].clear()
+            controller.reset()
+            (due, last_updated, last_recorded) = (now, now, None)
+        metrics.record("control temp jitter", now - due)
+        temp = sample_temp(a)
+        (dt, last_updated) = (now - last_updated, now)
+        if temp is not None and not idle_event.is_set():
+            duty = controller.update(temp, dt)
+            set_heater(a, duty)
+            if (last_recorded is None or
+                    now - last_recorded >= intervals["temp"].interval):
+                last_recorded = now
+                intervals["temp"].update((temp,))
                 with locks["records"]:
-                    if records["temp"][-1] is None:
-                        records["temp"].pop()
-                    if records["heater"][-1] is None:
-                        records["heater"].pop()
-                    records["temp"].append((record[0], record[1]))
-                    records["heater"].append((record[0], record[2]))
-                idle_event.wait(TEMP_MEASUREMENT_INTERVAL)
-        else:
-            time.sleep(IDLE_CHECK_INTERVAL)
+                    offset = hours_offset(records["start"], clock.now())
+                    records["series"].append("temp", offset, temp)
+                    records["series"].append("heater", offset, duty)
+                    publish_records(records)
+        # Updates missed by more than an interval are skipped
+        due += interval
+        behind = clock.time() - due
+        if behind > interval:
+            due += interval * int(behind / interval)
+        yield max(0, due - clock.time())
 def monitor_optics(a, records, locks, calibrate_event, idle_event):
-    """Continuously monitor and record fluid optical properties"""
+    """Continuously monitor and record fluid optical properties.
+    Measurements are taken at the adaptive interval of intervals["optics"].
+    Returns a generator of steps for the scheduler; parks while idle, and
+    abandons a measurement when the fermenter stops.
+    """
+    last_started = None
     while True:
-        if not idle_event.is_set():
+        if idle_event.is_set():
+            last_started = None
+            yield PARK
+            continue
+        started = clock.time()
+        if last_started is not None:
+            metrics.record("monitor optics period", started - last_started)
+        last_started = started
+        start = records_snapshot(records).start
+        acquisitions = construct_acquisitions()
+        for delay in transmittance_steps(a, acquisitions):
+            if idle_event.is_set():
+                break
+            yield delay
+        if idle_event.is_set():
+            turn_off_leds(a)
+            continue
+        record = transmittances_record(start,
+                                       combine_transmittances(acquisitions))
+        if record:
             with locks["records"]:
-                start = records["start"]
-            with locks["leds"]:
-                record = record_transmittances(a, locks["arduino"], start)
-            if record:
-                with locks["records"]:
-                    if calibrate_event.is_set():
-                        records["optics"]["calibration"]["red"] = record[2]
-                        records["optics"]["calibration"]["green"] = record[3]
-                        calibrate_event.clear()
-                    if records["optics"]["ambient"][-1] is None:
-                        records["optics"]["ambient"].pop()
-                    if records["optics"]["red"][-1] is None:
-                        records["optics"]["red"].pop()
-                    if records["optics"]["green"][-1] is None:
-                        records["optics"]["green"].pop()
-                    records["optics"]["ambient"].append((record[0], record[1]))
-                    records["optics"]["red"].append((record[0], record[2]))
-                    records["optics"]["green"].append((record[0], record[3]))
-                idle_event.wait(LIGHT_MEASUREMENT_INTERVAL)
+                if calibrate_event.is_set():
+                    records["optics"]["calibration"]["red"] = record[2]
+                    records["optics"]["calibration"]["green"] = record[3]
+                    log_event(records, "calibration red", record[2])
+                    log_event(records, "calibration green", record[3])
+                    calibrate_event.clear()
+                    # ODs against another calibration do not fit one curve
+                    growth.clear()
+                records["series"].append("ambient", record[0], record[1])
+                records["series"].append("red", record[0], record[2])
+                records["series"].append("green", record[0], record[3])
+                record_growth(records, record[0], record[2])
+                publish_records(records)
+            intervals["optics"].update((record[2], record[3]))
+            # Waits in short steps, so that resetting the interval takes effect
+            measured = clock.time()
+            while (not idle_event.is_set() and
+                   clock.time() < measured + intervals["optics"].interval):
+                yield min(LIGHT_MEASUREMENT_INTERVAL,
+                          measured + intervals["optics"].interval -
+                          clock.time())
         else:
-            time.sleep(IDLE_CHECK_INTERVAL)
+            yield 0
 
 ###############################################################################
 # MAIN
 ###############################################################################
 def interrupt_handler(signal_num, _):
+    # Exiting runs the atexit handlers, which flush the run log
     sys.exit(signal_num)
-def run_fermenter():
-    a = connect()
+def spawn_monitors(scheduler, a, records, locks, events):
+    """Schedules the temperature control and optics monitoring tasks."""
+    scheduler.spawn("temp", control_temp(a, records, locks,
+                                         events["fermenter idle"]),
+                    PRIORITY_CONTROL)
+    scheduler.spawn("optics", monitor_optics(a, records, locks,
+                                             events["calibrate"],
+                                             events["fermenter idle"]),
+                    PRIORITY_OPTICS)
+def run_fermenter(log_path=RUN_LOG_PATH, backend=DEFAULT_BACKEND,
+                  time_scale=1, capture_path=None,
+                  raw_retention=RAW_RETENTION, **backend_options):
+    """Connects to the fermenter and starts monitoring it in the scheduler.
+    Returns the scheduler, which owns the Arduino, with the records, locks,
+    events and threads of the fermenter.
+
+    Arguments:
+        log_path: the path of the run log, or None to not log runs
+        backend: the name of the device backend in BACKENDS
+        time_scale: the factor by which to run faster than real time, which
+            is only meaningful for simulated backends
+        capture_path: the path of a file to which all raw sensor samples are
+            appended for replay, or None to not capture them; see replay
+        raw_retention: the time (in hours) for which samples are kept in
+            memory at full resolution before being rolled up, or None to keep
+            all samples; see retention
+        backend_options: keyword arguments passed to the backend
+    """
+    set_clock(time_scale)
+    a = CoalescingDevice(connect(backend, **backend_options))
+    if capture_path:
+        import replay
+        a = replay.CapturingDevice(a, capture_path)
     set_pin_modes(a)
     signal.signal(signal.SIGINT, interrupt_handler)
     records = construct_records()
+    resume = False
+    if log_path:
+        resume = attach_run_log(records, log_path)
     locks = construct_locks()
     events = construct_events()
-    temp_monitor = Thread(target=monitor_temp, name="temp",
-                          args=(a, records, locks, events["fermenter idle"]))
-    optics_monitor = Thread(target=monitor_optics, name="optics",
-                            args=(a, records, locks, events["calibrate"],
-                                  events["fermenter idle"]))
+    if resume and records["optics"]["calibration"]["red"] is not None:
+        events["calibrate"].clear()
+    turn_off_leds(a)
+    turn_off_actuators(a)
+    scheduler = Scheduler(a, clock)
+    spawn_monitors(scheduler, a, records, locks, events)
     threads = {
-        "temp": temp_monitor,
-        "optics": optics_monitor,
+        "scheduler": scheduler.thread,
     }
-    threads["temp"].daemon = True
-    threads["optics"].daemon = True
-    turn_off_leds(a, locks["arduino"])
-    turn_off_actuators(a, locks["arduino"])
-    start_fermenter(a, records, locks, events["fermenter idle"])
-    threads["temp"].start()
-    threads["optics"].start()
-    return (a, records, locks, events, threads)
+    if raw_retention is not None:
+        import retention
+        threads["compaction"] = retention.start_compaction(records, locks,
+                                                           raw_retention)
+    scheduler.start()
+    start_fermenter(scheduler, records, locks, events["fermenter idle"],
+                    resume)
+    return (scheduler, records, locks, events, threads)
+
+def parse_retention(text):
+    """Returns the raw retention (in hours) given as a command-line option,
+    or None for 0 or inf, which keep all samples at full resolution.
+    """
+    hours = float(text)
+    if hours < 0 or math.isnan(hours):
+        raise argparse.ArgumentTypeError("%s is not a number of hours" % text)
+    return None if hours in (0, float("inf")) else hours
+def parse_args(description):
+    """Returns the command-line options for running the fermenter."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--backend", choices=sorted(BACKENDS.keys()),
+                        default=DEFAULT_BACKEND,
+                        help="the device backend to use")
+    parser.add_argument("--port", default=ARDUINO_PORT,
+                        help="the serial port of the Arduino")
+    parser.add_argument("--time-scale", type=float, default=1,
+                        help="factor by which simulated runs are sped up")
+    parser.add_argument("--latency", type=float, default=None,
+                        help="serial round-trip time (sec) of simulated runs")
+    parser.add_argument("--log", default=RUN_LOG_PATH,
+                        help="path of the run log")
+    parser.add_argument("--capture", default=None,
+                        help="path of a file to capture raw sensor samples to")
+    parser.add_argument("--retention", type=parse_retention,
+                        default=RAW_RETENTION,
+                        help="hours for which samples are kept in memory at "
+                        "full resolution before being rolled up; 0 or inf "
+                        "keeps all samples at full resolution")
+    parser.add_argument("--metrics", action="store_true",
+                        help="record hot path metrics from startup")
+    return parser.parse_args()
+def run_fermenter_from_args(args):
+    """Runs the fermenter as specified by command-line options."""
+    metrics.enable(args.metrics)
+    if args.backend == "simulated":
+        backend_options = {"latency": args.latency}
+    else:
+        backend_options = {"port": args.port}
+    return run_fermenter(log_path=args.log, backend=args.backend,
+                         time_scale=args.time_scale,
+                         capture_path=args.capture,
+                         raw_retention=args.retention, **backend_options)
 
 if __name__ == "__main__":
-    (a, records, locks, events, threads) = run_fermenter()
+    args = parse_args(__doc__)
+    (scheduler, records, locks, events, threads) = run_fermenter_from_args(
+        args)
     for thread in threads.values():
         signal.pause()
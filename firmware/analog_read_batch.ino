@@ -0,0 +1,31 @@
+/*
+ * Batched analog acquisition for the Python-Arduino-Command-API prototype
+ * sketch. Place this file in the prototype sketch folder so it is compiled as
+ * another tab of the sketch, then dispatch the command from SerialParser():
+ *
+ *   else if (cmd == "arb") {
+ *     AnalogBatchHandler(data);
+ *   }
+ *
+ * Command: @arb%<pin>%<nsamples>%<interval in ms>$!
+ * Reply: nsamples readings of the pin, each as a little-endian uint16, with
+ * no separators or terminator. Each reading is sent as soon as it is taken,
+ * so the reply needs no buffer on the Arduino.
+ */
+
+void AnalogBatchHandler(String data) {
+  int idx1 = data.indexOf('%');
+  int idx2 = data.indexOf('%', idx1 + 1);
+  int pin = Str2int(data.substring(0, idx1));
+  long nsamples = data.substring(idx1 + 1, idx2).toInt();
+  unsigned long interval = data.substring(idx2 + 1).toInt();
+  unsigned long next = millis();
+  for (long i = 0; i < nsamples; i++) {
+    while ((long) (millis() - next) < 0) {
+    }
+    next += interval;
+    unsigned int value = analogRead(pin);
+    Serial.write((uint8_t) (value & 0xFF));
+    Serial.write((uint8_t) (value >> 8));
+  }
+}
@@ -0,0 +1,203 @@
+#!/usr/bin/env python2
+"""
+Low-overhead instrumentation of the fermenter's hot paths.
+Durations are recorded into log-linear histograms, as in HdrHistogram, so each
+record takes constant time and memory while percentiles keep a bounded
+relative error. Recording can be switched on and off at runtime.
+"""
+
+import time
+import threading
+from collections import OrderedDict
+import numpy as np
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+LOWEST_DURATION = 1e-6 # (sec): resolution of recorded durations
+HIGHEST_DURATION = 3600 # (sec): durations above this are clamped
+SUB_BUCKET_BITS = 7 # durations are recorded within 2**-7 relative error
+PERCENTILES = (50, 90, 99, 99.9)
+
+###############################################################################
+# HISTOGRAMS
+###############################################################################
+class Histogram(object):
+    """A histogram of durations with log-linear buckets.
+    Durations below 2**SUB_BUCKET_BITS units of the lowest duration have
+    buckets of one unit; each power of two above that is split into half as
+    many buckets, so every bucket is narrow relative to its values.
+    """
+    def __init__(self, lowest=LOWEST_DURATION, highest=HIGHEST_DURATION,
+                 sub_bucket_bits=SUB_BUCKET_BITS):
+        self.lowest = float(lowest)
+        self._sub_bucket_count = 2 ** sub_bucket_bits
+        self._sub_bucket_half = self._sub_bucket_count // 2
+        self._sub_bucket_bits = sub_bucket_bits
+        self._max_units = int(highest / self.lowest)
+        self._counts = [0] * (self._index(self._max_units) + 1)
+        self._lock = threading.Lock()
+        self.reset()
+    def _index(self, units):
+        """Returns the index of the bucket of a duration in units."""
+        if units < self._sub_bucket_count:
+            return units
+        shift = units.bit_length() - self._sub_bucket_bits
+        return shift * self._sub_bucket_half + (units >> shift)
+    def _bucket_value(self, index):
+        """Returns the duration at the middle of a bucket."""
+        if index < self._sub_bucket_count:
+            return (index + 0.5) * self.lowest
+        shift = (index - self._sub_bucket_count) // self._sub_bucket_half + 1
+        mantissa = index - shift * self._sub_bucket_half
+        return (mantissa + 0.5) * (1 << shift) * self.lowest
+    def reset(self):
+        """Discards all recorded durations."""
+        with self._lock:
+            self._counts = [0] * len(self._counts)
+            self.count = 0
+            self.total = 0.0
+            self.min = None
+            self.max = None
+    def record(self, duration):
+        """Records a duration (in sec)."""
+        duration = max(0.0, float(duration))
+        units = min(int(duration / self.lowest), self._max_units)
+        index = self._index(units)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.total += duration
+            if self.min is None or duration < self.min:
+                self.min = duration
+            if self.max is None or duration > self.max:
+                self.max = duration
+    def percentiles(self, percentiles=PERCENTILES):
+        """Returns the durations at the specified percentiles."""
+        with self._lock:
+            counts = np.array(self._counts, dtype=np.int64)
+        cumulative = np.cumsum(counts)
+        if not cumulative[-1]:
+            return [None for _ in percentiles]
+        ranks = np.ceil(np.asarray(percentiles) / 100.0 * cumulative[-1])
+        indices = np.searchsorted(cumulative, np.maximum(ranks, 1))
+        return [min(self._bucket_value(index), self.max)
+                for index in indices]
+    def summary(self):
+        """Returns the count, mean, extremes and percentiles of durations."""
+        summary = OrderedDict([
+            ("count", self.count),
+            ("mean", self.total / self.count if self.count else None),
+            ("min", self.min),
+            ("max", self.max),
+        ])
+        for (percentile, value) in zip(PERCENTILES, self.percentiles()):
+            summary["p%g" % percentile] = value
+        return summary
+
+###############################################################################
+# METRICS
+###############################################################################
+class Metrics(object):
+    """Named histograms of durations which may be recorded from any thread.
+    While disabled, recording costs a single attribute check.
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._histograms = {}
+        self._lock = threading.Lock()
+    def enable(self, enabled=True):
+        """Switches recording on, or off if enabled is False."""
+        self.enabled = bool(enabled)
+    def histogram(self, name):
+        """Returns the histogram of the specified name, creating it if needed."""
+        histogram = self._histograms.get(name)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(name, Histogram())
+        return histogram
+    def record(self, name, duration):
+        """Records a duration (in sec) in the histogram of the given name."""
+        if self.enabled:
+            self.histogram(name).record(duration)
+    def reset(self):
+        """Discards all recorded durations."""
+        with self._lock:
+            self._histograms = {}
+    def summaries(self):
+        """Returns a message with summaries of all histograms, by name."""
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        return {
+            "enabled": self.enabled,
+            "histograms": OrderedDict((name, histogram.summary())
+                                      for (name, histogram) in histograms),
+        }
+
+###############################################################################
+# INSTRUMENTED OBJECTS
+###############################################################################
+class InstrumentedLock(object):
+    """A lock which records how long it is waited for and held.
+    Durations are recorded as "lock <name> wait" and "lock <name> hold" in
+    the registry, which defaults to the shared metrics.
+    """
+    def __init__(self, name, lock=None, registry=None):
+        self.name = name
+        self._lock = lock or threading.Lock()
+        self._metrics = registry or metrics
+        self._wait_name = "lock %s wait" % name
+        self._hold_name = "lock %s hold" % name
+        self._acquired = None
+    def acquire(self, blocking=True):
+        if not self._metrics.enabled:
+            acquired = self._lock.acquire(blocking)
+            if acquired:
+                self._acquired = None
+            return acquired
+        requested = time.time()
+        acquired = self._lock.acquire(blocking)
+        if acquired:
+            self._acquired = time.time()
+            self._metrics.record(self._wait_name, self._acquired - requested)
+        return acquired
+    def release(self):
+        acquired = self._acquired
+        self._acquired = None
+        if acquired is not None:
+            self._metrics.record(self._hold_name, time.time() - acquired)
+        self._lock.release()
+    def __enter__(self):
+        self.acquire()
+        return self
+    def __exit__(self, *_):
+        self.release()
+class InstrumentedDevice(object):
+    """A proxy of a device which records the round-trip time of each call.
+    Durations are recorded as "arduino <method>"; other attributes of the
+    device pass through untouched.
+    """
+    def __init__(self, device, registry=None):
+        self.device = device
+        self._metrics = registry or metrics
+    def __getattr__(self, name):
+        attribute = getattr(self.device, name)
+        if not callable(attribute):
+            return attribute
+        metrics = self._metrics
+        metric_name = "arduino %s" % name
+        def timed_call(*args, **kwargs):
+            if not metrics.enabled:
+                return attribute(*args, **kwargs)
+            started = time.time()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                metrics.record(metric_name, time.time() - started)
+        self.__dict__[name] = timed_call
+        return timed_call
+
+###############################################################################
+# GLOBALS
+###############################################################################
+metrics = Metrics() # shared by all instrumented paths of the fermenter
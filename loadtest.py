@@ -0,0 +1,517 @@
+#!/usr/bin/env python2
+"""
+Load-tests the web dashboard under many clients and long run histories.
+Boots app.py against simulated vessels, each resuming a synthetic run log of
+the requested length, and connects many Socket.IO clients to it over XHR
+polling. The first client of each vessel operates it: it sets the impeller,
+recalibrates the optics, and finally stops and restarts the fermenter. The
+other clients watch, resyncing their plots now and then. The latency of each
+command and resync, the gaps between stats updates, the CPU time and memory
+of the server processes, and how long the monitor tasks of each vessel waited
+on the records lock are printed as JSON, as by bench.py. CPU time and memory
+are read from /proc, so are only reported on Linux.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from threading import Thread
+from datetime import timedelta
+from collections import OrderedDict
+try:
+    from urllib.request import urlopen, Request
+    from urllib.parse import urlencode
+except ImportError:
+    from urllib2 import urlopen, Request
+    from urllib import urlencode
+import numpy as np
+import fermenter
+import dashboard
+import runlog
+import supervisor
+import bench
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+HTTP_PORT = 8080 # port at which the dashboard under test is served
+NAMESPACE = "/socket" # Socket.IO namespace of the dashboard
+SOCKETIO_PATH = "/socket.io/1/" # path of the Socket.IO 0.9 handshake
+FRAME_SEPARATOR = u"\ufffd" # delimits packets in an XHR polling payload
+POLL_TIMEOUT = 60 # (sec): longest time to wait for a polling response
+BOOT_TIMEOUT = 600 # (sec): time to wait for the server to serve the history
+COMMAND_INTERVAL = 5 # (sec): time between the commands of each operator
+RESYNC_INTERVAL = 10 # (sec): mean time between plot resyncs of each watcher
+COMMAND_TIMEOUT = 120 # (sec): time to wait for the effect of a command
+RECALIBRATE_EVERY = 5 # number of impeller commands between recalibrations
+SAMPLE_INTERVAL = 1 # (sec): time between samples of server CPU and memory
+IMPELLER_DUTIES = (0.15, 0.2, 0.25, 0.3) # duty cycles set by operators
+LOCK_METRICS = ( # metrics of how long monitor tasks wait on the records lock
+    "lock records wait",
+    "lock records hold",
+    "task temp delay",
+    "task optics delay",
+    "control temp jitter",
+)
+
+###############################################################################
+# STATELESS FUNCTIONS
+###############################################################################
+def http(url, data=None, timeout=POLL_TIMEOUT):
+    """Returns the body of the response to a GET, or a POST of text data."""
+    if data is not None:
+        data = Request(url, data.encode("utf-8"),
+                       {"Content-Type": "text/plain;charset=UTF-8"})
+        response = urlopen(data, timeout=timeout)
+    else:
+        response = urlopen(url, timeout=timeout)
+    try:
+        return response.read().decode("utf-8")
+    finally:
+        response.close()
+def decode_payload(payload):
+    """Returns the packets of an XHR polling payload.
+    Payloads of many packets frame each with its length.
+    """
+    if not payload.startswith(FRAME_SEPARATOR):
+        return [payload] if payload else []
+    packets = []
+    position = 0
+    while position < len(payload):
+        end = payload.index(FRAME_SEPARATOR, position + 1)
+        length = int(payload[position + 1:end])
+        packets.append(payload[end + 1:end + 1 + length])
+        position = end + 1 + length
+    return packets
+def decode_packet(packet):
+    """Returns the type, id, endpoint and data of a Socket.IO 0.9 packet."""
+    parts = packet.split(":", 3)
+    parts += [""] * (4 - len(parts))
+    return tuple(parts)
+def write_run_log(path, hours, seed=0):
+    """Writes a run log of an unfinished synthetic run of some length, which
+    ends now, so that a fermenter recovering it resumes the run.
+    """
+    records = bench.synthetic_records(hours, seed)
+    log = runlog.RunLog(path)
+    log.record_event("start", fermenter.clock.now() - timedelta(hours=hours))
+    for color in ("red", "green"):
+        log.record_event("calibration " + color,
+                         records["optics"]["calibration"][color])
+    snapshot = fermenter.records_snapshot(records)
+    for (channel, (times, values)) in snapshot.series.items():
+        log.record_samples(channel, times, values)
+    log.close()
+def process_usage(pid):
+    """Returns the CPU time (in sec) and resident memory (in bytes) of a
+    process, or None if they cannot be read.
+    """
+    try:
+        with open("/proc/%d/stat" % pid) as stat_file:
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        with open("/proc/%d/status" % pid) as status_file:
+            rss = [line.split()[1] for line in status_file
+                   if line.startswith("VmRSS:")]
+    except (IOError, OSError, IndexError):
+        return None
+    ticks = float(os.sysconf("SC_CLK_TCK"))
+    return ((int(fields[11]) + int(fields[12])) / ticks,
+            int(rss[0]) * 1024 if rss else 0)
+def child_pids(pid):
+    """Returns the ids of the child processes of a process."""
+    children = []
+    for name in (os.listdir("/proc") if os.path.isdir("/proc") else []):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % name) as stat_file:
+                fields = stat_file.read().rsplit(")", 1)[1].split()
+        except (IOError, OSError, IndexError):
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(name))
+    return children
+
+###############################################################################
+# CLIENTS
+###############################################################################
+class DashboardClient(object):
+    """A Socket.IO 0.9 client of the dashboard of a vessel, over XHR polling.
+    The client subscribes to the updates of its vessel, acknowledges
+    broadcast frames as the dashboard does, and records the gaps between
+    stats updates and the latency of plot resyncs.
+
+    Arguments:
+        base_url: the URL of the server, such as "http://localhost:8080"
+        vessel: the id of the vessel whose dashboard is shown
+    """
+    def __init__(self, base_url, vessel):
+        self.base_url = base_url
+        self.vessel = vessel
+        self.stats = None # latest stats update
+        self.stats_gaps = []
+        self.resync_latencies = []
+        self.frames = 0
+        self.errors = 0
+        self.closed = False
+        self._last_stats = None
+        self._resync = None # start time and number of replies pending
+        self._condition = threading.Condition()
+        handshake = http(self._url(SOCKETIO_PATH))
+        self._session = handshake.split(":")[0]
+        self._send("1::" + NAMESPACE)
+        self._thread = Thread(target=self._poll, name="client")
+        self._thread.daemon = True
+        self._thread.start()
+        self.emit("dashboard subscribe", {})
+    def _url(self, path):
+        return "%s%s?t=%d" % (self.base_url, path, time.time() * 1000)
+    def _send(self, packet):
+        http(self._url("%sxhr-polling/%s" % (SOCKETIO_PATH, self._session)),
+             packet)
+    def emit(self, event, message):
+        """Emits an event of the dashboard namespace for the vessel."""
+        message = dict(message, vessel=self.vessel)
+        self._send("5::%s:%s" % (NAMESPACE, json.dumps({"name": event,
+                                                         "args": [message]})))
+    def resync(self):
+        """Requests snapshots of all plots, as a new dashboard does."""
+        with self._condition:
+            self._resync = (time.time(), len(dashboard.PLOT_CHANNELS))
+        self.emit("plots resync", {"generation": None, "cursors": {}})
+    def wait_for(self, predicate, timeout=COMMAND_TIMEOUT):
+        """Waits until the latest stats satisfy a predicate.
+        Returns the time waited, or None on timeout.
+        """
+        started = time.time()
+        with self._condition:
+            while not (self.stats is not None and predicate(self.stats)):
+                remaining = started + timeout - time.time()
+                if remaining <= 0 or self.closed:
+                    return None
+                self._condition.wait(remaining)
+        return time.time() - started
+    def close(self):
+        """Disconnects from the server."""
+        self.closed = True
+        try:
+            self._send("0::" + NAMESPACE)
+        except Exception:
+            pass
+    def _poll(self):
+        while not self.closed:
+            try:
+                payload = http(self._url("%sxhr-polling/%s" %
+                                         (SOCKETIO_PATH, self._session)))
+            except Exception:
+                if not self.closed:
+                    self.errors += 1
+                    time.sleep(1)
+                continue
+            for packet in decode_payload(payload):
+                self._receive(packet)
+        with self._condition:
+            self._condition.notify_all()
+    def _receive(self, packet):
+        (packet_type, packet_id, endpoint, data) = decode_packet(packet)
+        if packet_type == "2":
+            self._send("2::")
+        elif packet_type == "5" and endpoint == NAMESPACE:
+            event = json.loads(data)
+            message = (event.get("args") or [None])[0]
+            broadcast = not isinstance(message, dict)
+            if broadcast and message is not None:
+                message = json.loads(message)
+            if message is not None and message.get("vessel") == self.vessel:
+                self._handle(event["name"], message, broadcast)
+            if packet_id.endswith("+"):
+                self._send("6::%s:%s" % (NAMESPACE, packet_id[:-1]))
+    def _handle(self, event, message, broadcast):
+        received = time.time()
+        with self._condition:
+            self.frames += 1
+            if event == "stats update":
+                if self._last_stats is not None:
+                    self.stats_gaps.append(received - self._last_stats)
+                self._last_stats = received
+                self.stats = message
+            elif (event.endswith(" plot update") and not broadcast and
+                  self._resync is not None):
+                (started, pending) = self._resync
+                self._resync = (started, pending - 1)
+                if pending == 1:
+                    self.resync_latencies.append(received - started)
+                    self._resync = None
+            self._condition.notify_all()
+
+###############################################################################
+# LOAD
+###############################################################################
+class UsageSampler(object):
+    """Samples the CPU usage and memory of a server process and of its
+    worker processes in a background thread.
+    """
+    def __init__(self, pid, interval=SAMPLE_INTERVAL):
+        self.pid = pid
+        self.interval = interval
+        self.samples = {"web": [], "workers": []} # (cpu fraction, bytes)
+        self._stopped = threading.Event()
+        self._thread = Thread(target=self._run, name="usage sampler")
+        self._thread.daemon = True
+        self._thread.start()
+    def _usage(self):
+        web = process_usage(self.pid)
+        workers = [usage for usage in map(process_usage,
+                                          child_pids(self.pid)) if usage]
+        if web is None:
+            return None
+        return {"web": web,
+                "workers": (sum(cpu for (cpu, _) in workers),
+                            sum(rss for (_, rss) in workers))}
+    def _run(self):
+        previous = (time.time(), self._usage())
+        while not self._stopped.wait(self.interval):
+            current = (time.time(), self._usage())
+            if previous[1] is not None and current[1] is not None:
+                elapsed = current[0] - previous[0]
+                for name in ("web", "workers"):
+                    self.samples[name].append(
+                        ((current[1][name][0] - previous[1][name][0]) /
+                         elapsed, current[1][name][1]))
+            previous = current
+    def stop(self):
+        """Stops sampling."""
+        self._stopped.set()
+    def summary(self):
+        """Returns the mean and max CPU usage (in cores) and the max resident
+        memory (in MB) of the web and worker processes, or None if no samples
+        were taken.
+        """
+        summary = OrderedDict()
+        for (name, samples) in sorted(self.samples.items()):
+            if not samples:
+                return None
+            cpu = np.array([sample[0] for sample in samples])
+            summary[name] = OrderedDict([
+                ("cpu mean", float(cpu.mean())),
+                ("cpu max", float(cpu.max())),
+                ("rss max", max(sample[1] for sample in samples) / 2.0 ** 20),
+            ])
+        return summary
+def confirm(client, latencies, name, predicate):
+    """Records the latency of a command, as the time until the stats of the
+    client satisfy a predicate; a timeout is recorded as None.
+    """
+    latencies.setdefault(name, []).append(client.wait_for(predicate))
+def operate(client, deadline, latencies):
+    """Sets the impeller of the vessel of a client and recalibrates its optics
+    until a deadline, recording the latency of each command.
+    """
+    commands = 0
+    while time.time() < deadline and client.stats is not None:
+        if commands % RECALIBRATE_EVERY == RECALIBRATE_EVERY - 1:
+            calibration = client.stats["optics"]["calibration"]["red"]
+            client.emit("recalibrate optics", {})
+            confirm(client, latencies, "recalibrate optics",
+                    lambda stats: stats["optics"]["calibration"]["red"] !=
+                    calibration)
+        else:
+            duty = IMPELLER_DUTIES[commands % len(IMPELLER_DUTIES)]
+            client.emit("impeller set", {"data": str(duty)})
+            confirm(client, latencies, "impeller set",
+                    lambda stats: stats["impeller"] and
+                    abs(stats["impeller"][1] - duty) < 1e-9)
+        commands += 1
+        time.sleep(COMMAND_INTERVAL)
+def restart(client, latencies):
+    """Stops and restarts the fermenter of the vessel of a client, recording
+    the latency of each command.
+    """
+    client.emit("fermenter stop", {})
+    confirm(client, latencies, "fermenter stop",
+            lambda stats: stats["stop"] is not None)
+    start = client.stats["start"]
+    client.emit("fermenter start", {})
+    confirm(client, latencies, "fermenter start",
+            lambda stats: stats["stop"] is None and stats["start"] != start)
+def watch(client, deadline):
+    """Resyncs the plots of a client at random intervals until a deadline."""
+    while time.time() < deadline:
+        time.sleep(random.expovariate(1.0 / RESYNC_INTERVAL))
+        client.resync()
+def wait_for_history(base_url, vessel_ids, hours, timeout=BOOT_TIMEOUT):
+    """Waits until the server serves the end of the synthetic history of each
+    vessel. Raises RuntimeError on timeout.
+    """
+    deadline = time.time() + timeout
+    query = urlencode({"t0": hours - 1, "limit": 1})
+    pending = list(vessel_ids)
+    while pending:
+        if time.time() > deadline:
+            raise RuntimeError("The server did not serve the history of %s"
+                               % ", ".join(pending))
+        try:
+            result = json.loads(http("%s/vessels/%s/series/temp?%s" %
+                                     (base_url, pending[0], query)))
+            if result["rows"]:
+                pending.pop(0)
+                continue
+        except Exception:
+            pass
+        time.sleep(1)
+def lock_metrics(summaries):
+    """Returns the metrics of waits on the records lock from summaries."""
+    if not summaries:
+        return None
+    histograms = summaries.get("histograms", {})
+    return OrderedDict((name, histograms[name]) for name in LOCK_METRICS
+                       if name in histograms)
+def run_load_test(clients=50, vessels=1, hours=336, duration=60,
+                  time_scale=1, port=HTTP_PORT, app_options=()):
+    """Runs a load test against a newly booted server and returns its results.
+    Latencies are in seconds; None latencies timed out.
+
+    Arguments:
+        clients: the number of clients, spread evenly over vessels
+        vessels: the number of simulated vessels
+        hours: the length of the synthetic run history of each vessel
+        duration: the time (in sec) for which commands and resyncs are sent
+        app_options: further command-line options of app.py
+    """
+    directory = tempfile.mkdtemp(prefix="loadtest")
+    log_path = os.path.join(directory, "loadtest.runlog")
+    vessel_ids = ["sim%d" % i for i in range(vessels)]
+    for (i, vessel_id) in enumerate(vessel_ids):
+        write_run_log(supervisor.vessel_log_path(log_path, vessel_id), hours,
+                      seed=i)
+    base_url = "http://localhost:%d" % port
+    # Only the results are printed to stdout, so that they can be redirected
+    server = subprocess.Popen(
+        [sys.executable, "app.py", "--backend", "simulated", "--vessels",
+         str(vessels), "--log", log_path, "--time-scale", str(time_scale),
+         "--http-port", str(port), "--metrics"] + list(app_options),
+        cwd=os.path.dirname(os.path.abspath(__file__)), stdout=sys.stderr)
+    connected = []
+    try:
+        booted = time.time()
+        wait_for_history(base_url, vessel_ids, hours)
+        boot_time = time.time() - booted
+        sampler = UsageSampler(server.pid)
+        started = time.time()
+        for i in range(clients):
+            connected.append(DashboardClient(base_url,
+                                             vessel_ids[i % vessels]))
+            connected[-1].resync()
+        connect_time = time.time() - started
+        operators = connected[:vessels]
+        operators[0].emit("metrics reset", {})
+        for operator in operators:
+            operator.wait_for(lambda stats: True)
+        latencies = {}
+        deadline = time.time() + duration
+        threads = [Thread(target=operate,
+                          args=(operator, deadline, latencies))
+                   for operator in operators]
+        threads += [Thread(target=watch, args=(watcher, deadline))
+                    for watcher in connected[vessels:]]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # Workers publish metrics periodically, in simulated time
+        time.sleep(supervisor.METRICS_PUBLISH_INTERVAL / float(time_scale) +
+                   supervisor.PUBLISH_INTERVAL * 2)
+        metrics = OrderedDict([
+            ("web", lock_metrics(json.loads(http(base_url + "/metrics")))),
+        ])
+        for vessel_id in vessel_ids:
+            metrics[vessel_id] = lock_metrics(json.loads(http(
+                "%s/vessels/%s/metrics" % (base_url, vessel_id)))["metrics"])
+        restarts = [Thread(target=restart, args=(operator, latencies))
+                    for operator in operators]
+        for thread in restarts:
+            thread.start()
+        for thread in restarts:
+            thread.join()
+        sampler.stop()
+    finally:
+        for client in connected:
+            client.close()
+        server.terminate()
+        server.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+    results = OrderedDict([
+        ("commit", bench.git_commit()),
+        ("clients", clients),
+        ("vessels", vessels),
+        ("history hours", hours),
+        ("duration", duration),
+        ("time_scale", time_scale),
+        ("boot time", boot_time),
+        ("connect time", connect_time),
+        ("latency", OrderedDict()),
+        ("timeouts", OrderedDict()),
+    ])
+    resyncs = sum((client.resync_latencies for client in connected), [])
+    for (name, values) in sorted(latencies.items()) + [("plots resync",
+                                                        resyncs)]:
+        results["latency"][name] = bench.summarize(
+            [value for value in values if value is not None])
+        results["timeouts"][name] = sum(value is None for value in values)
+    results["stats gaps"] = bench.summarize(
+        sum((client.stats_gaps for client in connected), []))
+    results["frames per client"] = bench.summarize(
+        [client.frames for client in connected])
+    results["client errors"] = sum(client.errors for client in connected)
+    results["server"] = sampler.summary()
+    results["records lock"] = metrics
+    return results
+
+###############################################################################
+# MAIN
+###############################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clients", type=int, default=50,
+                        help="number of concurrent dashboard clients")
+    parser.add_argument("--vessels", type=int, default=1,
+                        help="number of simulated vessels")
+    parser.add_argument("--hours", type=float, default=336,
+                        help="length (in hours) of the synthetic history of "
+                        "each vessel")
+    parser.add_argument("--duration", type=float, default=60,
+                        help="time (in sec) for which load is applied")
+    parser.add_argument("--time-scale", type=float, default=1,
+                        help="factor by which the simulated vessels are sped "
+                        "up")
+    parser.add_argument("--port", type=int, default=HTTP_PORT,
+                        help="port at which to serve the dashboard under test")
+    parser.add_argument("--packed-plots", action="store_true",
+                        help="have the server send packed plot updates")
+    parser.add_argument("--retention", type=float, default=None,
+                        help="hours for which the server keeps samples at "
+                        "full resolution; defaults to that of app.py")
+    parser.add_argument("--output", default=None,
+                        help="path of a file to write results to")
+    args = parser.parse_args()
+    if args.clients < args.vessels:
+        parser.error("--clients must be at least --vessels")
+    app_options = ["--packed-plots"] if args.packed_plots else []
+    if args.retention is not None:
+        app_options += ["--retention", str(args.retention)]
+    results = run_load_test(args.clients, args.vessels, args.hours,
+                            args.duration, args.time_scale, args.port,
+                            app_options)
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    print(output)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python2
+"""
+Answers time-range queries over the recorded series of a fermenter run.
+Queries read the latest snapshot of records, so they never wait for the
+records lock. Times are in hours after the start of the run. Sample times are
+monotonically increasing, so a query finds its window by binary search and
+costs O(log n + k) for k samples returned. Samples compacted by retention
+are returned as their rolled-up means, and aggregated as the samples they were
+rolled up from.
+"""
+
+import numpy as np
+import fermenter
+import decimation
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+DEFAULT_PAGE_SIZE = 1000 # number of rows returned per page by default
+MAX_PAGE_SIZE = 10000 # maximum number of rows returned per page
+AGGREGATES = ("mean", "min", "max", "count") # aggregates of bucketed queries
+
+###############################################################################
+# STATELESS FUNCTIONS
+###############################################################################
+def optional_float(value, name):
+    """Returns a query parameter as a float, or None if it is absent."""
+    if value is None or value == "":
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError("%s must be a number" % name)
+def optional_int(value, name, default=None):
+    """Returns a query parameter as an int, or the default if it is absent."""
+    if value is None or value == "":
+        return default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError("%s must be an integer" % name)
+def parse_aggregates(value):
+    """Returns the aggregates requested as a list or comma-separated string."""
+    if not value:
+        return []
+    if isinstance(value, (list, tuple)):
+        aggregates = list(value)
+    else:
+        aggregates = [aggregate.strip() for aggregate in value.split(",")]
+    for aggregate in aggregates:
+        if aggregate not in AGGREGATES:
+            raise ValueError("Unknown aggregate %s; choose from %s" %
+                             (aggregate, ", ".join(AGGREGATES)))
+    return aggregates
+def parse_query(channel, parameters):
+    """Returns the keyword arguments of query_series from request parameters.
+    Parameters may come from an HTTP query string or a Socket.IO message.
+    Raises ValueError for malformed parameters.
+    """
+    return {
+        "channel": channel,
+        "t0": optional_float(parameters.get("t0"), "t0"),
+        "t1": optional_float(parameters.get("t1"), "t1"),
+        "cursor": optional_int(parameters.get("cursor"), "cursor"),
+        "generation": optional_int(parameters.get("generation"),
+                                   "generation"),
+        "offset": optional_int(parameters.get("offset"), "offset"),
+        "limit": optional_int(parameters.get("limit"), "limit",
+                              DEFAULT_PAGE_SIZE),
+        "bucket": optional_float(parameters.get("bucket"), "bucket"),
+        "aggregates": parse_aggregates(parameters.get("aggregate")),
+    }
+
+###############################################################################
+# AGGREGATION
+###############################################################################
+def window_history(history, values, begin, end):
+    """Returns the minimums, maximums and counts of the samples in a window of
+    a series. Samples which are not rolled up are their own minimum and
+    maximum, and count once.
+
+    Arguments:
+        history: the minimums, maximums and counts of the rolled-up samples
+            at the start of the series
+    """
+    rolled = max(0, min(len(history[2]), end) - begin)
+    window = values[begin:end]
+    return tuple(np.concatenate((column[begin:begin + rolled], fill[rolled:]))
+                 for (column, fill) in zip(history, (window, window,
+                                                      np.ones(len(window)))))
+def aggregate_buckets(times, values, origin, bucket, aggregates,
+                      history=None):
+    """Returns rows of the start time and aggregates of each bucket of samples.
+    Buckets are consecutive time intervals of width bucket starting at origin;
+    only buckets containing samples are returned. Rolled-up samples count as
+    the samples they were rolled up from, given their minimums, maximums and
+    counts as history; by default, no samples are rolled up.
+    """
+    if not len(times):
+        return []
+    if history is None:
+        history = (values, values, np.ones(len(values)))
+    (mins, maxs, weights) = history
+    ids = np.floor((times - origin) / bucket).astype(np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(ids)) + 1))
+    counts = np.add.reduceat(weights, starts)
+    columns = [origin + ids[starts] * bucket]
+    for aggregate in aggregates:
+        if aggregate == "mean":
+            columns.append(np.add.reduceat(values * weights, starts) / counts)
+        elif aggregate == "min":
+            columns.append(np.minimum.reduceat(mins, starts))
+        elif aggregate == "max":
+            columns.append(np.maximum.reduceat(maxs, starts))
+        elif aggregate == "count":
+            columns.append(counts)
+    return np.column_stack(columns).tolist()
+
+###############################################################################
+# QUERIES
+###############################################################################
+def query_series(records, channel, t0=None, t1=None, cursor=None,
+                 generation=None, offset=None, limit=DEFAULT_PAGE_SIZE,
+                 bucket=None, aggregates=()):
+    """Returns a page of the samples of a channel within a time window.
+    The result holds the column names and rows of the page, and the cursor of
+    the next page, which is None after the last page. Cursors are indices of
+    samples plus the offset of their series, so they stay valid while samples
+    are appended, and across compactions unless the samples they point at are
+    rolled up, but not after the records are cleared for a new run; pass the
+    generation and offset returned with each cursor to detect that.
+
+    Arguments:
+        channel: the name of a recorded channel
+        t0: the start of the window, or None for the start of the run
+        t1: the end of the window, or None for the latest sample
+        cursor: the cursor of the page to return, or None for the first page
+        generation: the generation of the records the cursor was returned for
+        offset: the offset of the series the cursor was returned for
+        limit: the maximum number of rows in the page
+        bucket: the width (in hours) of buckets to aggregate samples into, or
+            None to return samples
+        aggregates: the aggregates of each bucket, from AGGREGATES; defaults
+            to the mean
+    """
+    snapshot = fermenter.records_snapshot(records)
+    if channel not in snapshot.series:
+        raise ValueError("Unknown channel %s" % channel)
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise ValueError("limit must be between 1 and %d" % MAX_PAGE_SIZE)
+    if bucket is not None and not bucket > 0:
+        raise ValueError("bucket must be positive")
+    if (cursor is not None and generation is not None and
+            generation != snapshot.generation):
+        raise ValueError("The records were cleared since the cursor was "
+                         "returned")
+    (times, values) = snapshot.series[channel]
+    series_offset = snapshot.offsets[channel]
+    if cursor is not None:
+        cursor -= series_offset
+        if (offset is not None and offset != series_offset and
+                cursor < len(snapshot.history[channel][2])):
+            raise ValueError("The samples at the cursor were compacted since "
+                             "it was returned")
+    (begin, end) = decimation.window_indices(times, t0, t1)
+    if cursor is not None:
+        begin = max(begin, min(cursor, end))
+    result = {
+        "channel": channel,
+        "generation": snapshot.generation,
+        "offset": series_offset,
+        "start": snapshot.start,
+        "t0": t0,
+        "t1": t1,
+    }
+    if bucket is None:
+        page_end = min(end, begin + limit)
+        result["columns"] = ["time", "value"]
+        result["rows"] = np.column_stack((times[begin:page_end],
+                                          values[begin:page_end])).tolist()
+    else:
+        aggregates = list(aggregates) or ["mean"]
+        origin = t0 if t0 is not None else 0
+        page_end = end
+        if begin < end:
+            first = np.floor((times[begin] - origin) / bucket)
+            page_t1 = origin + (first + limit) * bucket
+            page_end = min(end, int(np.searchsorted(times, page_t1, "left")))
+        result["bucket"] = bucket
+        result["columns"] = ["time"] + aggregates
+        result["rows"] = aggregate_buckets(
+            times[begin:page_end], values[begin:page_end], origin, bucket,
+            aggregates, window_history(snapshot.history[channel], values,
+                                       begin, page_end))
+    result["cursor"] = series_offset + page_end if page_end < end else None
+    return result
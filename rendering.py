@@ -0,0 +1,229 @@
+#!/usr/bin/env python2
+"""
+Renders the dashboard plots of recorded series as SVG images on the server.
+Rendered plots are cached per plot and only rendered again when the samples
+or calibration they show change, so clients can revalidate cached images by
+their ETag at almost no cost.
+"""
+
+import weakref
+import hashlib
+import threading
+from xml.sax.saxutils import escape
+import numpy as np
+import fermenter
+import dashboard
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+WIDTH = 600 # (px): width of each plot, as drawn by the client
+HEIGHT = 310 # (px): height of each plot, as drawn by the client
+MARGINS = (40, 60, 40, 60) # (px): top, right, bottom and left margins
+PLOT_POINTS = 600 # maximum number of points per series, about one per pixel
+TICKS = 5 # approximate number of ticks on each axis
+FONT = "font-family=\"sans-serif\" font-size=\"11\""
+PLOTS = { # title, then label and (channel, name, color) series of each axis
+    "temp": ("Temperature Control",
+             (u"Temperature (°C)", (("temp", "Temperature", "#4285f4"),)),
+             ("Heater Duty Cycle", (("heater", "Heater", "#db4437"),))),
+    "optics": ("Relative Absorbances",
+               ("Green Absorbance", (("green", "Green", "#0f9d58"),)),
+               ("OD", (("red", "Red", "#db4437"),))),
+    "environ": ("Ambient Light",
+                ("Ambient Light", (("ambient", "Ambient", "#4285f4"),)),
+                None),
+    "impeller": ("Impeller Duty",
+                 ("Impeller Duty Cycle", (("impeller", "Impeller",
+                                           "#4285f4"),)),
+                 None),
+}
+
+###############################################################################
+# GLOBALS
+###############################################################################
+caches = weakref.WeakKeyDictionary() # rendered plots by series store
+caches_lock = threading.Lock()
+
+###############################################################################
+# STATELESS FUNCTIONS
+###############################################################################
+def plot_channels(plot):
+    """Returns the recorded channels shown in a plot."""
+    (_, left, right) = PLOTS[plot]
+    axes = [left] + ([right] if right else [])
+    return [channel for (_, series) in axes for (channel, _, _) in series]
+def plot_key(snapshot, plot):
+    """Returns what a plot depends on in a snapshot of records.
+    Series are append-only within a generation between compactions, which
+    change their offsets, so their offsets and lengths identify their
+    contents.
+    """
+    key = (plot, snapshot.generation,
+           tuple((snapshot.offsets[channel], len(snapshot.series[channel][0]))
+                 for channel in plot_channels(plot)))
+    if plot == "optics":
+        key += (snapshot.calibration["red"], snapshot.calibration["green"])
+    return key
+def key_etag(key):
+    """Returns the ETag of a rendered plot from its key."""
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:20]
+def ticks(low, high):
+    """Returns round tick values spanning an interval."""
+    if high <= low:
+        return [low]
+    raw_step = (high - low) / TICKS
+    magnitude = 10 ** np.floor(np.log10(raw_step))
+    step = min((multiple * magnitude for multiple in (1, 2, 2.5, 5, 10)
+                if multiple * magnitude >= raw_step))
+    first = np.ceil(low / step) * step
+    return [float(tick) for tick in np.arange(first, high + step / 2, step)]
+def tick_label(value):
+    """Returns a short label of a tick value."""
+    return "%g" % float("%.4g" % value)
+def axis_range(arrays):
+    """Returns the padded range of values of some arrays, or None if empty."""
+    arrays = [values for values in arrays if len(values)]
+    if not arrays:
+        return None
+    low = min(float(np.nanmin(values)) for values in arrays)
+    high = max(float(np.nanmax(values)) for values in arrays)
+    if not np.isfinite(low) or not np.isfinite(high):
+        return None
+    if high - low < 1e-9:
+        (low, high) = (low - 0.5, high + 0.5)
+    padding = (high - low) * 0.05
+    return (low - padding, high + padding)
+
+###############################################################################
+# RENDERING
+###############################################################################
+def plot_series(snapshot, store_pyramids, channel):
+    """Returns the decimated times and values of a channel for a plot.
+    Transmittances are converted to absorbances against their calibration.
+    """
+    (times, values) = snapshot.series[channel]
+    rows = np.array(dashboard.decimated_points(
+        store_pyramids[channel], snapshot.generation, times, values,
+        npoints=PLOT_POINTS, offset=snapshot.offsets[channel]),
+        dtype=np.float64).reshape(-1, 2)
+    (times, values) = (rows[:, 0], rows[:, 1])
+    calibration = snapshot.calibration.get(channel)
+    if channel in ("red", "green"):
+        if calibration:
+            values = (calibration - values) / calibration
+        else:
+            values = values[:0]
+            times = times[:0]
+    return (times, values)
+def render_svg(title, time_range, axes):
+    """Returns the SVG text of a line plot.
+
+    Arguments:
+        time_range: the range of times (in hours) on the horizontal axis
+        axes: a list of the left and optionally right vertical axis, each as a
+            tuple of its label, value range and (name, color, times, values)
+            series; an axis with a range of None is not drawn
+    """
+    (top, right, bottom, left) = MARGINS
+    (x0, x1) = (left, WIDTH - right)
+    (y0, y1) = (HEIGHT - bottom, top)
+    (t0, t1) = time_range
+    def x(times):
+        return x0 + (times - t0) / (t1 - t0) * (x1 - x0)
+    elements = [
+        u'<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" '
+        u'viewBox="0 0 %d %d">' % (WIDTH, HEIGHT, WIDTH, HEIGHT),
+        u'<rect width="100%" height="100%" fill="white"/>',
+        u'<text x="%d" y="%d" %s font-size="14">%s</text>' %
+        (x0, top - 18, FONT, escape(title)),
+        u'<line x1="%d" y1="%d" x2="%d" y2="%d" stroke="#999"/>' %
+        (x0, y0, x1, y0),
+    ]
+    for tick in ticks(t0, t1):
+        elements.append(u'<text x="%.1f" y="%d" %s text-anchor="middle">%s'
+                        u'</text>' % (x(tick), y0 + 15, FONT,
+                                      tick_label(tick)))
+    elements.append(u'<text x="%d" y="%d" %s text-anchor="middle">Time (h)'
+                    u'</text>' % ((x0 + x1) / 2, HEIGHT - 8, FONT))
+    drawn = False
+    for (side, (label, value_range, series)) in zip(("left", "right"), axes):
+        if value_range is None:
+            continue
+        (v0, v1) = value_range
+        def y(values):
+            return y0 + (values - v0) / (v1 - v0) * (y1 - y0)
+        (axis_x, anchor, offset) = ((x0, "end", -6) if side == "left"
+                                    else (x1, "start", 6))
+        elements.append(u'<line x1="%d" y1="%d" x2="%d" y2="%d" '
+                        u'stroke="#999"/>' % (axis_x, y0, axis_x, y1))
+        for tick in ticks(v0, v1):
+            elements.append(u'<text x="%d" y="%.1f" %s text-anchor="%s" '
+                            u'dominant-baseline="middle">%s</text>' %
+                            (axis_x + offset, y(tick), FONT, anchor,
+                             tick_label(tick)))
+        label_x = axis_x + (-45 if side == "left" else 45)
+        elements.append(u'<text x="%d" y="%d" %s text-anchor="middle" '
+                        u'transform="rotate(-90 %d %d)">%s</text>' %
+                        (label_x, (y0 + y1) / 2, FONT, label_x,
+                         (y0 + y1) / 2, escape(label)))
+        for (name, color, times, values) in series:
+            if not len(times):
+                continue
+            drawn = True
+            points = np.column_stack((x(times), y(values)))
+            elements.append(u'<polyline fill="none" stroke="%s" '
+                            u'stroke-width="1.5" points="%s"><title>%s'
+                            u'</title></polyline>' %
+                            (color, " ".join("%.1f,%.1f" % tuple(point)
+                                             for point in points),
+                             escape(name)))
+    if not drawn:
+        elements.append(u'<text x="%d" y="%d" %s text-anchor="middle" '
+                        u'fill="#999">No data</text>' %
+                        ((x0 + x1) / 2, (y0 + y1) / 2, FONT))
+    elements.append(u'</svg>')
+    return u"\n".join(elements)
+def render_plot(snapshot, store_pyramids, plot):
+    """Returns the SVG text of a plot of a snapshot of records."""
+    (title, left, right) = PLOTS[plot]
+    axes = []
+    all_times = []
+    for axis in (left, right):
+        if axis is None:
+            continue
+        (label, channels) = axis
+        series = []
+        for (channel, name, color) in channels:
+            (times, values) = plot_series(snapshot, store_pyramids, channel)
+            series.append((name, color, times, values))
+            all_times.append(times)
+        axes.append((label, axis_range([values for (_, _, _, values)
+                                        in series]), series))
+    time_range = axis_range(all_times) or (0, 1)
+    return render_svg(title, (max(0, time_range[0]), time_range[1]), axes)
+
+###############################################################################
+# CACHING
+###############################################################################
+def plot_etag(records, plot):
+    """Returns the ETag of the current plot, without rendering it."""
+    return key_etag(plot_key(fermenter.records_snapshot(records), plot))
+def cached_plot(records, plot):
+    """Returns the ETag and SVG text of the current plot of records.
+    The plot is only rendered if the samples or calibration it shows changed
+    since it was last rendered.
+    """
+    snapshot = fermenter.records_snapshot(records)
+    key = plot_key(snapshot, plot)
+    series = records["series"]
+    with caches_lock:
+        cache = caches.setdefault(series, {})
+        cached = cache.get(plot)
+    if cached is not None and cached[0] == key:
+        return (cached[1], cached[2])
+    svg = render_plot(snapshot, dashboard.series_pyramids(series), plot)
+    etag = key_etag(key)
+    with caches_lock:
+        cache[plot] = (key, etag, svg)
+    return (etag, svg)
@@ -0,0 +1,340 @@
+#!/usr/bin/env python2
+"""
+Captures the raw sensor samples of fermenter runs and replays them faster than
+real time. A capture holds every sample read from the analog pins of the
+Arduino, with its time and the LEDs lit while it was read. A replay feeds the
+captured samples back through the fermenter's acquisition, filtering and
+control routines on a virtual clock, so that a run may be re-run with other
+parameters, such as filter thresholds and control gains, and the records of
+the replay compared with those of the run.
+"""
+
+import os
+import time
+import atexit
+import argparse
+import threading
+from bisect import bisect_left
+import numpy as np
+import fermenter
+import clocks
+import export
+from scheduler import Scheduler
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+MAGIC = b"FRMCAP01" # identifies the file format and its version
+HEADER_SIZE = 16 # (bytes): the magic followed by reserved bytes
+SAMPLE_DTYPE = np.dtype([("time", "<f8"), ("pin", "<u1"), ("leds", "<u1"),
+                         ("value", "<u2")])
+LED_BITS = { # bit of each LED in the leds field of captured samples
+    "red": 1,
+    "green": 2,
+}
+DEFAULT_OUTPUT = "replay.npz" # file to which replayed records are exported
+# Fermenter parameters which a replay cannot apply, as the captured samples
+# were read at their values or they only concern hardware and storage
+FIXED_PARAMETERS = frozenset([
+    "SENSOR_PINS", "ACTUATOR_PINS", "LIGHT_COLORS", "PWM_MAX", "SERIAL_RATE",
+    "ARDUINO_PORT", "ANALOG_PIN_OFFSET", "DEFAULT_BACKEND", "BATCH_COMMAND",
+    "BATCH_SAMPLE_DTYPE", "BATCH_TIMEOUT_MARGIN", "RECORD_CHANNELS",
+    "RUN_LOG_PATH", "RAW_RETENTION", "OPTICS_MODE", "LIGHT_SAMPLE_SCHEDULES",
+])
+
+###############################################################################
+# STATELESS FUNCTIONS
+###############################################################################
+def update_led_bits(leds, pin, value):
+    """Returns the bits of lit LEDs after a digital write to a pin."""
+    for (color, bit) in LED_BITS.items():
+        if pin == fermenter.ACTUATOR_PINS[color + " led"]:
+            if value == "HIGH":
+                leds |= bit
+            else:
+                leds &= ~bit
+    return leds
+def sample_leds(pin, leds):
+    """Returns the bits of lit LEDs captured with a sample of a pin.
+    Only samples of the phototransistor depend on the LEDs.
+    """
+    return leds if pin == fermenter.SENSOR_PINS["phototransistor"] else 0
+def parse_parameter(text):
+    """Returns the name and value of a parameter given as NAME=VALUE."""
+    (name, _, value) = text.partition("=")
+    try:
+        return (name.strip(), int(value))
+    except ValueError:
+        pass
+    try:
+        return (name.strip(), float(value))
+    except ValueError:
+        raise ValueError("Parameter %s must be given as NAME=NUMBER" % text)
+
+###############################################################################
+# CAPTURE
+###############################################################################
+class CapturingDevice(object):
+    """A proxy of a device which appends every analog sample read from it to
+    a capture file. Writes to LED pins are tracked, so that each sample of the
+    phototransistor is captured with the LEDs lit while it was read; other
+    attributes of the device pass through untouched. Samples of a batch read
+    are timed as taken at the requested sample interval.
+
+    Arguments:
+        device: the device whose samples are captured
+        path: the path of the capture file, to which samples are appended
+    """
+    def __init__(self, device, path):
+        self.device = device
+        self.path = path
+        self._leds = 0
+        self._lock = threading.Lock()
+        self._file = open(path, "ab")
+        size = os.path.getsize(path)
+        if size < HEADER_SIZE:
+            self._file.truncate(0)
+            self._file.write(MAGIC + b"\0" * (HEADER_SIZE - len(MAGIC)))
+        else:
+            torn = (size - HEADER_SIZE) % SAMPLE_DTYPE.itemsize
+            if torn:
+                self._file.truncate(size - torn)
+        self._file.flush()
+        atexit.register(self.close)
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+    def digitalWrite(self, pin, value):
+        self.device.digitalWrite(pin, value)
+        self._leds = update_led_bits(self._leds, pin, value)
+    def analogRead(self, pin):
+        started = fermenter.clock.time()
+        value = self.device.analogRead(pin)
+        self._capture(pin, [started], [value])
+        return value
+    def analogReadBatch(self, pin, nsamples, sample_interval):
+        started = fermenter.clock.time()
+        reply = fermenter.analog_read_batch(self.device, pin, nsamples,
+                                            sample_interval)
+        values = np.frombuffer(reply, dtype=fermenter.BATCH_SAMPLE_DTYPE)
+        self._capture(pin, started + sample_interval * np.arange(len(values)),
+                      values)
+        return reply
+    def _capture(self, pin, times, values):
+        samples = np.zeros(len(values), dtype=SAMPLE_DTYPE)
+        samples["time"] = times
+        samples["pin"] = pin
+        samples["leds"] = sample_leds(pin, self._leds)
+        samples["value"] = values
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(samples.tobytes())
+                self._file.flush()
+    def close(self):
+        """Closes the capture file."""
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+def load_capture(path):
+    """Returns the samples of a capture file as a structured array.
+    A torn sample at the end of the file is ignored.
+    """
+    with open(path, "rb") as capture_file:
+        if capture_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a sensor capture" % path)
+        capture_file.seek(HEADER_SIZE)
+        data = capture_file.read()
+    count = len(data) // SAMPLE_DTYPE.itemsize
+    return np.frombuffer(data[:count * SAMPLE_DTYPE.itemsize],
+                         dtype=SAMPLE_DTYPE)
+
+###############################################################################
+# REPLAY
+###############################################################################
+class ReplayArduino(object):
+    """A device which serves captured samples in place of an Arduino.
+    Each read of a pin returns the next captured sample of that pin, read with
+    the same LEDs lit, which is not earlier than the current time of the
+    clock; once the samples run out, the last one is repeated. Batch reads
+    advance the clock by their sample intervals. Writes to actuators are kept
+    in outputs, as duty cycles.
+
+    Arguments:
+        samples: the captured samples, as from load_capture
+        clock: the clock of the replay
+    """
+    def __init__(self, samples, clock):
+        self.clock = clock
+        self.outputs = {}
+        self._leds = 0
+        self._streams = {}
+        self._cursors = {}
+        keys = samples["pin"].astype(np.int64) * 256 + samples["leds"]
+        for key in np.unique(keys).tolist():
+            stream = samples[keys == key]
+            self._streams[divmod(key, 256)] = (stream["time"].tolist(),
+                                               stream["value"].tolist())
+            self._cursors[divmod(key, 256)] = 0
+    def pinMode(self, pin, mode):
+        pass
+    def digitalWrite(self, pin, value):
+        self.outputs[pin] = 1.0 if value == "HIGH" else 0.0
+        self._leds = update_led_bits(self._leds, pin, value)
+    def analogWrite(self, pin, value):
+        self.outputs[pin] = float(value) / fermenter.PWM_MAX
+    def _read(self, pin):
+        key = (pin, sample_leds(pin, self._leds))
+        if key not in self._streams:
+            return 0
+        (times, values) = self._streams[key]
+        cursor = bisect_left(times, self.clock.time(), self._cursors[key])
+        self._cursors[key] = cursor + 1
+        return values[min(cursor, len(values) - 1)]
+    def analogRead(self, pin):
+        return self._read(pin)
+    def analogReadBatch(self, pin, nsamples, sample_interval):
+        values = []
+        for i in range(nsamples):
+            if i != 0:
+                self.clock.sleep(sample_interval)
+            values.append(self._read(pin))
+        return np.array(values, dtype=fermenter.BATCH_SAMPLE_DTYPE).tobytes()
+def derive_parameters(parameters):
+    """Recomputes the fermenter parameters derived from others at import,
+    except those overridden themselves.
+
+    Arguments:
+        parameters: a dict of the overridden parameters, as for set_parameters
+    """
+    f = fermenter
+    for (name, derive) in (
+            ("FILTER_STEADY_STATE_TIME",
+             lambda: f.LOW_PASS_FILTER_TAU * f.STEADY_STATE_TAUS),
+            ("HEATER_SETPOINT_DUTY",
+             lambda: float(f.HEAT_LOSS) / f.MAX_HEATING),
+            ("GAIN", lambda: f.HEATER_SETPOINT_DUTY - 1)):
+        if name not in parameters:
+            setattr(fermenter, name, derive())
+    fermenter.LIGHT_SAMPLE_SCHEDULES = {
+        color: (f.LIGHT_SAMPLES_PER_ACQUISITION, f.LIGHT_SAMPLE_INTERVAL)
+        for color in f.LIGHT_COLORS}
+def check_parameters(parameters):
+    """Raises ValueError for any parameter which a replay cannot apply.
+
+    Arguments:
+        parameters: a dict of parameters to override, as for set_parameters
+    """
+    for name in parameters:
+        if not name.isupper() or not hasattr(fermenter, name):
+            raise ValueError("Unknown fermenter parameter %s" % name)
+        if name in FIXED_PARAMETERS:
+            raise ValueError("Fermenter parameter %s cannot be replayed" %
+                             name)
+def set_parameters(parameters):
+    """Overrides parameters of the fermenter, such as filter thresholds and
+    control gains, and applies them to its derived parameters, estimators and
+    intervals. Raises ValueError for parameters which a replay cannot apply.
+
+    Arguments:
+        parameters: a dict of values keyed by the names of parameters in
+            fermenter, such as "TEMP_OUTLIER_THRESHOLD"
+    """
+    check_parameters(parameters)
+    for (name, value) in parameters.items():
+        setattr(fermenter, name, value)
+    derive_parameters(parameters)
+    fermenter.estimators.update(fermenter.construct_estimators())
+    for name in ("window", "min_samples", "min_od", "min_rate",
+                 "stationary_fraction"):
+        setattr(fermenter.growth, name,
+                getattr(fermenter, "GROWTH_" + name.upper()))
+    for (name, prefix, tolerances) in (
+            ("temp", "TEMP_", (fermenter.TEMP_STABLE_TOLERANCE,)),
+            ("optics", "LIGHT_", (fermenter.LIGHT_STABLE_TOLERANCE,) * 2)):
+        interval = fermenter.intervals[name]
+        interval.minimum = getattr(fermenter, prefix + "MEASUREMENT_INTERVAL")
+        interval.maximum = getattr(fermenter,
+                                   prefix + "MAX_MEASUREMENT_INTERVAL")
+        interval.tolerances = tolerances
+def replay(samples, parameters=None, verbose=False):
+    """Replays captured samples through the fermenter on a virtual clock.
+    Returns the records of the replayed run, which starts at the first
+    captured sample and stops at the last.
+
+    Arguments:
+        samples: the captured samples, as from load_capture
+        parameters: a dict of fermenter parameters to override, as for
+            set_parameters
+        verbose: whether to print each change of measurement intervals
+    """
+    set_parameters(parameters or {})
+    for interval in fermenter.intervals.values():
+        interval.verbose = verbose
+    # Routines of the fermenter read time from its module clock
+    fermenter.clock = clocks.VirtualClock(samples["time"][0])
+    end = samples["time"][-1]
+    a = fermenter.CoalescingDevice(ReplayArduino(samples, fermenter.clock))
+    fermenter.set_pin_modes(a)
+    fermenter.turn_off_actuators(a)
+    fermenter.initialize_default_actuators(a)
+    records = fermenter.construct_records()
+    locks = fermenter.construct_locks()
+    events = fermenter.construct_events()
+    with locks["records"]:
+        fermenter.reinitialize_records(records)
+        records["series"].append("impeller", 0,
+                                 fermenter.IMPELLER_DEFAULT_DUTY)
+        fermenter.reset_growth(records)
+        fermenter.publish_records(records)
+    fermenter.reset_intervals("replay started")
+    events["fermenter idle"].clear()
+    scheduler = Scheduler(a, fermenter.clock)
+    fermenter.spawn_monitors(scheduler, a, records, locks, events)
+    scheduler.run_until(lambda: fermenter.clock.time() >= end)
+    events["fermenter idle"].set()
+    with locks["records"]:
+        records["stop"] = fermenter.clock.now()
+        fermenter.publish_records(records)
+    return records
+
+###############################################################################
+# MAIN
+###############################################################################
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("capture", help="path of the sensor capture to replay")
+    parser.add_argument("--set", action="append", default=[],
+                        metavar="NAME=VALUE",
+                        help="override a fermenter parameter, such as "
+                        "TEMP_OUTLIER_THRESHOLD; may be repeated")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT,
+                        help="path of the file to export replayed records to, "
+                        "whose extension selects the export format")
+    parser.add_argument("--verbose", action="store_true",
+                        help="print each change of measurement intervals")
+    args = parser.parse_args()
+    formats = {extension: export_format for (export_format, extension)
+               in export.FORMATS.items()}
+    export_format = formats.get(os.path.splitext(args.output)[1])
+    if export_format is None:
+        parser.error("--output must end with one of %s" %
+                     ", ".join(sorted(formats)))
+    try:
+        parameters = dict(parse_parameter(text) for text in args.set)
+        check_parameters(parameters)
+    except ValueError as error:
+        parser.error(str(error))
+    samples = load_capture(args.capture)
+    if not len(samples):
+        parser.error("%s holds no samples" % args.capture)
+    started = time.time()
+    records = replay(samples, parameters, args.verbose)
+    snapshot = fermenter.records_snapshot(records)
+    temps = snapshot.series["temp"][1]
+    print("Replayed %.2f hours in %.1f sec." %
+          ((samples["time"][-1] - samples["time"][0]) / 3600,
+           time.time() - started))
+    if len(temps):
+        print("Temperature: mean %.3f deg C, mean absolute error %.3f deg C."
+              % (np.mean(temps), np.mean(np.abs(temps - fermenter.SETPOINT))))
+    export.WRITERS[export_format](snapshot, args.output)
+    print("Records exported to %s." % args.output)
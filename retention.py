@@ -0,0 +1,125 @@
+#!/usr/bin/env python2
+"""
+Bounds the memory used by the records of long fermenter runs.
+Samples recorded within a recent window are kept at full resolution; older
+samples are compacted into per-minute rolled-up samples, and those older still
+into per-hour ones. Each rolled-up sample holds the mean time and value of a
+bucket of samples and keeps their minimum, maximum and count, and takes the
+place of the bucket at the start of its series, so plots and queries read
+across the tiers as if they were ordinary samples. Compaction runs in a
+background thread and only holds the records lock to swap in compacted
+series. The run log still holds every sample.
+"""
+
+import time
+from threading import Thread
+import numpy as np
+import fermenter
+from instrumentation import metrics
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+MINUTE = 1.0 / 60 # (hours)
+HOUR = 1.0 # (hours)
+MINUTE_RETENTION = 48 # (hours): per-minute samples kept after the raw window
+COMPACTION_INTERVAL = 600 # (sec): time to wait between compactions
+
+###############################################################################
+# STATELESS FUNCTIONS
+###############################################################################
+def floor_to(value, width):
+    """Returns a value rounded down to a multiple of a width."""
+    return np.floor(value / width) * width
+def rollup(times, values, mins, maxs, counts, width):
+    """Returns the mean times and values, minimums, maximums and counts of
+    samples grouped into buckets of a width. Buckets are aligned to multiples
+    of the width; only buckets containing samples are returned. Samples may
+    themselves be rolled up, in which case their means are weighted by their
+    counts.
+    """
+    if not len(times):
+        return (times, values, mins, maxs, counts)
+    ids = np.floor(times / width).astype(np.int64)
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(ids)) + 1))
+    totals = np.add.reduceat(counts, starts)
+    return (np.add.reduceat(times * counts, starts) / totals,
+            np.add.reduceat(values * counts, starts) / totals,
+            np.minimum.reduceat(mins, starts),
+            np.maximum.reduceat(maxs, starts),
+            totals)
+def compact_series(times, values, history, now, raw_retention):
+    """Returns the arguments of TimeSeries.compact for a series, or None if
+    none of its samples are due for compaction.
+
+    Arguments:
+        times, values: views of all samples of the series
+        history: the minimums, maximums and counts of its rolled-up samples
+        now: the current time (in hours after the start of the run)
+        raw_retention: the time (in hours) for which samples are kept at full
+            resolution
+    """
+    (mins, maxs, counts) = history
+    rolled = len(counts)
+    raw_cutoff = floor_to(now - raw_retention, MINUTE)
+    hour_cutoff = min(floor_to(raw_cutoff - MINUTE_RETENTION, HOUR),
+                      raw_cutoff)
+    begin = int(np.searchsorted(times, raw_cutoff, "left"))
+    hourly = int(np.searchsorted(times[:rolled], hour_cutoff, "left"))
+    if begin <= rolled:
+        return None
+    # Full-resolution samples are buckets of one sample
+    raw = slice(rolled, begin)
+    columns = (np.concatenate((times[:rolled], times[raw])),
+               np.concatenate((values[:rolled], values[raw])),
+               np.concatenate((mins, values[raw])),
+               np.concatenate((maxs, values[raw])),
+               np.concatenate((counts, np.ones(begin - rolled))))
+    tiers = [rollup(*([column[:hourly] for column in columns] + [HOUR])),
+             rollup(*([column[hourly:] for column in columns] + [MINUTE]))]
+    return (begin,) + tuple(np.concatenate(tier_columns)
+                            for tier_columns in zip(*tiers))
+
+###############################################################################
+# COMPACTION
+###############################################################################
+def compact_records(records, locks, raw_retention):
+    """Compacts the samples of records older than the raw retention window.
+    Rolled-up samples are computed from a snapshot without locking the
+    records; samples appended meanwhile are kept as they are. Returns whether
+    any samples were compacted.
+    """
+    snapshot = fermenter.records_snapshot(records)
+    now = fermenter.hours_offset(snapshot.start, fermenter.clock.now())
+    rollups = {}
+    for (channel, (times, values)) in snapshot.series.items():
+        arguments = compact_series(times, values, snapshot.history[channel],
+                                   now, raw_retention)
+        if arguments is not None:
+            rollups[channel] = arguments
+    if not rollups:
+        return False
+    with locks["records"]:
+        if records["series"].generation != snapshot.generation:
+            # The records were cleared for a new run meanwhile
+            return False
+        records["series"].compact(rollups)
+        fermenter.publish_records(records)
+    return True
+def run_compaction(records, locks, raw_retention,
+                   interval=COMPACTION_INTERVAL):
+    """Compacts records periodically. Never returns."""
+    while True:
+        fermenter.clock.sleep(interval)
+        started = time.time()
+        compact_records(records, locks, raw_retention)
+        metrics.record("compact records", time.time() - started)
+def start_compaction(records, locks, raw_retention):
+    """Starts compacting records periodically in a background thread.
+    Returns the thread.
+    """
+    thread = Thread(target=run_compaction, name="compaction",
+                    args=(records, locks, raw_retention))
+    thread.daemon = True
+    thread.start()
+    return thread
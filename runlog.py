@@ -0,0 +1,175 @@
+#!/usr/bin/env python2
+"""
+Crash-safe, append-only binary log of the samples recorded by a fermenter.
+"""
+
+import os
+import mmap
+import time
+import struct
+import threading
+from threading import Thread
+from datetime import datetime
+import numpy as np
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+FSYNC_INTERVAL = 5 # (sec): time to wait between flushing batches to disk
+MAGIC = b"FRMLOG01" # identifies the file format and its version
+HEADER_SIZE = 16 # (bytes): the magic followed by reserved bytes
+RECORD_FORMAT = "<Bdd" # code, hours offset, value
+RECORD_DTYPE = np.dtype([("code", "<u1"), ("time", "<f8"), ("value", "<f8")])
+RECORD_SIZE = struct.calcsize(RECORD_FORMAT)
+
+# Record codes. Codes are stored on disk, so existing codes must not change.
+EVENT_CODES = {
+    "start": 0, # value is the start time, as a POSIX timestamp
+    "stop": 1, # value is the stop time, as a POSIX timestamp
+    "calibration red": 2,
+    "calibration green": 3,
+}
+CHANNEL_CODES = {
+    "temp": 16,
+    "heater": 17,
+    "impeller": 18,
+    "ambient": 19,
+    "red": 20,
+    "green": 21,
+    "od": 22,
+    "growth": 23,
+}
+
+###############################################################################
+# STATELESS FUNCTIONS
+###############################################################################
+def datetime_to_timestamp(moment):
+    """Returns the POSIX timestamp of a local datetime."""
+    return time.mktime(moment.timetuple()) + moment.microsecond / 1e6
+def timestamp_to_datetime(timestamp):
+    """Returns the local datetime of a POSIX timestamp."""
+    return datetime.fromtimestamp(timestamp)
+
+###############################################################################
+# WRITING
+###############################################################################
+class RunLog(object):
+    """Appends records to a log file from any thread without blocking on disk.
+    Records are packed into an in-memory batch which a background thread
+    writes and fsyncs every FSYNC_INTERVAL seconds. A torn record at the end
+    of an existing log, left by a crash during a write, is truncated on open.
+    """
+    def __init__(self, path, fsync_interval=FSYNC_INTERVAL):
+        self.path = path
+        self._fsync_interval = fsync_interval
+        self._batch = bytearray()
+        self._batch_lock = threading.Lock()
+        self._file_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._file = open(path, "ab")
+        size = os.path.getsize(path)
+        if size < HEADER_SIZE:
+            self._file.truncate(0)
+            self._file.write(MAGIC + b"\0" * (HEADER_SIZE - len(MAGIC)))
+        else:
+            torn = (size - HEADER_SIZE) % RECORD_SIZE
+            if torn:
+                self._file.truncate(size - torn)
+        self.flush()
+        self._flusher = Thread(target=self._flush_loop, name="run log")
+        self._flusher.daemon = True
+        self._flusher.start()
+    def record(self, channel, time, value):
+        """Appends a sample of a recorded channel."""
+        self._append(CHANNEL_CODES[channel], time, value)
+    def record_samples(self, channel, times, values):
+        """Appends arrays of samples of a recorded channel."""
+        records = np.zeros(len(times), dtype=RECORD_DTYPE)
+        records["code"] = CHANNEL_CODES[channel]
+        records["time"] = times
+        records["value"] = values
+        with self._batch_lock:
+            self._batch += records.tobytes()
+    def record_event(self, event, value, time=0):
+        """Appends a run event, such as a start, stop or calibration.
+        Datetime values are stored as POSIX timestamps.
+        """
+        if isinstance(value, datetime):
+            value = datetime_to_timestamp(value)
+        self._append(EVENT_CODES[event], time, value)
+    def _append(self, code, time, value):
+        packed = struct.pack(RECORD_FORMAT, code, time, value)
+        with self._batch_lock:
+            self._batch += packed
+    def flush(self):
+        """Writes all batched records to disk and waits for them to persist."""
+        with self._file_lock:
+            with self._batch_lock:
+                (batch, self._batch) = (self._batch, bytearray())
+            if self._file.closed:
+                return
+            if batch:
+                self._file.write(batch)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+    def _flush_loop(self):
+        while not self._closed.wait(self._fsync_interval):
+            self.flush()
+    def close(self):
+        """Flushes all batched records and closes the log file."""
+        self._closed.set()
+        self.flush()
+        with self._file_lock:
+            self._file.close()
+
+###############################################################################
+# READING
+###############################################################################
+def read_records(path):
+    """Returns all complete records in a log file as a Numpy structured array.
+    The array is a read-only view of a memory map of the file, so no records
+    are parsed or copied.
+    """
+    size = os.path.getsize(path)
+    count = (size - HEADER_SIZE) // RECORD_SIZE
+    if count <= 0:
+        return np.zeros(0, dtype=RECORD_DTYPE)
+    with open(path, "rb") as log_file:
+        mapped = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(MAGIC)] != MAGIC:
+        raise ValueError("%s is not a fermenter run log" % path)
+    return np.frombuffer(mapped, dtype=RECORD_DTYPE, count=count,
+                         offset=HEADER_SIZE)
+def last_run(log_records):
+    """Returns the records of the most recently started run in a log."""
+    starts = np.flatnonzero(log_records["code"] == EVENT_CODES["start"])
+    if not starts.size:
+        return log_records[:0]
+    return log_records[starts[-1]:]
+def recover_records(path, records):
+    """Rebuilds records from the most recently started run in a log file.
+    Returns whether a run was recovered; records are left untouched otherwise.
+    """
+    if not os.path.exists(path):
+        return False
+    run = last_run(read_records(path))
+    if not run.size:
+        return False
+    codes = run["code"]
+    records["series"].clear()
+    records["start"] = timestamp_to_datetime(run["value"][0])
+    records["stop"] = None
+    for (channel, code) in CHANNEL_CODES.items():
+        samples = run[codes == code]
+        if channel in records["series"]:
+            records["series"][channel].extend(samples["time"], samples["value"])
+    for (event, code) in EVENT_CODES.items():
+        matches = np.flatnonzero(codes == code)
+        if not matches.size or event == "start":
+            continue
+        value = float(run["value"][matches[-1]])
+        if event == "stop":
+            records["stop"] = timestamp_to_datetime(value)
+        else:
+            records["optics"]["calibration"][event.split()[1]] = value
+    return True
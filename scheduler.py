@@ -0,0 +1,259 @@
+#!/usr/bin/env python2
+"""
+Schedules all use of the fermenter's Arduino from a single thread.
+Tasks are either functions, which run to completion, or generators of steps.
+Each step of a generator runs until its next yield, which gives the delay (in
+sec) before its next step may run, or PARK to wait until the scheduler is
+woken. Between steps, the ready task of highest priority runs first, so
+time-critical tasks preempt long tasks at their step boundaries.
+"""
+
+import time
+import heapq
+import itertools
+import threading
+import traceback
+from threading import Thread
+from clocks import Clock
+from instrumentation import metrics
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+# Priorities, from most to least urgent
+PRIORITY_CONTROL = 0 # temperature control
+PRIORITY_COMMAND = 1 # commands from the user
+PRIORITY_OPTICS = 2 # optical measurements
+
+PARK = None # yielded by a step to wait for the scheduler to be woken
+
+# Adaptive intervals
+INTERVAL_GROWTH = 2 # factor by which intervals lengthen while stable
+
+###############################################################################
+# FUTURES
+###############################################################################
+class Future(object):
+    """The eventual result of a task."""
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+    def set_exception(self, error):
+        self._error = error
+        self._done.set()
+    def done(self):
+        """Returns whether the task has finished."""
+        return self._done.is_set()
+    def result(self, timeout=None):
+        """Waits for the task to finish and returns its result.
+        Raises the exception which stopped the task, if there was one.
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Task did not finish within %s sec" % timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+###############################################################################
+# ADAPTIVE INTERVALS
+###############################################################################
+class AdaptiveInterval(object):
+    """The interval between measurements of a changing signal.
+    Each measurement is compared with the previous one. While all values
+    stay within their tolerances, the interval lengthens by INTERVAL_GROWTH;
+    when a value changes by more than its tolerance, the interval shortens in
+    proportion, so that fast changes are measured at about their tolerance.
+    Intervals are kept within bounds, and each change is logged.
+
+    Arguments:
+        name: the name of the measurement, used in the log
+        minimum: the shortest interval (in sec), used after a reset
+        maximum: the longest interval (in sec)
+        tolerances: the largest change of each value considered stable
+        verbose: whether to print each change of the interval
+    """
+    def __init__(self, name, minimum, maximum, tolerances, verbose=True):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerances = tolerances
+        self.verbose = verbose
+        self._lock = threading.Lock()
+        self.interval = minimum
+        self._previous = None
+    def _set(self, interval, reason):
+        interval = max(self.minimum, min(self.maximum, interval))
+        if interval != self.interval and self.verbose:
+            print("%s interval changed from %g to %g sec: %s." %
+                  (self.name.capitalize(), self.interval, interval, reason))
+        self.interval = interval
+    def reset(self, reason="reset"):
+        """Shortens the interval to its minimum, such as after a change of
+        the fermenter's actuators.
+        """
+        with self._lock:
+            self._previous = None
+            self._set(self.minimum, reason)
+    def update(self, values):
+        """Adapts the interval to a new measurement, and returns it."""
+        with self._lock:
+            if self._previous is not None:
+                change = max(abs(value - previous) / tolerance
+                             for (value, previous, tolerance)
+                             in zip(values, self._previous, self.tolerances))
+                if change <= 1:
+                    self._set(self.interval * INTERVAL_GROWTH, "stable")
+                else:
+                    self._set(self.interval / change, "changing")
+            self._previous = values
+            return self.interval
+
+###############################################################################
+# SCHEDULER
+###############################################################################
+class Task(object):
+    """A function or generator of steps scheduled with a priority.
+    The deadline is the time at which the task became ready to run its next
+    step; ready tasks of equal priority run in order of deadline.
+    """
+    def __init__(self, name, priority, steps=None, function=None, args=()):
+        self.name = name
+        self.priority = priority
+        self.steps = steps
+        self.function = function
+        self.args = args
+        self.future = Future()
+        self.deadline = None
+class Scheduler(object):
+    """Runs tasks which use a device, one step at a time, in one thread.
+    The scheduler thread is the only thread which may use the device.
+
+    Arguments:
+        device: the Arduino, or simulated Arduino, used by tasks
+        clock: the clock used for delays between steps
+    """
+    def __init__(self, device, clock=None):
+        self.device = device
+        self.clock = clock or Clock()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._sequence = itertools.count()
+        self._ready = [] # heap of (priority, deadline, sequence, task)
+        self._sleeping = [] # heap of (wake time, sequence, task)
+        self._parked = []
+        self._wakes = 0 # number of times the scheduler was woken
+        self.thread = Thread(target=self._run, name="scheduler")
+        self.thread.daemon = True
+    def start(self):
+        """Starts running tasks in the scheduler thread."""
+        self.thread.start()
+    def spawn(self, name, steps, priority):
+        """Schedules a generator of steps to run as soon as possible.
+        Returns a future which completes when the generator is exhausted.
+        """
+        task = Task(name, priority, steps=steps)
+        self._make_ready(task, self.clock.time())
+        return task.future
+    def call(self, function, args=(), priority=PRIORITY_COMMAND):
+        """Schedules a function to run as soon as possible.
+        Returns a future of the result of the function.
+        """
+        task = Task(function.__name__, priority, function=function, args=args)
+        self._make_ready(task, self.clock.time())
+        return task.future
+    def wake(self):
+        """Makes all parked tasks ready, such as after the fermenter starts."""
+        with self._lock:
+            self._wakes += 1
+            (parked, self._parked) = (self._parked, [])
+        now = self.clock.time()
+        for task in parked:
+            self._make_ready(task, now)
+    def _make_ready(self, task, deadline):
+        with self._lock:
+            task.deadline = deadline
+            heapq.heappush(self._ready, (task.priority, deadline,
+                                         next(self._sequence), task))
+        self._wakeup.set()
+    def _next_task(self):
+        """Returns the ready task to run next, or None after waiting a while."""
+        with self._lock:
+            now = self.clock.time()
+            while self._sleeping and self._sleeping[0][0] <= now:
+                (wake_time, sequence, task) = heapq.heappop(self._sleeping)
+                task.deadline = wake_time
+                heapq.heappush(self._ready, (task.priority, wake_time,
+                                             sequence, task))
+            if self._ready:
+                return heapq.heappop(self._ready)[-1]
+            timeout = None
+            if self._sleeping:
+                timeout = self._sleeping[0][0] - now
+            self._wakeup.clear()
+        self.clock.wait(self._wakeup, timeout)
+        return None
+    def _flush_writes(self):
+        # Devices which hold writes send them before the task waits
+        flush_writes = getattr(self.device, "flush_writes", None)
+        if flush_writes is not None:
+            flush_writes()
+    def _step(self, task):
+        """Runs the next step of a task and reschedules it as it asks."""
+        try:
+            if task.function is not None:
+                result = task.function(*task.args)
+                self._flush_writes()
+                task.future.set_result(result)
+                return
+            with self._lock:
+                wakes = self._wakes
+            try:
+                delay = next(task.steps)
+            finally:
+                self._flush_writes()
+        except StopIteration:
+            task.future.set_result(None)
+            return
+        except Exception as error:
+            print("Task %s failed:" % task.name)
+            traceback.print_exc()
+            task.future.set_exception(error)
+            return
+        with self._lock:
+            if delay is not PARK:
+                heapq.heappush(self._sleeping, (self.clock.time() + delay,
+                                                next(self._sequence), task))
+            elif self._wakes == wakes:
+                self._parked.append(task)
+            else:
+                # Woken while the step ran, so before it could be parked
+                task.deadline = self.clock.time()
+                heapq.heappush(self._ready, (task.priority, task.deadline,
+                                             next(self._sequence), task))
+    def run_until(self, done):
+        """Runs tasks in the calling thread until done() returns True.
+        This replaces starting the scheduler thread when the clock is virtual,
+        since a virtual clock only advances while the scheduler waits.
+        """
+        while not done():
+            self._run_next()
+    def _run(self):
+        while True:
+            self._run_next()
+    def _run_next(self):
+        task = self._next_task()
+        if task is None:
+            return
+        if not metrics.enabled:
+            self._step(task)
+            return
+        # Delays are in clock time, from when the task became ready
+        metrics.record("task %s delay" % task.name,
+                       self.clock.time() - task.deadline)
+        started = time.time()
+        self._step(task)
+        metrics.record("task %s step" % task.name, time.time() - started)
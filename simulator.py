@@ -0,0 +1,175 @@
+#!/usr/bin/env python2
+"""
+Simulates an Arduino-driven fermenter for runs without hardware.
+A device backend must provide the subset of the Arduino command API used by
+the fermenter: pinMode, digitalWrite, analogWrite and analogRead. It may also
+provide analogReadBatch, which replies to a batched read as the firmware does.
+"""
+
+import math
+import random
+import struct
+import threading
+import fermenter
+from clocks import Clock
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+# Serial link
+BITS_PER_BYTE = 10 # start bit, 8 data bits and stop bit
+BYTES_PER_COMMAND = 12 # typical length of a command and its reply
+FIRMWARE_OVERHEAD = 0.002 # (sec): time for the firmware to handle a command
+
+# Thermal model
+AMBIENT_TEMP = 22 # (deg C): temperature of the room
+INITIAL_TEMP = 22 # (deg C): temperature of the fluid at startup
+HEAT_CAPACITY = 2100 # (J/deg C): heat capacity of the fluid and vessel
+HEAT_LOSS_TEMP = 37 # (deg C): temperature at which fermenter.HEAT_LOSS applies
+TEMP_NOISE = 1.0 # (pin value): standard deviation of thermometer noise
+
+# Optical model
+INITIAL_OD = 0.05 # optical density of the culture at startup
+MAX_OD = 1.5 # carrying capacity of the culture, as an optical density
+MAX_GROWTH_RATE = 0.7 # (1/hour): specific growth rate at the optimal temp
+OPTIMAL_TEMP = 37 # (deg C): temperature of fastest growth
+GROWTH_TEMP_WIDTH = 4 # (deg C): width of the growth rate temperature response
+GREEN_OD_RATIO = 0.6 # green absorbance per unit of red optical density
+AMBIENT_LEVEL = 900 # (pin value): phototransistor reading in ambient light
+AMBIENT_DRIFT = 5 # (pin value): amplitude of slow ambient light variation
+AMBIENT_DRIFT_PERIOD = 20 # (sec): period of slow ambient light variation
+AMBIENT_NOISE = 3 # (pin value): standard deviation of ambient light noise
+LED_LEVELS = { # (pin value): reading decrease from each LED through water
+    "red": 600,
+    "green": 500,
+}
+
+# Sensor glitches
+OUTLIER_PROBABILITY = 0.01 # probability of any reading being wildly wrong
+OUTLIER_MAGNITUDE = 200 # (pin value): maximum deviation of a wrong reading
+
+# Constants
+ANALOG_MAX = 1023
+
+###############################################################################
+# STATELESS FUNCTIONS
+###############################################################################
+def serial_round_trip(baud_rate, nbytes=BYTES_PER_COMMAND):
+    """Returns the time (in sec) for a command and reply over a serial link."""
+    return nbytes * BITS_PER_BYTE / float(baud_rate) + FIRMWARE_OVERHEAD
+def temp_to_pin_val(temp):
+    """Returns the pin value representing the input deg C temperature."""
+    return (temp - 0.764) / 0.174
+def growth_rate(temp):
+    """Returns the specific growth rate (1/hour) of the culture at a temp."""
+    return MAX_GROWTH_RATE * math.exp(-((temp - OPTIMAL_TEMP) /
+                                        GROWTH_TEMP_WIDTH) ** 2)
+
+###############################################################################
+# DEVICES
+###############################################################################
+class SimulatedArduino(object):
+    """A simulated Arduino wired to a simulated fermenter.
+    The fluid temperature responds to the heater duty cycle through a
+    first-order model, with heat loss proportional to the difference from room
+    temperature and equal to fermenter.HEAT_LOSS at HEAT_LOSS_TEMP. The culture
+    grows logistically at a temperature-dependent rate, attenuating the LEDs
+    seen by the phototransistor, which responds through the low pass filter.
+    Every command holds the simulated serial link for the given latency.
+
+    Arguments:
+        clock: the clock driving the simulation and its latency
+        latency: the time (in sec) taken by each command
+        seed: the seed of the noise generator
+    """
+    def __init__(self, clock=None, latency=None, seed=None):
+        self.clock = clock or Clock()
+        if latency is None:
+            latency = serial_round_trip(fermenter.SERIAL_RATE)
+        self.latency = latency
+        self.random = random.Random(seed)
+        self.modes = {}
+        self.outputs = {}
+        self.temp = INITIAL_TEMP
+        self.od = INITIAL_OD
+        self._light = AMBIENT_LEVEL
+        self._last_update = self.clock.time()
+        self._link = threading.Lock()
+    def _command(self):
+        """Occupies the serial link and brings the simulation up to date."""
+        self.clock.sleep(self.latency)
+        self._update()
+    def _update(self):
+        """Brings the simulation up to the current time."""
+        now = self.clock.time()
+        self._advance(max(0, now - self._last_update))
+        self._last_update = now
+    def _advance(self, elapsed):
+        """Advances the physical state of the fermenter by elapsed seconds."""
+        heater = self.outputs.get(fermenter.ACTUATOR_PINS["heater"], 0)
+        heating = heater * fermenter.MAX_HEATING
+        loss_coefficient = (fermenter.HEAT_LOSS /
+                            (HEAT_LOSS_TEMP - AMBIENT_TEMP))
+        equilibrium = AMBIENT_TEMP + heating / loss_coefficient
+        tau = HEAT_CAPACITY / loss_coefficient
+        self.temp = (equilibrium + (self.temp - equilibrium) *
+                     math.exp(-elapsed / tau))
+        growth = math.exp(-growth_rate(self.temp) * elapsed / 3600)
+        self.od = MAX_OD / (1 + (MAX_OD / self.od - 1) * growth)
+        settling = math.exp(-elapsed / fermenter.LOW_PASS_FILTER_TAU)
+        self._light = (self._target_light() +
+                       (self._light - self._target_light()) * settling)
+    def _target_light(self):
+        """Returns the noiseless phototransistor reading for the LED states."""
+        light = AMBIENT_LEVEL + AMBIENT_DRIFT * math.sin(
+            2 * math.pi * self._last_update / AMBIENT_DRIFT_PERIOD)
+        absorbances = {"red": self.od, "green": self.od * GREEN_OD_RATIO}
+        for (color, level) in LED_LEVELS.items():
+            if self.outputs.get(fermenter.ACTUATOR_PINS[color + " led"], 0):
+                light -= level * 10 ** -absorbances[color]
+        return light
+    def _reading(self, value, noise):
+        """Returns a noisy, occasionally glitched, quantized pin reading."""
+        value += self.random.gauss(0, noise)
+        if self.random.random() < OUTLIER_PROBABILITY:
+            value += self.random.uniform(-OUTLIER_MAGNITUDE, OUTLIER_MAGNITUDE)
+        return int(max(0, min(ANALOG_MAX, round(value))))
+    def pinMode(self, pin, mode):
+        with self._link:
+            self._command()
+            self.modes[pin] = mode
+    def digitalWrite(self, pin, value):
+        with self._link:
+            self._command()
+            self.outputs[pin] = 1.0 if value == "HIGH" else 0.0
+    def analogWrite(self, pin, value):
+        with self._link:
+            self._command()
+            self.outputs[pin] = float(value) / fermenter.PWM_MAX
+    def _sample(self, pin):
+        """Returns a reading of an analog pin."""
+        if pin == fermenter.SENSOR_PINS["thermometer"]:
+            return self._reading(temp_to_pin_val(self.temp), TEMP_NOISE)
+        elif pin == fermenter.SENSOR_PINS["phototransistor"]:
+            return self._reading(self._light, AMBIENT_NOISE)
+        return 0
+    def analogRead(self, pin):
+        with self._link:
+            self._command()
+            return self._sample(pin)
+    def analogReadBatch(self, pin, nsamples, sample_interval):
+        """Reads a pin many times as the batch firmware command would.
+        Returns the raw reply of little-endian uint16 samples.
+        """
+        with self._link:
+            self._command()
+            samples = []
+            for i in range(nsamples):
+                if i != 0:
+                    self.clock.sleep(sample_interval)
+                    self._update()
+                samples.append(self._sample(pin))
+            self.clock.sleep(serial_round_trip(fermenter.SERIAL_RATE,
+                                               2 * nsamples) -
+                             FIRMWARE_OVERHEAD)
+            return struct.pack("<%dH" % nsamples, *samples)
@@ -65,9 +65,9 @@ function ambient_text(data) {
     return "Ambient light will be updated soon!";
   }
 }
-function red_text(red_calib, data) {
+function od_text(data) {
   if (data) {
-    return "OD: " + absorbance(red_calib, data[1]).toFixed(2);
+    return "OD: " + data[1].toFixed(3);
   } else {
     return "OD will be updated soon!";
   }
@@ -79,38 +79,336 @@ function green_text(green_calib, data) {
     return "Green absorbance will be updated soon!";
   }
 }
+function growth_rate_text(data) {
+  if (data) {
+    return "Growth rate: " + data[1].toFixed(3) + " /h";
+  } else {
+    return "Growth rate will be updated soon!";
+  }
+}
+function doubling_time_text(hours) {
+  if (hours) {
+    return "Doubling time: " + hours.toFixed(2) + " h";
+  } else {
+    return "Doubling time: not growing";
+  }
+}
+function phase_text(phase) {
+  if (phase) {
+    return "Growth phase: " + phase;
+  } else {
+    return "Growth phase will be updated soon!";
+  }
+}
+
+// Plot series
+var PLOT_RESYNC_POINTS = 4000; // local points per series before a resync
+var plot_series = {
+  generation: null,
+  calibration: {red: null, green: null},
+  cursors: {},
+  series: {
+    temp: [],
+    heater: [],
+    red: [],
+    green: [],
+    ambient: [],
+    impeller: []
+  }
+};
+var plot_windows = {}; // decimated windows shown in place of live plots
+// With ?plots=svg, plots are shown as images rendered by the server, which
+// are only fetched again when they change, instead of as charts drawn here
+var plot_images = /[?&]plots=svg(&|$)/.test(location.search);
+function plot_cursors() {
+  var cursors = {};
+  for (var channel in plot_series.series) {
+    cursors[channel] = plot_series.cursors[channel] || 0;
+  }
+  return cursors;
+}
+function unpack_floats(text) {
+  // Decodes base64 text of a little-endian float32 buffer into a typed array
+  var bytes = atob(text);
+  var view = new DataView(new ArrayBuffer(bytes.length));
+  for (var i = 0; i < bytes.length; i++) {
+    view.setUint8(i, bytes.charCodeAt(i));
+  }
+  var floats = new Float32Array(bytes.length / 4);
+  for (var i = 0; i < floats.length; i++) {
+    floats[i] = view.getFloat32(4 * i, true);
+  }
+  return floats;
+}
+function unpack_points(packed) {
+  // Returns the points of packed samples, whose times are relative to origin
+  var times = unpack_floats(packed.times);
+  var values = unpack_floats(packed.values);
+  var points = new Array(times.length);
+  for (var i = 0; i < times.length; i++) {
+    points[i] = [packed.origin + times[i], values[i]];
+  }
+  return points;
+}
+function merge_plot_update(msg) {
+  // Returns false if the update cannot be merged because samples are missing
+  if (msg.generation !== plot_series.generation) {
+    plot_series.generation = msg.generation;
+    plot_series.cursors = {};
+    for (var channel in plot_series.series) {
+      plot_series.series[channel] = [];
+    }
+  }
+  for (var channel in msg.series) {
+    if (msg.series[channel].from > (plot_series.cursors[channel] || 0)) {
+      return false;
+    }
+  }
+  for (var channel in msg.series) {
+    var update = msg.series[channel];
+    var cursor = plot_series.cursors[channel] || 0;
+    var points = update.packed ? unpack_points(update.packed) : update.points;
+    if (update.from === 0) {
+      // Snapshots may be decimated, so they replace the local series
+      plot_series.series[channel] = points.slice(0);
+    } else {
+      // Deltas are at full resolution, so overlapping points are skipped
+      var fresh = points.slice(cursor - update.from);
+      Array.prototype.push.apply(plot_series.series[channel], fresh);
+    }
+    plot_series.cursors[channel] = Math.max(cursor, update.to);
+  }
+  if (msg.calibration) {
+    plot_series.calibration = msg.calibration;
+  }
+  return true;
+}
+function plot_needs_snapshot() {
+  for (var channel in plot_series.series) {
+    if (plot_series.series[channel].length > PLOT_RESYNC_POINTS) {
+      return true;
+    }
+  }
+  return false;
+}
+function plot_data(plot) {
+  // Returns the series and calibration to draw for the specified plot
+  if (plot_windows[plot]) {
+    return plot_windows[plot];
+  }
+  return plot_series;
+}
+function join_series(first, second, join) {
+  // Merges two time-sorted series into rows, with null for missing values
+  var rows = [];
+  var i = 0;
+  var j = 0;
+  while (i < first.length || j < second.length) {
+    if (j >= second.length || (i < first.length && first[i][0] < second[j][0])) {
+      rows.push(join(first[i][0], first[i][1], null));
+      i++;
+    } else if (i >= first.length || second[j][0] < first[i][0]) {
+      rows.push(join(second[j][0], null, second[j][1]));
+      j++;
+    } else {
+      rows.push(join(first[i][0], first[i][1], second[j][1]));
+      i++;
+      j++;
+    }
+  }
+  return rows;
+}
+function nullable(f, value) {
+  return value === null ? null : f(value);
+}
+
+// Plots
+function draw_optics_plot() {
+  var plot = plot_data("optics");
+  var calib_red = plot.calibration.red;
+  var calib_green = plot.calibration.green;
+  var data = new google.visualization.DataTable();
+  data.addColumn('number', 'Time (h)');
+  data.addColumn('number', 'Green');
+  data.addColumn('number', 'Red (OD)');
+  data.addRows(join_series(plot.series.red, plot.series.green,
+                           function(time, red, green) {
+    return [time,
+            nullable(function(value) { return absorbance(calib_green, value); }, green),
+            nullable(function(value) { return absorbance(calib_red, value); }, red)];
+  }));
+  var options = {
+    chart: {title: 'Relative Absorbances'},
+    width: 600,
+    height: 310,
+    legend: {position: 'none'},
+    interpolateNulls: true,
+    series: {
+      0: {axis: 'Green'},
+      1: {axis: 'Red'}
+    },
+    axes: {
+      Green: {label: 'Green Absorbance'},
+      Red: {label: 'OD'},
+    },
+  };
+  var chart = new google.charts.Line(document.getElementById('optics_plot'));
+  chart.draw(data, options);
+}
+function draw_environ_plot() {
+  var data = new google.visualization.DataTable();
+  data.addColumn('number', 'Time (h)');
+  data.addColumn('number', 'Ambient Light');
+  data.addRows(plot_data("environ").series.ambient);
+  var options = {
+    chart: {title: 'Ambient Light'},
+    width: 600,
+    height: 310,
+    legend: {position: 'none'}
+  };
+  var chart = new google.charts.Line(document.getElementById('environ_plot'));
+  chart.draw(data, options);
+}
+function draw_temp_plot() {
+  var plot = plot_data("temp");
+  var data = new google.visualization.DataTable();
+  data.addColumn('number', 'Time (h)');
+  data.addColumn('number', 'Temperature (°C)');
+  data.addColumn('number', 'Heater Duty (Decimal)');
+  data.addRows(join_series(plot.series.temp, plot.series.heater,
+                           function(time, temp, heater) {
+    return [time, temp, heater];
+  }));
+  var options = {
+    chart: {title: 'Temperature Control'},
+    width: 600,
+    height: 310,
+    legend: {position: 'none'},
+    interpolateNulls: true,
+    series: {
+      0: {axis: 'Temp'},
+      1: {axis: 'Heater'}
+    },
+    axes: {
+      Temp: {label: 'Temperature (°C)'},
+      Heater: {label: 'Heater Duty Cycle'}
+    }
+  };
+  var chart = new google.charts.Line(document.getElementById('temp_plot'));
+  chart.draw(data, options);
+}
+function draw_impeller_plot() {
+  var data = new google.visualization.DataTable();
+  data.addColumn('number', 'Time (h)');
+  data.addColumn('number', 'Impeller Duty (Decimal)');
+  data.addRows(plot_data("impeller").series.impeller);
+  var options = {
+    chart: {title: 'Impeller Duty'},
+    width: 600,
+    height: 310,
+    legend: {position: 'none'}
+  };
+  var chart = new google.charts.Line(document.getElementById('impeller_plot'));
+  chart.draw(data, options);
+}
+
+function plot_image_url(vessel, plot, etag) {
+  // Each version of a plot has its own URL, so the image is only fetched once
+  // it changes
+  var url = "/vessels/" + encodeURIComponent(vessel) + "/plots/" + plot;
+  return etag ? url + "?etag=" + encodeURIComponent(etag) : url;
+}
+function show_plot_images(vessel) {
+  for (var plot in {temp: 0, optics: 0, impeller: 0, environ: 0}) {
+    $('#' + plot + '_plot').empty().append(
+      $('<img>').attr("id", plot + "_image")
+                .attr("src", plot_image_url(vessel, plot)));
+  }
+}
 
-google.load('visualization', '1.1', {packages: ['line']});
+if (!plot_images) {
+  google.load('visualization', '1.1', {packages: ['line']});
+}
 
 $(document).ready(function() {
 
   // Set up socket
   namespace = "/socket";
   var socket = io.connect("http://" + document.domain + ":" + location.port + namespace);
+  // The dashboard of a vessel is served at /vessels/<vessel id>
+  var vessel = decodeURIComponent(location.pathname.split("/")[2] || "");
+  function emit(event, msg) {
+    msg.vessel = vessel;
+    socket.emit(event, msg);
+  }
+  // Broadcast updates arrive as JSON text to acknowledge once handled, so
+  // that the server sends the next one; direct replies arrive as objects
+  function for_vessel(handler) {
+    return function(msg, acknowledge) {
+      if (typeof msg === "string") {
+        msg = JSON.parse(msg);
+      }
+      if (msg.vessel === vessel) {
+        handler(msg);
+      }
+      if (typeof acknowledge === "function") {
+        acknowledge();
+      }
+    };
+  }
+  function resync_plots() {
+    emit("plots resync", {
+      generation: plot_series.generation,
+      cursors: plot_cursors()
+    });
+  }
+  function resync_plot_snapshots() {
+    emit("plots resync", {generation: null, cursors: {}});
+  }
   socket.on("connect", function() {
     socket.emit("socket event", {data: "Successful connection!"});
+    if (plot_images) {
+      emit("dashboard subscribe", {plots: "svg"});
+    } else {
+      emit("dashboard subscribe", {});
+      resync_plots();
+    }
+  });
+  $('#vessel').text("Vessel: " + vessel);
+  if (plot_images) {
+    show_plot_images(vessel);
+    $('#plot_mode').append($('<a>').attr("href", location.pathname)
+                                   .text("Show interactive charts"));
+  } else {
+    $('#plot_mode').append($('<a>').attr("href", "?plots=svg")
+                                   .text("Show plots as images"));
+  }
+  $.getJSON("/vessels", function(msg) {
+    $.each(msg.vessels, function(i, vessel_id) {
+      $('#vessels').append($('<a>').attr("href", "/vessels/" + encodeURIComponent(vessel_id)).text(vessel_id)).append(" ");
+    });
   });
 
   // Emit events
   $('form#startbutton').submit(function(event) {
-    socket.emit("fermenter start", {});
+    emit("fermenter start", {});
     return false;
   });
   $('form#stopbutton').submit(function(event) {
-    socket.emit("fermenter stop", {});
+    emit("fermenter stop", {});
     return false;
   });
   $('form#impellermenu').change(function(event) {
-    socket.emit("impeller set", {data: $('#impellerduty').val()});
+    emit("impeller set", {data: $('#impellerduty').val()});
     return false;
   });
   $('form#recalibrate').submit(function(event) {
-    socket.emit("recalibrate optics", {});
+    emit("recalibrate optics", {});
     return false;
   });
 
   // Receive events
-  socket.on("stats update", function(msg) {
+  socket.on("stats update", for_vessel(function(msg) {
     $("#start").text(start_text(msg.start));
     $("#stop").text(stop_text(msg.stop, msg.since));
     $("#now").text(now_text(msg.now));
@@ -120,86 +418,56 @@ $(document).ready(function() {
     $('#heater').text(heater_text(msg.heater));
     $('#optics_update_time').text(time_text(msg.optics.ambient));
     $('#ambient').text(ambient_text(msg.optics.ambient));
-    $('#red').text(red_text(msg.optics.calibration.red, msg.optics.red));
+    $('#red').text(od_text(msg.optics.od));
     $('#green').text(green_text(msg.optics.calibration.green, msg.optics.green));
-  });
-  socket.on("optics plot update", function(msg) {
-    var calib_red = msg.calibration.red;
-    var calib_green = msg.calibration.green;
-    var data = new google.visualization.DataTable();
-    data.addColumn('number', 'Time (h)');
-    data.addColumn('number', 'Green');
-    data.addColumn('number', 'Red (OD)');
-    data.addRows(msg.redgreen.map(function(curr) {
-      return [curr[0], absorbance(calib_green, curr[2]), absorbance(calib_red, curr[1])];
-    }));
-    var options = {
-      chart: {title: 'Relative Absorbances'},
-      width: 600,
-      height: 310,
-      legend: {position: 'none'},
-      series: {
-        0: {axis: 'Green'},
-        1: {axis: 'Red'}
-      },
-      axes: {
-        Green: {label: 'Green Absorbance'},
-        Red: {label: 'OD'},
-      },
-    };
-    var chart = new google.charts.Line(document.getElementById('optics_plot'));
-    chart.draw(data, options);
-  });
-  socket.on("environ plot update", function(msg) {
-    var data = new google.visualization.DataTable();
-    data.addColumn('number', 'Time (h)');
-    data.addColumn('number', 'Ambient Light');
-    data.addRows(msg.ambient);
-    var options = {
-      chart: {title: 'Ambient Light'},
-      width: 600,
-      height: 310,
-      legend: {position: 'none'}
-    };
-    var chart = new google.charts.Line(document.getElementById('environ_plot'));
-    chart.draw(data, options);
-  });
-  socket.on("temp plot update", function(msg) {
-    var data = new google.visualization.DataTable();
-    data.addColumn('number', 'Time (h)');
-    data.addColumn('number', 'Temperature (°C)');
-    data.addColumn('number', 'Heater Duty (Decimal)');
-    data.addRows(msg.tempheater);
-    var options = {
-      chart: {title: 'Temperature Control'},
-      width: 600,
-      height: 310,
-      legend: {position: 'none'},
-      series: {
-        0: {axis: 'Temp'},
-        1: {axis: 'Heater'}
-      },
-      axes: {
-        Temp: {label: 'Temperature (°C)'},
-        Heater: {label: 'Heater Duty Cycle'}
+    $('#growth_rate').text(growth_rate_text(msg.growth.rate));
+    $('#doubling_time').text(doubling_time_text(msg.growth.doubling_time));
+    $('#phase').text(phase_text(msg.growth.phase));
+  }));
+  var plot_draws = {
+    optics: draw_optics_plot,
+    environ: draw_environ_plot,
+    temp: draw_temp_plot,
+    impeller: draw_impeller_plot
+  };
+  function on_plot_update(draw) {
+    return for_vessel(function(msg) {
+      if (!merge_plot_update(msg)) {
+        resync_plots();
+      } else if (plot_needs_snapshot()) {
+        resync_plot_snapshots();
+      } else {
+        draw();
       }
-    };
-    var chart = new google.charts.Line(document.getElementById('temp_plot'));
-    chart.draw(data, options);
-  });
-  socket.on("impeller plot update", function(msg) {
-    var data = new google.visualization.DataTable();
-    data.addColumn('number', 'Time (h)');
-    data.addColumn('number', 'Impeller Duty (Decimal)');
-    data.addRows(msg.impeller);
-    var options = {
-      chart: {title: 'Impeller Duty'},
-      width: 600,
-      height: 310,
-      legend: {position: 'none'}
-    };
-    var chart = new google.charts.Line(document.getElementById('impeller_plot'));
-    chart.draw(data, options);
-  });
+    });
+  }
+  // Zoom a plot to a time window (in hours after start), or back to live data
+  window.request_plot_window = function(plot, t0, t1, points, method) {
+    emit("plot window request", {
+      plot: plot, t0: t0, t1: t1, points: points, method: method
+    });
+  };
+  window.reset_plot_window = function(plot) {
+    delete plot_windows[plot];
+    plot_draws[plot]();
+  };
+  socket.on("plot window", for_vessel(function(msg) {
+    if (!msg.calibration) {
+      msg.calibration = plot_series.calibration;
+    }
+    plot_windows[msg.plot] = msg;
+    plot_draws[msg.plot]();
+  }));
+  socket.on("optics plot update", on_plot_update(draw_optics_plot));
+  socket.on("environ plot update", on_plot_update(draw_environ_plot));
+  socket.on("temp plot update", on_plot_update(draw_temp_plot));
+  socket.on("impeller plot update", on_plot_update(draw_impeller_plot));
+  function on_plot_image_update(msg) {
+    $('#' + msg.plot + '_image').attr(
+      "src", plot_image_url(vessel, msg.plot, msg.etag));
+  }
+  socket.on("temp plot image update", for_vessel(on_plot_image_update));
+  socket.on("optics plot image update", for_vessel(on_plot_image_update));
+  socket.on("environ plot image update", for_vessel(on_plot_image_update));
+  socket.on("impeller plot image update", for_vessel(on_plot_image_update));
 });
-
@@ -0,0 +1,339 @@
+#!/usr/bin/env python2
+"""
+Supervises many fermenter vessels from one host.
+Each vessel runs its fermenter in its own worker process, so that vessels do
+not contend for one interpreter lock. Workers publish newly recorded samples
+to the supervising process over a pipe, and the supervisor mirrors them into
+records which the dashboard reads as if the fermenter ran in-process. Commands
+are sent to workers over another pipe.
+"""
+
+import os
+import glob
+import time
+import argparse
+import threading
+import multiprocessing
+from threading import Thread
+from collections import OrderedDict
+import numpy as np
+import fermenter
+import dashboard
+from instrumentation import metrics
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+PORT_PATTERNS = ("/dev/ttyACM*", "/dev/ttyUSB*") # serial ports of Arduinos
+PUBLISH_INTERVAL = 1 # (sec): time to wait between publishing samples
+RECEIVE_INTERVAL = 0.2 # (sec): time to wait between polling for samples
+IMPELLER_EXTEND_INTERVAL = 10 # (sec): time between extending impeller series
+METRICS_PUBLISH_INTERVAL = 10 # (sec): time between publishing worker metrics
+
+###############################################################################
+# STATELESS FUNCTIONS
+###############################################################################
+def discover_ports(patterns=PORT_PATTERNS):
+    """Returns the serial ports at which Arduinos may be connected."""
+    ports = []
+    for pattern in patterns:
+        ports.extend(sorted(glob.glob(pattern)))
+    return ports
+def port_vessel_id(port):
+    """Returns the id of the vessel driven through a serial port."""
+    return os.path.basename(port)
+def vessel_log_path(log_path, vessel_id):
+    """Returns the path of the run log or sensor capture of a vessel, derived
+    from a path shared by all vessels, or None for no file.
+    """
+    if not log_path:
+        return None
+    (root, extension) = os.path.splitext(log_path)
+    return "%s-%s%s" % (root, vessel_id, extension)
+
+###############################################################################
+# WORKERS
+###############################################################################
+def handle_command(scheduler, records, locks, events, command, args):
+    """Carries out a command sent to a worker by the supervisor."""
+    if command == "start":
+        if events["fermenter idle"].is_set():
+            events["fermenter idle"].clear()
+            fermenter.start_fermenter(scheduler, records, locks,
+                                      events["fermenter idle"])
+    elif command == "stop":
+        if not events["fermenter idle"].is_set():
+            events["fermenter idle"].set()
+            fermenter.stop_fermenter(scheduler, records, locks,
+                                     events["fermenter idle"])
+    elif command == "impeller":
+        fermenter.set_impeller_duty(scheduler, records, locks, args[0])
+    elif command == "recalibrate":
+        events["calibrate"].set()
+    elif command == "metrics enable":
+        metrics.enable(args[0])
+    elif command == "metrics reset":
+        metrics.reset()
+    else:
+        print("Unknown command %s." % command)
+class VesselPublisher(object):
+    """Tracks the samples of a worker already published to the supervisor.
+    Samples are indexed by their index plus the offset of their series, as
+    for dashboard.plot_update, so compaction does not republish them.
+    """
+    def __init__(self):
+        self.generation = None
+        self.cursors = {}
+        self.raw_starts = {}
+    def update(self, records, locks, events, extend_impeller=False):
+        """Returns an update message with the samples appended since the
+        previous update. Each series in the message is a tuple of the index of
+        its first sample and arrays of sample times and values. Series
+        compacted since the previous update also have a history in the
+        message: a tuple of their offset and the times, values, minimums,
+        maximums and counts of their rolled-up samples.
+        """
+        if extend_impeller:
+            dashboard.take_plot_views(records, locks, extend_impeller=True)
+        snapshot = fermenter.records_snapshot(records)
+        (generation, calibration, views) = (snapshot.generation,
+                                            snapshot.calibration,
+                                            snapshot.series)
+        (start, stop) = (snapshot.start, snapshot.stop)
+        if generation != self.generation:
+            self.generation = generation
+            self.cursors = {}
+            self.raw_starts = {}
+        update = {
+            "generation": generation,
+            "start": start,
+            "stop": stop,
+            "calibration": calibration,
+            "phase": snapshot.phase,
+            "idle": events["fermenter idle"].is_set(),
+            "calibrate": events["calibrate"].is_set(),
+            "series": {},
+            "history": {},
+            "metrics": None,
+        }
+        for (channel, (times, values)) in views.items():
+            offset = snapshot.offsets[channel]
+            (mins, maxs, counts) = snapshot.history[channel]
+            # The index of the first sample at full resolution grows with
+            # each compaction
+            raw_start = offset + len(counts)
+            if raw_start != self.raw_starts.get(channel, 0):
+                rolled = len(counts)
+                update["history"][channel] = (
+                    offset, np.array(times[:rolled]),
+                    np.array(values[:rolled]), np.array(mins),
+                    np.array(maxs), np.array(counts))
+                self.raw_starts[channel] = raw_start
+            begin = max(self.cursors.get(channel, 0), raw_start)
+            end = offset + len(times)
+            if end > begin:
+                update["series"][channel] = (
+                    begin, np.array(times[begin - offset:]),
+                    np.array(values[begin - offset:]))
+                self.cursors[channel] = end
+        return update
+def run_worker(commands, updates, log_path, backend, time_scale,
+               backend_options, metrics_enabled, capture_path=None,
+               raw_retention=fermenter.RAW_RETENTION):
+    """Runs a fermenter and serves its supervisor until the process exits.
+
+    Arguments:
+        commands: the receiving end of the pipe of commands
+        updates: the sending end of the pipe of updates
+    """
+    metrics.enable(metrics_enabled)
+    (scheduler, records, locks, events, _) = fermenter.run_fermenter(
+        log_path, backend, time_scale, capture_path, raw_retention,
+        **backend_options)
+    publisher = VesselPublisher()
+    last_extended = last_metrics = fermenter.clock.time()
+    while True:
+        if commands.poll(PUBLISH_INTERVAL):
+            (command, args) = commands.recv()
+            handle_command(scheduler, records, locks, events, command, args)
+        now = fermenter.clock.time()
+        extend_impeller = now - last_extended >= IMPELLER_EXTEND_INTERVAL
+        if extend_impeller:
+            last_extended = now
+        update = publisher.update(records, locks, events, extend_impeller)
+        if metrics.enabled and now - last_metrics >= METRICS_PUBLISH_INTERVAL:
+            update["metrics"] = metrics.summaries()
+            last_metrics = now
+        updates.send(update)
+
+###############################################################################
+# VESSELS
+###############################################################################
+class Vessel(object):
+    """A fermenter run by a worker process, as seen from the supervisor.
+    The records, locks and events mirror those of the worker's fermenter, so
+    they may be read like those of a fermenter run in-process; they must only
+    be changed by sending commands.
+
+    Arguments:
+        vessel_id: the name of the vessel
+        log_path: the path of the run log of the vessel, or None for no log
+        backend: the name of the device backend in fermenter.BACKENDS
+        time_scale: the factor by which to run faster than real time
+        backend_options: keyword arguments passed to the backend
+        capture_path: the path of the sensor capture of the vessel, or None
+            to not capture sensor samples
+        raw_retention: the time (in hours) for which the worker keeps samples
+            at full resolution, or None to keep all samples
+    """
+    def __init__(self, vessel_id, log_path, backend, time_scale,
+                 backend_options, capture_path=None,
+                 raw_retention=fermenter.RAW_RETENTION):
+        self.id = vessel_id
+        self.log_path = log_path
+        self.records = fermenter.construct_records()
+        self.locks = fermenter.construct_locks()
+        self.events = fermenter.construct_events()
+        self.metrics = None # latest summaries published by the worker
+        self._generation = None
+        self._send_lock = threading.Lock()
+        (worker_commands, self._commands) = multiprocessing.Pipe(False)
+        (self._updates, worker_updates) = multiprocessing.Pipe(False)
+        self.process = multiprocessing.Process(
+            target=run_worker, name="vessel " + vessel_id,
+            args=(worker_commands, worker_updates, log_path, backend,
+                  time_scale, backend_options, metrics.enabled,
+                  capture_path, raw_retention))
+        self.process.daemon = True
+        self.thread = Thread(target=self._receive, name="vessel " + vessel_id)
+        self.thread.daemon = True
+    def start(self):
+        """Starts the worker process and mirroring of its records."""
+        self.process.start()
+        self.thread.start()
+    def send(self, command, *args):
+        """Sends a command to the worker, without waiting for it to finish."""
+        with self._send_lock:
+            self._commands.send((command, args))
+    def apply(self, update):
+        """Mirrors an update message published by the worker."""
+        with self.locks["records"]:
+            series = self.records["series"]
+            if update["generation"] != self._generation:
+                series.clear()
+                self._generation = update["generation"]
+            self.records["start"] = update["start"]
+            self.records["stop"] = update["stop"]
+            self.records["optics"]["calibration"].update(
+                update["calibration"])
+            self.records["growth"]["phase"] = update["phase"]
+            for (channel, history) in update["history"].items():
+                # Roll up the mirrored samples as the worker did
+                (offset, times, values, mins, maxs, counts) = history
+                begin = offset + len(counts) - series[channel].offset
+                series[channel].compact(begin, times, values, mins, maxs,
+                                        counts)
+            for (channel, (begin, times, values)) in update["series"].items():
+                if begin != series[channel].offset + len(series[channel]):
+                    print("Vessel %s skipped samples of %s." %
+                          (self.id, channel))
+                series[channel].extend(times, values)
+            fermenter.publish_records(self.records)
+        for (event, state) in (("fermenter idle", update["idle"]),
+                               ("calibrate", update["calibrate"])):
+            if state:
+                self.events[event].set()
+            else:
+                self.events[event].clear()
+        if update["metrics"] is not None:
+            self.metrics = update["metrics"]
+    def _receive(self):
+        # Polling keeps the thread cooperative under gevent
+        while True:
+            try:
+                while self._updates.poll():
+                    self.apply(self._updates.recv())
+            except EOFError:
+                print("Vessel %s stopped." % self.id)
+                return
+            time.sleep(RECEIVE_INTERVAL)
+def vessel_specs(args):
+    """Returns the id and backend options of each vessel to run."""
+    if args.backend == "simulated":
+        return [("sim%d" % i, {"latency": args.latency, "seed": i})
+                for i in range(args.vessels)]
+    ports = list(args.port or [])
+    if args.discover:
+        ports.extend(port for port in discover_ports() if port not in ports)
+    if not ports:
+        ports = [fermenter.ARDUINO_PORT]
+    return [(port_vessel_id(port), {"port": port}) for port in ports]
+def run_vessels(specs, log_path=fermenter.RUN_LOG_PATH,
+                backend=fermenter.DEFAULT_BACKEND, time_scale=1,
+                capture_path=None, raw_retention=fermenter.RAW_RETENTION):
+    """Starts a worker process for each vessel.
+    Returns the vessels, keyed by id, in the order of their specs.
+
+    Arguments:
+        specs: a list of the id and backend options of each vessel
+        log_path: the path from which the run log path of each vessel is
+            derived, or None to not log runs
+        capture_path: the path from which the sensor capture path of each
+            vessel is derived, or None to not capture sensor samples
+        raw_retention: the time (in hours) for which samples are kept at full
+            resolution, or None to keep all samples
+    """
+    fermenter.set_clock(time_scale)
+    vessels = OrderedDict()
+    for (vessel_id, backend_options) in specs:
+        vessels[vessel_id] = Vessel(vessel_id,
+                                    vessel_log_path(log_path, vessel_id),
+                                    backend, time_scale, backend_options,
+                                    vessel_log_path(capture_path, vessel_id),
+                                    raw_retention)
+    for vessel in vessels.values():
+        vessel.start()
+    return vessels
+
+###############################################################################
+# MAIN
+###############################################################################
+def parse_args(description):
+    """Returns the command-line options for supervising vessels."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--backend", choices=sorted(fermenter.BACKENDS.keys()),
+                        default=fermenter.DEFAULT_BACKEND,
+                        help="the device backend to use")
+    parser.add_argument("--port", action="append",
+                        help="the serial port of an Arduino; may be repeated")
+    parser.add_argument("--discover", action="store_true",
+                        help="also run a vessel at each serial port found")
+    parser.add_argument("--vessels", type=int, default=1,
+                        help="number of vessels to simulate")
+    parser.add_argument("--time-scale", type=float, default=1,
+                        help="factor by which simulated runs are sped up")
+    parser.add_argument("--latency", type=float, default=None,
+                        help="serial round-trip time (sec) of simulated runs")
+    parser.add_argument("--log", default=fermenter.RUN_LOG_PATH,
+                        help="path from which run log paths are derived")
+    parser.add_argument("--capture", default=None,
+                        help="path from which paths of sensor captures for "
+                        "replay are derived")
+    parser.add_argument("--retention", type=fermenter.parse_retention,
+                        default=fermenter.RAW_RETENTION,
+                        help="hours for which samples are kept in memory at "
+                        "full resolution before being rolled up; 0 or inf "
+                        "keeps all samples at full resolution")
+    parser.add_argument("--metrics", action="store_true",
+                        help="record hot path metrics from startup")
+    parser.add_argument("--http-port", type=int, default=80,
+                        help="the port at which the dashboard is served")
+    parser.add_argument("--packed-plots", action="store_true",
+                        help="send plot updates to dashboards as packed "
+                        "float32 arrays")
+    return parser.parse_args()
+def run_vessels_from_args(args):
+    """Runs the vessels specified by command-line options."""
+    metrics.enable(args.metrics)
+    return run_vessels(vessel_specs(args), args.log, args.backend,
+                       args.time_scale, args.capture, args.retention)
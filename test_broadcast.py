@@ -0,0 +1,108 @@
+#!/usr/bin/env python2
+"""
+Regression tests of the dashboard broadcast hub.
+"""
+
+import threading
+import unittest
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+import broadcast
+
+TIMEOUT = 5 # (sec): time to wait for a sender thread
+
+class RecordingClient(object):
+    """A client which records the frames sent to it and only acknowledges
+    them when told to.
+    """
+    def __init__(self):
+        self.frames = queue.Queue()
+        self.acknowledges = []
+    def send(self, event, frame, acknowledge):
+        self.acknowledges.append(acknowledge)
+        self.frames.put((event, frame))
+    def receive(self):
+        return self.frames.get(timeout=TIMEOUT)
+    def acknowledge(self):
+        self.acknowledges.pop(0)()
+
+class BroadcastHubTest(unittest.TestCase):
+    def setUp(self):
+        self.encodings = []
+        self.hub = broadcast.BroadcastHub(self.encode)
+    def tearDown(self):
+        for key in ("a", "b"):
+            self.hub.unsubscribe(key)
+    def encode(self, message):
+        self.encodings.append(message)
+        return broadcast.encode_json(message)
+    def test_frames_are_encoded_once_per_topic(self):
+        clients = [RecordingClient(), RecordingClient()]
+        self.hub.subscribe("a", clients[0].send, ["vessel"])
+        self.hub.subscribe("b", clients[1].send, ["vessel", "other"])
+        self.assertEqual(self.hub.publish("stats", {"temp": 37}, "vessel"), 2)
+        self.assertEqual(self.hub.publish("other", {"temp": 36}, "other"), 1)
+        self.assertEqual(len(self.encodings), 2)
+        frames = [client.receive() for client in clients]
+        self.assertIs(frames[0][1], frames[1][1])
+        self.assertEqual(frames[0], ("stats", '{"temp":37}'))
+        clients[1].acknowledge()
+        self.assertEqual(clients[1].receive(), ("other", '{"temp":36}'))
+        self.assertTrue(clients[0].frames.empty())
+    def test_slow_client_skips_to_latest_frame(self):
+        client = RecordingClient()
+        self.hub.subscribe("a", client.send, ["vessel"])
+        self.hub.publish("stats", 0, "vessel")
+        self.assertEqual(client.receive(), ("stats", "0"))
+        # Frames published before the client acknowledges wait in its
+        # mailbox, where only the latest frame of each event is kept
+        for value in range(1, 4):
+            self.hub.publish("stats", value, "vessel")
+        self.hub.publish("plots", "p", "vessel")
+        self.assertTrue(client.frames.empty())
+        client.acknowledge()
+        self.assertEqual(client.receive(), ("stats", "3"))
+        client.acknowledge()
+        self.assertEqual(client.receive(), ("plots", '"p"'))
+        subscriber = self.hub._subscribers["a"]
+        self.assertEqual(subscriber.dropped, 2)
+    def test_slow_client_does_not_hold_up_others(self):
+        (slow, fast) = (RecordingClient(), RecordingClient())
+        self.hub.subscribe("a", slow.send, ["vessel"])
+        self.hub.subscribe("b", fast.send, ["vessel"])
+        for value in range(3):
+            self.hub.publish("stats", value, "vessel")
+            self.assertEqual(fast.receive(), ("stats", str(value)))
+            fast.acknowledge()
+        # The slow client was sent one frame, which may have been replaced
+        # by a later one before it was sent
+        (event, frame) = slow.receive()
+        self.assertEqual(event, "stats")
+        self.assertTrue(slow.frames.empty())
+        if frame != "2":
+            slow.acknowledge()
+            self.assertEqual(slow.receive(), ("stats", "2"))
+    def test_failed_send_closes_subscriber(self):
+        failed = threading.Event()
+        def send(event, frame, acknowledge):
+            failed.set()
+            raise IOError("disconnected")
+        self.hub.subscribe("a", send, ["vessel"])
+        self.hub.publish("stats", 0, "vessel")
+        self.assertTrue(failed.wait(TIMEOUT))
+        subscriber = self.hub._subscribers["a"]
+        subscriber._thread.join(TIMEOUT)
+        self.assertTrue(subscriber.closed)
+    def test_resubscribing_replaces_subscription(self):
+        (old, new) = (RecordingClient(), RecordingClient())
+        self.hub.subscribe("a", old.send, ["vessel"])
+        self.hub.subscribe("a", new.send, ["vessel"])
+        self.assertEqual(self.hub.subscriber_count(), 1)
+        self.hub.publish("stats", 0, "vessel")
+        self.assertEqual(new.receive(), ("stats", "0"))
+        self.assertTrue(old.frames.empty())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python2
+"""
+Regression tests of the feedback controllers.
+"""
+
+import unittest
+from control import PIDController
+
+class PIDControllerTest(unittest.TestCase):
+    def test_proportional_output_around_feed_forward(self):
+        pid = PIDController(37.5, kp=0.5, feed_forward=0.6)
+        self.assertAlmostEqual(pid.update(37.5, 1), 0.6)
+        self.assertAlmostEqual(pid.update(37.3, 1), 0.7)
+        self.assertAlmostEqual(pid.update(37.9, 1), 0.4)
+        self.assertEqual(pid.update(30, 1), 1)
+        self.assertEqual(pid.update(45, 1), 0)
+    def test_integral_does_not_wind_up_while_saturated(self):
+        pid = PIDController(37.5, kp=1, ki=0.01, feed_forward=0.6)
+        for _ in range(1000):
+            self.assertEqual(pid.update(25, 1), 1)
+        self.assertEqual(pid.integral, 0)
+        # Once back at the setpoint, the output does not overshoot
+        self.assertAlmostEqual(pid.update(37.5, 1), 0.6)
+    def test_integral_is_limited_to_output_range(self):
+        pid = PIDController(37.5, kp=0, ki=0.01, feed_forward=0.6)
+        for _ in range(1000):
+            pid.update(37.4, 1)
+        self.assertAlmostEqual(pid.integral, 0.4)
+        self.assertEqual(pid.output, 1)
+        # The integral unwinds as soon as the error changes sign
+        pid.update(37.6, 1)
+        self.assertLess(pid.integral, 0.4)
+        self.assertLess(pid.update(37.6, 1), 1)
+    def test_integral_removes_offset(self):
+        # A first-order plant whose heat loss is higher than fed forward
+        pid = PIDController(37.5, kp=0.5, ki=0.5 / 600, feed_forward=0.6)
+        temp = 37.5
+        for _ in range(20000):
+            duty = pid.update(temp, 1)
+            temp += 0.01 * (duty - 0.7)
+        self.assertAlmostEqual(temp, 37.5, places=3)
+        self.assertAlmostEqual(pid.integral, 0.1, places=3)
+    def test_derivative_ignores_setpoint_changes(self):
+        pid = PIDController(37.5, kp=0, kd=10, feed_forward=0.5)
+        pid.update(37.5, 1)
+        pid.setpoint = 38.5
+        self.assertAlmostEqual(pid.update(37.5, 1), 0.5)
+        # A rising measurement is damped
+        self.assertLess(pid.update(37.51, 1), 0.5)
+    def test_reset_forgets_integral(self):
+        pid = PIDController(37.5, kp=0, ki=0.01, feed_forward=0.5)
+        for _ in range(10):
+            pid.update(37.0, 1)
+        self.assertGreater(pid.integral, 0)
+        pid.reset()
+        self.assertEqual(pid.integral, 0)
+        self.assertAlmostEqual(pid.update(37.5, 1), 0.5)
+
+if __name__ == "__main__":
+    unittest.main()
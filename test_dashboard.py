@@ -0,0 +1,105 @@
+#!/usr/bin/env python2
+"""
+Regression tests of the delta streaming of dashboard plots.
+"""
+
+import base64
+import unittest
+import numpy as np
+import fermenter
+import dashboard
+import retention
+
+class PlotUpdatesTest(unittest.TestCase):
+    def setUp(self):
+        self.records = fermenter.construct_records()
+        self.locks = fermenter.construct_locks()
+        self.broadcaster = dashboard.PlotBroadcaster(extend_impeller=False)
+        self.append("temp", np.arange(0, 10, 0.5), 37.0)
+        self.append("heater", np.arange(0, 10, 0.5), 0.6)
+    def append(self, channel, times, value):
+        series = self.records["series"]
+        for time in times:
+            series.append(channel, time, value)
+        fermenter.publish_records(self.records)
+    def updates(self):
+        return dict(self.broadcaster.updates(self.records, self.locks))
+    def test_first_update_is_snapshot(self):
+        updates = self.updates()
+        # The optics plot is also sent its calibration
+        self.assertEqual(sorted(updates),
+                         ["optics plot update", "temp plot update"])
+        series = updates["temp plot update"]["series"]
+        self.assertEqual((series["temp"]["from"], series["temp"]["to"]),
+                         (0, 20))
+        self.assertEqual(len(series["temp"]["points"]), 20)
+    def test_later_updates_hold_appended_samples(self):
+        self.updates()
+        self.assertEqual(self.updates(), {})
+        self.append("temp", [10, 10.5], 37.5)
+        update = self.updates()["temp plot update"]
+        self.assertEqual(update["series"]["temp"],
+                         {"from": 20, "to": 22,
+                          "points": [[10, 37.5], [10.5, 37.5]]})
+        self.assertEqual(update["series"]["heater"],
+                         {"from": 20, "to": 20, "points": []})
+    def test_clear_restarts_from_snapshot(self):
+        self.updates()
+        fermenter.reinitialize_records(self.records)
+        self.append("temp", [0, 1], 37.0)
+        update = self.updates()["temp plot update"]
+        self.assertEqual(update["generation"], 1)
+        self.assertEqual(update["series"]["temp"]["from"], 0)
+        self.assertEqual(len(update["series"]["temp"]["points"]), 2)
+    def test_resync_continues_from_client_cursors(self):
+        message = {"generation": 0, "cursors": {"temp": 18, "heater": 20}}
+        updates = dict(dashboard.resync_updates(self.records, self.locks,
+                                                message))
+        series = updates["temp plot update"]["series"]
+        self.assertEqual(series["temp"]["points"], [[9, 37.0], [9.5, 37.0]])
+        self.assertEqual(series["heater"]["points"], [])
+        # Cursors of another generation are ignored
+        message["generation"] = 1
+        updates = dict(dashboard.resync_updates(self.records, self.locks,
+                                                message))
+        series = updates["temp plot update"]["series"]
+        self.assertEqual(series["temp"]["from"], 0)
+        self.assertEqual(len(series["temp"]["points"]), 20)
+    def test_cursors_survive_compaction(self):
+        self.append("temp", np.arange(10, 20, 0.5), 37.0)
+        self.append("heater", np.arange(10, 20, 0.5), 0.6)
+        self.updates()
+        snapshot = fermenter.records_snapshot(self.records)
+        rollups = {}
+        for channel in ("temp", "heater"):
+            (times, values) = snapshot.series[channel]
+            rollups[channel] = retention.compact_series(
+                times, values, snapshot.history[channel], 20, 6)
+        self.records["series"].compact(rollups)
+        fermenter.publish_records(self.records)
+        self.append("temp", [20], 38.0)
+        update = self.updates()["temp plot update"]
+        self.assertEqual(update["series"]["temp"],
+                         {"from": 40, "to": 41, "points": [[20, 38.0]]})
+        # A client whose cursor points at rolled-up samples gets a snapshot
+        message = {"generation": 0, "cursors": {"temp": 10}}
+        updates = dict(dashboard.resync_updates(self.records, self.locks,
+                                                message))
+        series = updates["temp plot update"]["series"]["temp"]
+        self.assertEqual((series["from"], series["to"]), (0, 41))
+        self.assertEqual(len(series["points"]),
+                         len(self.records["series"]["temp"]))
+    def test_packed_points_round_trip(self):
+        broadcaster = dashboard.PlotBroadcaster(extend_impeller=False,
+                                                packed=True)
+        update = dict(broadcaster.updates(self.records, self.locks))
+        packed = update["temp plot update"]["series"]["temp"]["packed"]
+        times = packed["origin"] + np.frombuffer(
+            base64.b64decode(packed["times"]), dashboard.PACKED_TYPE)
+        values = np.frombuffer(base64.b64decode(packed["values"]),
+                               dashboard.PACKED_TYPE)
+        self.assertEqual(times.tolist(), np.arange(0, 10, 0.5).tolist())
+        self.assertEqual(values.tolist(), [37.0] * 20)
+
+if __name__ == "__main__":
+    unittest.main()
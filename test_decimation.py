@@ -0,0 +1,48 @@
+#!/usr/bin/env python2
+"""
+Regression tests of plot decimation.
+"""
+
+import unittest
+import numpy as np
+import decimation
+
+class DecimateTest(unittest.TestCase):
+    def check_extrema(self, pyramid, times, values, begin, end, npoints):
+        (_, decimated) = decimation.decimate(pyramid, times, values,
+                                             times[begin], times[end - 1],
+                                             npoints, "minmax")
+        self.assertEqual(decimated.max(), values[begin:end].max())
+        self.assertEqual(decimated.min(), values[begin:end].min())
+    def test_window_keeps_extrema_of_partial_buckets(self):
+        rng = np.random.RandomState(0)
+        values = rng.randn(4187).cumsum()
+        times = np.arange(len(values), dtype=float)
+        pyramid = decimation.MinMaxPyramid()
+        self.check_extrema(pyramid, times, values, 1468, 2135, 3)
+    def test_random_windows_keep_extrema(self):
+        rng = np.random.RandomState(1)
+        for _ in range(500):
+            length = rng.randint(100, 5000)
+            values = rng.randn(length).cumsum()
+            times = np.arange(length, dtype=float)
+            pyramid = decimation.MinMaxPyramid()
+            begin = rng.randint(0, length - 10)
+            end = rng.randint(begin + 5, length + 1)
+            self.check_extrema(pyramid, times, values, begin, end,
+                               rng.randint(3, 60))
+    def test_extrema_beyond_summarized_samples(self):
+        # A reader of a longer series may find the pyramid reset to a shorter
+        # one by another reader
+        rng = np.random.RandomState(2)
+        values = rng.randn(4000).cumsum()
+        pyramid = decimation.MinMaxPyramid()
+        pyramid.update(None, values)
+        pyramid.update(None, values[:1000] + 1)
+        indices = pyramid.extrema(values, 500, 4000, 10)
+        self.assertTrue((indices < 4000).all())
+        self.assertEqual(values[indices].max(), values[500:].max())
+        self.assertEqual(values[indices].min(), values[500:].min())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python2
+"""
+Regression tests of the streaming estimators.
+"""
+
+import unittest
+import numpy as np
+import estimators
+import fermenter
+
+class HampelFilterTest(unittest.TestCase):
+    def test_acquisitions_match_batch_filters(self):
+        rng = np.random.RandomState(0)
+        for (discard, threshold, nsamples) in (
+                (fermenter.discard_light_outliers,
+                 fermenter.LIGHT_OUTLIER_THRESHOLD,
+                 fermenter.LIGHT_SAMPLES_PER_ACQUISITION),
+                (fermenter.discard_temp_outliers,
+                 fermenter.TEMP_OUTLIER_THRESHOLD,
+                 fermenter.TEMP_SAMPLES_PER_ACQUISITION)):
+            hampel = estimators.HampelFilter(nsamples, threshold)
+            for _ in range(200):
+                samples = rng.normal(500, threshold / 2.0, nsamples).round()
+                outliers = rng.rand(nsamples) < 0.2
+                samples[outliers] += rng.choice([-1, 1], outliers.sum()) * (
+                    rng.randint(threshold, 10 * threshold, outliers.sum()))
+                hampel.clear()
+                hampel.extend(samples)
+                inliers = discard(samples)
+                self.assertEqual(hampel.median(), np.median(samples))
+                self.assertEqual(hampel.inliers(), inliers.size)
+                self.assertAlmostEqual(hampel.mean(), inliers.mean())
+    def test_window_slides_over_latest_samples(self):
+        rng = np.random.RandomState(1)
+        samples = rng.randint(0, 1024, 500)
+        hampel = estimators.HampelFilter(7, 100)
+        for (i, sample) in enumerate(samples):
+            hampel.push(sample)
+            window = samples[max(0, i - 6):i + 1]
+            self.assertEqual(hampel.values(), window.tolist())
+            self.assertEqual(hampel.median(), np.median(window))
+            inliers = window[np.abs(window - np.median(window)) <= 100]
+            if inliers.size:
+                self.assertAlmostEqual(hampel.mean(), inliers.mean())
+            else:
+                self.assertIsNone(hampel.mean())
+    def test_empty_window(self):
+        hampel = estimators.HampelFilter(5, 10)
+        self.assertIsNone(hampel.median())
+        self.assertIsNone(hampel.mean())
+        self.assertEqual(hampel.inliers(), 0)
+
+class GrowthEstimatorTest(unittest.TestCase):
+    def construct_growth(self):
+        return estimators.GrowthEstimator(window=2, min_samples=10,
+                                          min_od=0.01, min_rate=0.05,
+                                          stationary_fraction=0.2)
+    def test_rate_matches_batch_fit(self):
+        rng = np.random.RandomState(0)
+        times = np.arange(0, 6, 0.05)
+        ods = 0.02 * np.exp(0.7 * times + rng.normal(0, 0.01, times.size))
+        growth = self.construct_growth()
+        for (time, od) in zip(times, ods):
+            growth.push(time, od)
+            window = (times >= time - growth.window) & (times <= time)
+            if time - times[window][0] >= growth.window / 2.0:
+                (slope, _) = np.polyfit(times[window], np.log(ods[window]), 1)
+                self.assertAlmostEqual(growth.rate, slope, places=6)
+            else:
+                self.assertIsNone(growth.rate)
+        self.assertEqual(growth.phase, "exponential")
+    def test_rate_cleared_after_gap(self):
+        growth = self.construct_growth()
+        times = np.arange(0, 3, 0.05)
+        for time in times:
+            growth.push(time, 0.02 * np.exp(0.7 * time))
+        self.assertAlmostEqual(growth.rate, 0.7)
+        # After a gap, such as while the fermenter is stopped, too few samples
+        # are left in the window to fit the rate
+        growth.push(10, 1.0)
+        self.assertIsNone(growth.rate)
+        self.assertIsNone(growth.doubling_time)
+        self.assertEqual(growth.phase, "exponential")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python2
+"""
+Regression tests of tiered retention and of cursors across compactions.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import fermenter
+import queries
+import retention
+import runlog
+import export
+
+SAMPLE_INTERVAL = 10 / 3600.0 # (hours)
+
+class CompactionTest(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.records = fermenter.construct_records()
+        self.times = np.arange(0, 60, SAMPLE_INTERVAL)
+        self.values = 37 + rng.normal(0, 0.5, self.times.size)
+        self.records["series"]["temp"].extend(self.times, self.values)
+        fermenter.publish_records(self.records)
+    def compact(self, now, raw_retention=6):
+        snapshot = fermenter.records_snapshot(self.records)
+        (times, values) = snapshot.series["temp"]
+        arguments = retention.compact_series(times, values,
+                                             snapshot.history["temp"], now,
+                                             raw_retention)
+        if arguments is not None:
+            self.records["series"].compact({"temp": arguments})
+        fermenter.publish_records(self.records)
+        return arguments is not None
+    def query(self, **parameters):
+        return queries.query_series(self.records, "temp", **parameters)
+    def test_tiers_keep_extrema_and_counts(self):
+        self.assertTrue(self.compact(60))
+        series = self.records["series"]["temp"]
+        (mins, maxs, counts) = series.history()
+        rolled = len(counts)
+        (times, values) = series.view()
+        raw_begin = self.times.size - (len(series) - rolled)
+        # Samples are first rolled up by the minute
+        self.assertEqual(np.sum(times[:rolled] < 1), 60)
+        self.assertEqual(counts.sum(), raw_begin)
+        self.assertAlmostEqual(np.sum(values[:rolled] * counts),
+                               self.values[:raw_begin].sum(), places=6)
+        self.assertEqual(mins.min(), self.values[:raw_begin].min())
+        self.assertEqual(maxs.max(), self.values[:raw_begin].max())
+        self.assertTrue((times[rolled:] >= 54).all())
+        self.assertTrue(times[rolled - 1] < 54)
+    def test_compaction_keeps_indices_of_raw_samples(self):
+        self.assertTrue(self.compact(60))
+        series = self.records["series"]["temp"]
+        rolled = len(series.history()[2])
+        self.assertEqual(series.offset + rolled,
+                         self.times.size - (len(series) - rolled))
+        for index in (rolled, len(series) - 1):
+            original = series.offset + index
+            self.assertEqual(series.times[index], self.times[original])
+            self.assertEqual(series.values[index], self.values[original])
+        offset = series.offset
+        self.assertFalse(self.compact(60))
+        self.assertEqual(series.offset, offset)
+    def test_recompaction_keeps_counts(self):
+        self.assertTrue(self.compact(60))
+        more = np.arange(60, 62, SAMPLE_INTERVAL)
+        self.records["series"]["temp"].extend(more, np.full(more.size, 37.0))
+        self.assertTrue(self.compact(62))
+        series = self.records["series"]["temp"]
+        counts = series.history()[2]
+        # Rolled-up samples older than the minute tier are rolled up again by
+        # the hour
+        self.assertEqual(np.sum(series.times[:len(counts)] < 8), 8)
+        self.assertEqual(counts.sum() + len(series) - len(counts),
+                         self.times.size + more.size)
+        self.assertEqual(series.offset + len(series),
+                         self.times.size + more.size)
+    def test_cursor_survives_compaction(self):
+        page = self.query(t0=55, limit=100)
+        expected = self.query(t0=55, cursor=page["cursor"],
+                              generation=page["generation"],
+                              offset=page["offset"], limit=100)
+        self.assertTrue(self.compact(60))
+        resumed = self.query(t0=55, cursor=page["cursor"],
+                             generation=page["generation"],
+                             offset=page["offset"], limit=100)
+        self.assertNotEqual(resumed["offset"], page["offset"])
+        self.assertEqual(resumed["rows"], expected["rows"])
+        self.assertEqual(resumed["cursor"], expected["cursor"])
+        self.assertEqual(resumed["generation"], page["generation"])
+    def test_cursor_into_rolled_up_samples_is_rejected(self):
+        page = self.query(t0=10, limit=100)
+        self.assertTrue(self.compact(60))
+        with self.assertRaises(ValueError):
+            self.query(t0=10, cursor=page["cursor"],
+                       generation=page["generation"], offset=page["offset"])
+    def test_cursor_is_rejected_after_clear(self):
+        page = self.query(t0=55, limit=100)
+        fermenter.reinitialize_records(self.records)
+        fermenter.publish_records(self.records)
+        with self.assertRaises(ValueError):
+            self.query(t0=55, cursor=page["cursor"],
+                       generation=page["generation"], offset=page["offset"])
+    def test_export_reads_rolled_up_samples_from_log(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "test.runlog")
+            log = runlog.RunLog(path)
+            log.record_event("start", self.records["start"])
+            log.record_samples("temp", self.times, self.values)
+            log.close()
+            self.assertTrue(self.compact(60))
+            snapshot = fermenter.records_snapshot(self.records)
+            self.assertIs(export.full_resolution_snapshot(snapshot, None),
+                          snapshot)
+            full = export.full_resolution_snapshot(snapshot, path)
+            self.assertEqual(full.series["temp"][0].tolist(),
+                             self.times.tolist())
+            self.assertEqual(full.series["temp"][1].tolist(),
+                             self.values.tolist())
+            self.assertFalse(export.rolled_up(full))
+        finally:
+            shutil.rmtree(directory)
+    def test_export_without_log_holds_history(self):
+        self.assertTrue(self.compact(60))
+        snapshot = fermenter.records_snapshot(self.records)
+        (mins, maxs, counts, tiers) = export.history_columns(snapshot, "temp")
+        rolled = len(snapshot.history["temp"][2])
+        values = snapshot.series["temp"][1]
+        self.assertEqual(counts.sum(), self.times.size)
+        self.assertEqual(tiers.tolist(),
+                         [1] * rolled + [0] * (len(values) - rolled))
+        self.assertEqual(mins[rolled:].tolist(), values[rolled:].tolist())
+        self.assertTrue((mins <= values).all() and (values <= maxs).all())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python2
+"""
+Regression tests of run logging and recovery.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+import numpy as np
+import fermenter
+import runlog
+
+class RunLogTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test.runlog")
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    def write_run(self, log, start, temps):
+        log.record_event("start", start)
+        for (time, temp) in temps:
+            log.record("temp", time, temp)
+    def recover(self):
+        records = fermenter.construct_records()
+        recovered = runlog.recover_records(self.path, records)
+        return (recovered, records)
+    def test_recovers_last_run(self):
+        log = runlog.RunLog(self.path)
+        self.write_run(log, datetime(2014, 6, 1, 12), [(0, 36.0), (1, 37.0)])
+        log.record_event("stop", datetime(2014, 6, 1, 13))
+        start = datetime(2014, 6, 2, 9, 30, 15, 250000)
+        self.write_run(log, start, [(0.5, 37.5), (1.5, 37.25)])
+        log.record_samples("red", np.array([0.25, 0.75]),
+                           np.array([600.0, 590.0]))
+        log.record_event("calibration red", 610.0)
+        log.close()
+        (recovered, records) = self.recover()
+        self.assertTrue(recovered)
+        self.assertEqual(records["start"], start)
+        self.assertIsNone(records["stop"])
+        self.assertEqual(records["optics"]["calibration"]["red"], 610.0)
+        self.assertIsNone(records["optics"]["calibration"]["green"])
+        (times, values) = records["series"]["temp"].view()
+        self.assertEqual(times.tolist(), [0.5, 1.5])
+        self.assertEqual(values.tolist(), [37.5, 37.25])
+        (times, values) = records["series"]["red"].view()
+        self.assertEqual(times.tolist(), [0.25, 0.75])
+        self.assertEqual(values.tolist(), [600.0, 590.0])
+    def test_recovers_stopped_run(self):
+        log = runlog.RunLog(self.path)
+        self.write_run(log, datetime(2014, 6, 1, 12), [(0, 36.0)])
+        log.record_event("stop", datetime(2014, 6, 1, 13))
+        log.close()
+        (recovered, records) = self.recover()
+        self.assertTrue(recovered)
+        self.assertEqual(records["stop"], datetime(2014, 6, 1, 13))
+    def test_truncates_torn_record(self):
+        log = runlog.RunLog(self.path)
+        self.write_run(log, datetime(2014, 6, 1, 12), [(0, 36.0), (1, 37.0)])
+        log.close()
+        size = os.path.getsize(self.path)
+        with open(self.path, "ab") as log_file:
+            # A crash in the middle of writing a record
+            log_file.write(b"\x10" * (runlog.RECORD_SIZE - 3))
+        self.assertEqual(len(runlog.read_records(self.path)), 3)
+        log = runlog.RunLog(self.path)
+        self.assertEqual(os.path.getsize(self.path), size)
+        log.record("temp", 2, 38.0)
+        log.close()
+        (_, records) = self.recover()
+        self.assertEqual(records["series"]["temp"].view()[1].tolist(),
+                         [36.0, 37.0, 38.0])
+    def test_ignores_missing_and_empty_logs(self):
+        (recovered, records) = self.recover()
+        self.assertFalse(recovered)
+        runlog.RunLog(self.path).close()
+        (recovered, records) = self.recover()
+        self.assertFalse(recovered)
+        self.assertEqual(len(records["series"]["temp"]), 0)
+    def test_rejects_other_files(self):
+        with open(self.path, "wb") as log_file:
+            log_file.write(b"\0" * (runlog.HEADER_SIZE + runlog.RECORD_SIZE))
+        self.assertRaises(ValueError, runlog.read_records, self.path)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python2
+"""
+Regression tests of the task scheduler and adaptive intervals.
+"""
+
+import unittest
+import clocks
+import scheduler
+from scheduler import Scheduler, AdaptiveInterval, PARK
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = clocks.VirtualClock(1000)
+        self.scheduler = Scheduler(None, self.clock)
+        self.log = []
+    def steps(self, name, delays):
+        for delay in delays:
+            self.log.append((name, self.clock.time() - 1000))
+            yield delay
+    def run_all(self, futures):
+        self.scheduler.run_until(lambda: all(future.done()
+                                             for future in futures))
+    def test_steps_run_after_their_delays(self):
+        future = self.scheduler.spawn("a", self.steps("a", [5, 2.5, 0]), 0)
+        self.run_all([future])
+        self.assertEqual(self.log, [("a", 0), ("a", 5), ("a", 7.5)])
+    def test_ready_tasks_run_by_priority(self):
+        futures = [
+            self.scheduler.spawn("optics", self.steps("optics", [0, 0]),
+                                 scheduler.PRIORITY_OPTICS),
+            self.scheduler.spawn("control", self.steps("control", [0, 0]),
+                                 scheduler.PRIORITY_CONTROL),
+            self.scheduler.call(lambda: self.log.append(("command", 0))),
+        ]
+        self.run_all(futures)
+        self.assertEqual([name for (name, _) in self.log],
+                         ["control", "control", "command", "optics",
+                          "optics"])
+    def test_long_task_yields_to_urgent_task(self):
+        futures = [
+            self.scheduler.spawn("optics", self.steps("optics", [1] * 4),
+                                 scheduler.PRIORITY_OPTICS),
+            self.scheduler.spawn("control", self.steps("control", [2, 2]),
+                                 scheduler.PRIORITY_CONTROL),
+        ]
+        self.run_all(futures)
+        self.assertEqual(self.log, [("control", 0), ("optics", 0),
+                                    ("optics", 1), ("control", 2),
+                                    ("optics", 2), ("optics", 3)])
+    def test_call_returns_result_or_raises(self):
+        futures = [self.scheduler.call(lambda x: x * 2, (21,)),
+                   self.scheduler.call(lambda: 1 / 0)]
+        self.run_all(futures)
+        self.assertEqual(futures[0].result(), 42)
+        self.assertRaises(ZeroDivisionError, futures[1].result)
+    def test_parked_task_waits_for_wake(self):
+        future = self.scheduler.spawn("a", self.steps("a", [PARK, 0]), 0)
+        # Time only passes while some task sleeps
+        ticks = self.scheduler.spawn("tick", iter([100]), 1)
+        self.run_all([ticks])
+        self.assertEqual(self.log, [("a", 0)])
+        self.scheduler.wake()
+        self.run_all([future])
+        self.assertEqual(self.log, [("a", 0), ("a", 100)])
+    def test_wake_during_parking_step_is_not_lost(self):
+        def steps():
+            self.log.append(("a", self.clock.time() - 1000))
+            # Woken while running the step which parks
+            self.scheduler.wake()
+            yield PARK
+            self.log.append(("a", self.clock.time() - 1000))
+        future = self.scheduler.spawn("a", steps(), 0)
+        ticks = self.scheduler.spawn("tick", iter([100]), 1)
+        self.run_all([ticks])
+        self.assertTrue(future.done())
+        self.assertEqual(self.log, [("a", 0), ("a", 0)])
+
+class AdaptiveIntervalTest(unittest.TestCase):
+    def test_interval_adapts_to_changes(self):
+        interval = AdaptiveInterval("temp", 10, 120, (0.2,), verbose=False)
+        self.assertEqual(interval.update((37.0,)), 10)
+        # Stable readings lengthen the interval up to its maximum
+        for expected in (20, 40, 80, 120, 120):
+            self.assertEqual(interval.update((37.1,)), expected)
+        # A change of twice the tolerance halves it
+        self.assertAlmostEqual(interval.update((37.5,)), 60)
+        # Faster changes are bounded by the minimum
+        self.assertEqual(interval.update((40.0,)), 10)
+        interval.update((40.0,))
+        interval.reset("impeller changed")
+        self.assertEqual(interval.interval, 10)
+        self.assertEqual(interval.update((45.0,)), 10)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python2
+"""
+Columnar storage for the time series recorded over a fermenter run.
+"""
+
+from collections import OrderedDict
+import numpy as np
+
+###############################################################################
+# PARAMETERS
+###############################################################################
+INITIAL_CAPACITY = 1024 # number of samples preallocated for each series
+GROWTH_FACTOR = 2 # factor by which a full series grows its capacity
+SAMPLE_DTYPE = np.float64 # type of both the hours offset and the value columns
+
+###############################################################################
+# SERIES
+###############################################################################
+class TimeSeries(object):
+    """A growable series of (hours offset, value) samples.
+    Samples are stored in two preallocated typed columns whose capacity grows
+    geometrically, so appends are O(1) amortized. Samples already appended are
+    never overwritten in place: clearing the series allocates new columns. Thus
+    views returned by the series stay valid after the lock guarding the series
+    is released.
+
+    Old samples may be compacted into a history of rolled-up samples at the
+    start of the series, each of which holds the mean time and value of a
+    bucket of samples, with their minimum, maximum and count kept aside. The
+    offset of the series counts the samples removed by compaction, so that
+    the index of a sample plus the offset stays the same across compactions
+    until the sample itself is rolled up.
+    """
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        self._capacity = capacity
+        self._allocate(capacity)
+    def __len__(self):
+        return self._size
+    def _allocate(self, capacity):
+        """Replaces the columns with new empty columns."""
+        self._times = np.empty(capacity, dtype=SAMPLE_DTYPE)
+        self._values = np.empty(capacity, dtype=SAMPLE_DTYPE)
+        self._size = 0
+        self._offset = 0
+        self._set_history([], [], [])
+    def _set_history(self, mins, maxs, counts):
+        """Replaces the columns of rolled-up samples with read-only copies."""
+        self._history = tuple(np.array(column, dtype=SAMPLE_DTYPE)
+                              for column in (mins, maxs, counts))
+        for column in self._history:
+            column.flags.writeable = False
+    def _grow(self):
+        """Grows the capacity of the columns, keeping all samples."""
+        capacity = max(1, self._times.size) * GROWTH_FACTOR
+        times = np.empty(capacity, dtype=SAMPLE_DTYPE)
+        values = np.empty(capacity, dtype=SAMPLE_DTYPE)
+        times[:self._size] = self._times[:self._size]
+        values[:self._size] = self._values[:self._size]
+        self._times = times
+        self._values = values
+    def append(self, time, value):
+        """Appends a sample to the end of the series."""
+        if self._size == self._times.size:
+            self._grow()
+        self._times[self._size] = time
+        self._values[self._size] = value
+        self._size += 1
+    def extend(self, times, values):
+        """Appends arrays of samples to the end of the series."""
+        size = self._size + len(times)
+        while size > self._times.size:
+            self._grow()
+        self._times[self._size:size] = times
+        self._values[self._size:size] = values
+        self._size = size
+    def clear(self):
+        """Removes all samples from the series."""
+        self._allocate(self._capacity)
+    def compact(self, begin, times, values, mins, maxs, counts):
+        """Replaces the samples before an index with rolled-up samples.
+        The samples from the index on are kept, in new columns. An index past
+        the end of the series replaces all samples, as if the missing samples
+        had been appended and rolled up. The offset grows by the number of
+        samples replaced less the number of rolled-up samples.
+
+        Arguments:
+            begin: the index of the first sample kept
+            times, values: the mean times and values of the rolled-up samples
+            mins, maxs, counts: the minimum, maximum and number of the values
+                rolled up into each sample
+        """
+        kept = max(0, self._size - begin)
+        capacity = max(self._capacity, len(times) + kept)
+        columns = []
+        for (rolled, column) in ((times, self._times),
+                                 (values, self._values)):
+            merged = np.empty(capacity, dtype=SAMPLE_DTYPE)
+            merged[:len(rolled)] = rolled
+            merged[len(rolled):len(rolled) + kept] = column[begin:self._size]
+            columns.append(merged)
+        (self._times, self._values) = columns
+        self._size = len(times) + kept
+        self._offset += begin - len(times)
+        self._set_history(mins, maxs, counts)
+    def last(self):
+        """Returns the most recent sample as a tuple, or None if empty."""
+        if not self._size:
+            return None
+        return (float(self._times[self._size - 1]),
+                float(self._values[self._size - 1]))
+    def view(self, begin=0, end=None):
+        """Returns read-only views of the times and values columns.
+        Views do not copy the underlying samples.
+
+        Arguments:
+            begin: the index of the first sample in the views
+            end: the index after the last sample in the views
+        """
+        if end is None or end > self._size:
+            end = self._size
+        times = self._times[begin:end]
+        values = self._values[begin:end]
+        times.flags.writeable = False
+        values.flags.writeable = False
+        return (times, values)
+    def history(self):
+        """Returns read-only views of the minimums, maximums and counts of the
+        rolled-up samples at the start of the series.
+        """
+        return self._history
+    @property
+    def offset(self):
+        """The number of samples removed from the start of the series by
+        compaction, net of the rolled-up samples which replaced them.
+        """
+        return self._offset
+    @property
+    def times(self):
+        """A read-only view of the hours offsets of all samples."""
+        return self.view()[0]
+    @property
+    def values(self):
+        """A read-only view of the values of all samples."""
+        return self.view()[1]
+    @property
+    def nbytes(self):
+        """The number of bytes used by the samples of the series."""
+        return (self._size * (self._times.itemsize + self._values.itemsize) +
+                sum(column.nbytes for column in self._history))
+
+###############################################################################
+# STORES
+###############################################################################
+class TimeSeriesStore(object):
+    """A collection of named time series, one per recorded channel.
+    The generation of the store counts how many times it has been cleared, so
+    that a (generation, index plus offset) pair identifies a sample across
+    clears and compactions.
+    Listeners are called with the channel, time and value of every sample
+    appended to the store.
+    """
+    def __init__(self, channels, capacity=INITIAL_CAPACITY):
+        self.generation = 0
+        self._listeners = []
+        self._series = OrderedDict()
+        for channel in channels:
+            self._series[channel] = TimeSeries(capacity)
+    def __getitem__(self, channel):
+        return self._series[channel]
+    def __contains__(self, channel):
+        return channel in self._series
+    def __iter__(self):
+        return iter(self._series)
+    def channels(self):
+        """Returns the names of all channels in the store."""
+        return list(self._series.keys())
+    def add_listener(self, listener):
+        """Registers a function to be called on every appended sample."""
+        self._listeners.append(listener)
+    def append(self, channel, time, value):
+        """Appends a sample to the specified channel."""
+        self._series[channel].append(time, value)
+        for listener in self._listeners:
+            listener(channel, time, value)
+    def last(self, channel):
+        """Returns the most recent sample of the specified channel."""
+        return self._series[channel].last()
+    def clear(self):
+        """Removes all samples from all channels."""
+        for series in self._series.values():
+            series.clear()
+        self.generation += 1
+    def compact(self, rollups):
+        """Replaces old samples of channels with rolled-up samples.
+        Compaction shifts the offsets of the compacted series instead of
+        starting a new generation, so consumers of samples appended since keep
+        their place.
+
+        Arguments:
+            rollups: a dict of the arguments of TimeSeries.compact, keyed by
+                channel
+        """
+        for (channel, arguments) in rollups.items():
+            self._series[channel].compact(*arguments)
+    @property
+    def nbytes(self):
+        """The number of bytes used by the samples of all channels."""
+        return sum(series.nbytes for series in self._series.values())